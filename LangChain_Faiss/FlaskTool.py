@@ -1,7 +1,23 @@
+import os
+# 生產模式 (RAG_SERVE_MODE=production 直接執行) 使用 gevent 伺服器，必須在其他匯入前 monkey patch
+PRODUCTION = __name__ == '__main__' and os.getenv("RAG_SERVE_MODE") == "production"
+if PRODUCTION:
+    from gevent import monkey
+    monkey.patch_all()
+
 from flask import Flask, jsonify, request
 from datetime import datetime
-from LangChainTool import LangChainTool
+from LangChainTool import get_shared_tool
+from serving import ServiceOverloaded, pool_from_env
 app = Flask(__name__)
+
+# LLM 呼叫共用的有上限工作池，排隊已滿回 429、排隊逾時回 503
+llm_pool = pool_from_env()
+
+@app.errorhandler(ServiceOverloaded)
+def handle_overloaded(e):
+    return jsonify(e.to_dict()), e.status_code, {"Retry-After": str(e.retry_after)}
+
 @app.route("/")
 def home():
     return "Welcome to the Flask API!"
@@ -26,15 +42,15 @@ def get_time():
 @app.route("/ask/", methods=["GET"])
 def ask():
     question = request.args.get("question")
-    ans = LangChainTool().Embeddings_FAISS(questions=question, texts=None)
-    # ans= LangChainTool().answer_question(questions=question)
+    # 使用啟動時建立的共用索引與問答鏈，不再每個請求重建索引
+    ans = llm_pool.run(get_shared_tool().ask, questions=question)
     return ans
 
 from flask_socketio import SocketIO, send, emit
 # 當有客戶端連線時
 
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="gevent" if PRODUCTION else None)
 @socketio.on('connect')
 def handle_connect():
     print("有客戶端連線進來了")
@@ -51,10 +67,31 @@ def handle_message(data):
 @socketio.on('chat')
 def handle_chat(data):
     print("聊天室訊息:", data)
-    # ans = LangChainTool().Embeddings_FAISS(questions=data, texts=None)
-    ans = LangChainTool().answer_question(questions=data)
-    emit('chat', {'msg': f"{ans}"}, broadcast=True)
+    # 逐段送出 LLM 輸出 (delta)，最後送出完整回答與首個 token 延遲
+    tokens = []
+    ttft_ms = None
+    try:
+        with llm_pool.slot():
+            for token, ttft_ms in get_shared_tool().stream_ask(questions=data):
+                tokens.append(token)
+                emit('chat', {'msg': token, 'delta': True, 'done': False}, broadcast=True)
+                socketio.sleep(0)
+    except ServiceOverloaded as e:
+        emit('chat', {'msg': str(e), 'delta': False, 'done': True, 'error': e.status_code})
+        return
+    emit('chat', {'msg': "".join(tokens), 'delta': False, 'done': True, 'ttft_ms': ttft_ms}, broadcast=True)
 
 if __name__ == '__main__':
-    # 用 eventlet 啟動支援 WebSocket
-    socketio.run(app, host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    # 啟動時載入或建立索引（語料變更時才重建）；debug 模式下只在實際服務請求的重載子進程中執行，
+    # 其他方式匯入 (例如 WSGI 伺服器) 時由第一個請求建立
+    if PRODUCTION or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        get_shared_tool()
+    if PRODUCTION:
+        # gevent pywsgi + gevent-websocket，關閉 debug 與自動重載；以連線池限制同時連線數
+        from gevent.pool import Pool
+        max_connections = int(os.getenv("RAG_MAX_CONNECTIONS", str((llm_pool.max_workers + llm_pool.max_queue) * 4)))
+        print(f"🚀 生產模式啟動 (gevent): workers={llm_pool.max_workers}, queue={llm_pool.max_queue}, "
+              f"max_connections={max_connections}")
+        socketio.run(app, host="0.0.0.0", port=5000, spawn=Pool(max_connections))
+    else:
+        socketio.run(app, host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -1,84 +1,92 @@
 import os
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_community.chat_models import ChatOllama
+import time
+import hashlib
+import threading
 from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.docstore.document import Document
-import re
-import regex
+from langchain_core.documents import Document
 from dotenv import load_dotenv
-from langchain_community.embeddings import OllamaEmbeddings
+from embedding_cache import CachedEmbeddings, get_default_cache
+from vector_index import build_vector_store, apply_search_params, resolve_params
+from index_storage import save_vector_store, load_vector_store, LegacyPickleIndexError
+from variant_rules import VariantEngine, LANGCHAIN_TOOL_RULES
+from metrics import timed, observe
+from providers import create_embeddings, create_chat_model, provider_name
+
+# LangChainTool 一直以 normalize_L2 + L2 距離建立索引
+DEFAULT_INDEX_CONFIG = {"index_type": "flat", "distance_strategy": "EUCLIDEAN_DISTANCE", "normalize_L2": True}
 load_dotenv()
 
-class LangChainTool:
-    # 環境變數
-    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-    print("OPENAI_API_KEY:", OPENAI_API_KEY)
-
-
-    def __init__(self):
-        self.embeddings = OllamaEmbeddings(model="nomic-embed-text")  # 或 "mxbai-embed-large" 
+# 預設知識庫內容
+DEFAULT_TEXTS = [
+    "LangChain 是一個強大的框架，用來建構 LLM 應用。",
+    "FAISS 是由 Facebook AI 提供的向量檢索資料庫。",
+    "你可以將文件轉換成 Embeddings，然後用 FAISS 做相似度搜尋。",
+    "Kevin Sin是NSG的大PM。",
+    "Danny Huang是NSG的總經理。",
+    "Suet Tang是Will的老婆。"
+]
 
-    def generate_variants(self, texts: list) -> list:
-        variants = set()
-        PUNCT = r"。；；,.;!?！？、"
-        def clean_sentence(text: str) -> str:
-            return re.sub(fr"^[\s{PUNCT}]+|[\s{PUNCT}]+$", "", text)
+# 索引目錄內記錄語料指紋的檔案，用來判斷是否需要重建索引
+CORPUS_FINGERPRINT_FILE = "corpus.sha256"
 
-        for text in texts:
-            # 去掉前後中英文標點
-            sentence = clean_sentence(text)
+# 文本變體規則 (編譯一次，大語料時自動分塊並行)
+VARIANT_ENGINE = VariantEngine(LANGCHAIN_TOOL_RULES)
 
-            if not sentence:
-                continue
-
-            # 原句
-            variants.add(sentence)
-
-            # 如果包含「是」，嘗試生成變體
-            if "是" in sentence:
-                parts = sentence.split("是", 1)
-                if len(parts) == 2:
-                    left, right = parts[0].strip(), parts[1].strip()
-
-                    if left and right:
-                        # 倒裝句
-                        variants.add(f"{right}是{left}。")
-
-                        # 問句（誰是 right）
-                        variants.add(f"誰是{right}？是{left}。")
+# 如果 context 中沒有答案，就回答「我不知道」。
+SYSTEM_PROMPT = """
+        回答必須以「Will: 」開頭，且最多三句話。
+        如果檢索結果顯示某人身份或職稱，就直接回答該身份。
+        如果 context 中找到某人對應的身份或職稱，就直接輸出該身份或職稱，如果在資料庫發現就不要用自己的知識補充。
+        {context}
+        """
 
-                        # 問句（left 是誰）
-                        variants.add(f"{left}是誰？是{right}。")
 
-                        # 問句（right 是什麼）
-                        variants.add(f"{right}是什麼？是{left}。")
+class LangChainTool:
+    def __init__(self, index_path: str = "faiss_index", index_type: str = None, index_params: dict = None):
+        # 透過持久化快取包裝，重建索引時已嵌入過的文本 (含變體) 不再重新計算
+        embeddings = create_embeddings("ollama", "nomic-embed-text")  # 或 "mxbai-embed-large"
+        self.embeddings = CachedEmbeddings(
+            embeddings,
+            get_default_cache(),
+            model_name=f"{provider_name()}:{embeddings.model}"
+        )
+        self.index_path = index_path
+        # 索引類型: flat / ivf_flat / ivf_pq / hnsw / sq_fp16 / sq_int8 (預設讀取 FAISS_INDEX_TYPE)
+        self.index_type = index_type or os.getenv("FAISS_INDEX_TYPE", "flat")
+        self.index_params = index_params
 
-        return list(variants)
+        # 進程內共用的索引與問答鏈，只在啟動或語料變更時建立
+        self.db = None
+        self.qa_chain = None
+        self.corpus_fingerprint = None
+        self._lock = threading.Lock()
 
-    def Embeddings_FAISS(self, questions, texts=None):
-        """
-        LangChain + FAISS 最小可行範例
-        """
-
-        # 1. 準備文本資料 預備文本
-        if not texts:
-            texts = [
-                "LangChain 是一個強大的框架，用來建構 LLM 應用。",
-                "FAISS 是由 Facebook AI 提供的向量檢索資料庫。",
-                "你可以將文件轉換成 Embeddings，然後用 FAISS 做相似度搜尋。",
-                "Kevin Sin是NSG的大PM。",
-                "Danny Huang是NSG的總經理。",
-                "Suet Tang是Will的老婆。"
-            ]
+    def generate_variants(self, texts: list) -> list:
+        """原句 (去掉前後中英文標點) 加上「是」句型的倒裝句與問句，規則見 variant_rules.LANGCHAIN_TOOL_RULES"""
+        return VARIANT_ENGINE.variants(texts)
 
+    @staticmethod
+    def fingerprint(texts: list) -> str:
+        """計算語料指紋，語料不變時指紋也不變"""
+        digest = hashlib.sha256()
+        for text in texts:
+            digest.update(text.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _read_saved_fingerprint(self):
+        path = os.path.join(self.index_path, CORPUS_FINGERPRINT_FILE)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def build_index(self, texts: list):
+        """生成變體、建立 FAISS 索引並寫入磁碟（只在語料變更時呼叫）"""
         texts = self.generate_variants(texts)
 
-
         docs = [
             Document(page_content=t, metadata={"index": i})
             for i, t in enumerate(texts)
@@ -87,24 +95,62 @@ class LangChainTool:
         # 2. 建立 Embeddings 與 FAISS 向量資料庫
         # embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
         """
-        但 llama3.2 是聊天/生成模型，不是向量嵌入模型。用它做 embedding 
+        但 llama3.2 是聊天/生成模型，不是向量嵌入模型。用它做 embedding
         會很差（或直接不對），FAISS 當然就抓不到「Kevin Sin」那句。👇給你兩個可用方案與最小修正。
         """
         # embeddings = OllamaEmbeddings(model="llama3.2:latest")
         # embeddings = OpenAIEmbeddings(model="text-embedding-3-small")  # 或 text-embedding-3-large
         # ollama pull nomic-embed-text
 
-        
-
-
         """
         1) 用「餵 Cosine」的方式建索引
 
         FAISS 在 LangChain 預設是 L2 距離；而句向量常用 Cosine 相似度。做法是把向量 先做 L2 正規化 再用 L2 搜尋（等效於 Cosine）。
         👉 只要在 from_documents 加 normalize_L2=True：
         """
-        db = FAISS.from_documents(docs, self.embeddings, normalize_L2=True)
-
+        if self.index_type == "flat":
+            db = FAISS.from_documents(docs, self.embeddings, normalize_L2=True)
+            config = {"index_type": "flat", "normalize_L2": True}
+        else:
+            db, config = build_vector_store(docs, self.embeddings, self.index_type, self.index_params)
+            config["normalize_L2"] = True
+        save_vector_store(db, self.index_path, {**DEFAULT_INDEX_CONFIG, **config})
+        return db
+
+    def load_or_build(self, texts: list = None):
+        """
+        啟動時呼叫一次：語料指紋與磁碟上的索引一致就直接載入，否則重建。
+        之後每個請求只需要做查詢 embedding、檢索與生成。
+        """
+        texts = texts or DEFAULT_TEXTS
+        # 索引類型不同也需要重建
+        fingerprint = self.fingerprint(texts + [f"index_type={self.index_type}"])
+
+        with self._lock:
+            if self.qa_chain is not None and fingerprint == self.corpus_fingerprint:
+                return
+
+            db = None
+            if fingerprint == self._read_saved_fingerprint():
+                print("載入已存在的索引:", self.index_path)
+                try:
+                    db, config = load_vector_store(self.index_path, self.embeddings, DEFAULT_INDEX_CONFIG)
+                    apply_search_params(db.index, resolve_params(config))
+                except (LegacyPickleIndexError, FileNotFoundError, ValueError) as e:
+                    # 舊的 pickle 索引不直接讀取，語料就在手上，重建即可
+                    print("無法載入索引，改為重建:", e)
+
+            if db is None:
+                print("語料已變更，重建索引:", self.index_path)
+                db = self.build_index(texts)
+                with open(os.path.join(self.index_path, CORPUS_FINGERPRINT_FILE), "w", encoding="utf-8") as f:
+                    f.write(fingerprint)
+
+            self.db = db
+            self.qa_chain = self._create_qa_chain(db)
+            self.corpus_fingerprint = fingerprint
+
+    def _create_qa_chain(self, db):
         # 3. 建立檢索器
         """
         2) k 調大、MMR 更穩
@@ -114,10 +160,6 @@ class LangChainTool:
             search_type="mmr",                # 改成 mmr
             search_kwargs={"k": 8, "fetch_k": 20, "lambda_mult": 0.5}
         )
-        print("=== DEBUG Retrieved ===")
-        for r in retriever.get_relevant_documents("誰是 Kevin Sin"):
-            print(r.metadata, r.page_content)
-        print("=======================")
 
         # 4. 結合 LLM 問答
         # llm = ChatOpenAI(
@@ -125,80 +167,82 @@ class LangChainTool:
         #     temperature=0
         # )
 
-        llm = ChatOllama(model="llama3.2:latest")
-        # 如果 context 中沒有答案，就回答「我不知道」。
-        system_prompt = """
-        回答必須以「Will: 」開頭，且最多三句話。
-        如果檢索結果顯示某人身份或職稱，就直接回答該身份。
-        如果 context 中找到某人對應的身份或職稱，就直接輸出該身份或職稱，如果在資料庫發現就不要用自己的知識補充。
-        {context}
-        """
-        
+        llm = create_chat_model("ollama", "llama3.2:latest")
+
         prompt = ChatPromptTemplate.from_messages(
             [
-                ("system", system_prompt),
+                ("system", SYSTEM_PROMPT),
                 ("human", "{input}"),
             ]
         )
 
-        # 建立 QA chain
+        # 建立 QA chain (langchain.chains 只在建立時匯入)
+        from langchain.chains import create_retrieval_chain
+        from langchain.chains.combine_documents import create_stuff_documents_chain
         question_answer_chain = create_stuff_documents_chain(llm, prompt)
-        qa_chain = create_retrieval_chain(retriever, question_answer_chain)
+        return create_retrieval_chain(retriever, question_answer_chain)
+
+    def debug_retrieval(self, query: str = "誰是 Kevin Sin"):
+        """印出檢索結果，只用於除錯，不在請求路徑上執行"""
+        print("=== DEBUG Retrieved ===")
+        for r in self.db.max_marginal_relevance_search(query, k=8, fetch_k=20, lambda_mult=0.5):
+            print(r.metadata, r.page_content)
+        print("=======================")
+
+    def ask(self, questions: str) -> str:
+        """使用已建立的問答鏈回答問題"""
+        if self.qa_chain is None:
+            self.load_or_build()
 
         # 5. 問問題
-        # query = input("請輸入你的問題: ")
-        result = qa_chain.invoke({"input": questions})
-        db.save_local("faiss_index")
+        with timed("tool_answer"):
+            result = self.qa_chain.invoke({"input": questions})
         print("問題:", questions)
-        print("回答:", result["answer"])    
+        print("回答:", result["answer"])
         return result["answer"]
 
-    def answer_question(self, questions: str) -> str:
-        db = FAISS.load_local("faiss_index", self.embeddings, allow_dangerous_deserialization=True)
+    def stream_ask(self, questions: str):
+        """
+        串流回答：每收到一段 LLM 輸出就 yield 一次
+        回傳 (token, ttft_ms)，ttft_ms 為從收到問題到第一個 token 的延遲
+        """
+        if self.qa_chain is None:
+            self.load_or_build()
+
+        start = time.perf_counter()
+        ttft_ms = None
+        for chunk in self.qa_chain.stream({"input": questions}):
+            token = chunk.get("answer")
+            if not token:
+                continue
+            if ttft_ms is None:
+                ttft_ms = (time.perf_counter() - start) * 1000
+                observe("tool_ttft", ttft_ms / 1000)
+                print(f"首個 token 延遲: {ttft_ms:.1f}ms")
+            yield token, ttft_ms
 
-        # 3. 建立檢索器
+    def Embeddings_FAISS(self, questions, texts=None):
         """
-        2) k 調大、MMR 更穩
+        LangChain + FAISS 最小可行範例
+        索引只在語料變更時重建，否則重用已建立的索引與問答鏈
         """
-        # retriever = db.as_retriever(search_type="similarity", search_kwargs={"k": 4})
-        retriever = db.as_retriever(
-            search_type="mmr",                # 改成 mmr
-            search_kwargs={"k": 8, "fetch_k": 20, "lambda_mult": 0.5}
-        )
-        print("=== DEBUG Retrieved ===")
-        for r in retriever.get_relevant_documents("誰是 Kevin Sin"):
-            print(r.metadata, r.page_content)
-        print("=======================")
+        self.load_or_build(texts)
+        return self.ask(questions)
 
-        # 4. 結合 LLM 問答
-        # llm = ChatOpenAI(
-        #     model="gpt-4o-mini",  # 也可以用 "gpt-4o" 或 "gpt-3.5-turbo"
-        #     temperature=0
-        # )
+    def answer_question(self, questions: str) -> str:
+        return self.ask(questions)
 
-        llm = ChatOllama(model="llama3.2:latest")
-        #如果 context 中沒有答案，就回答「我不知道」。
-        system_prompt = """
-        回答必須以「Will: 」開頭，且最多三句話。
-        如果 context 中找到某人對應的身份或職稱，就直接輸出該身份或職稱，如果在資料庫發現就不要用自己的知識補充。
-        如果檢索結果顯示某人身份或職稱，就直接回答該身份。
-        {context}
-        """
 
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", system_prompt),
-                ("human", "{input}"),
-            ]
-        )
+_shared_tool = None
+_shared_lock = threading.Lock()
 
-        # 建立 QA chain
-        question_answer_chain = create_stuff_documents_chain(llm, prompt)
-        qa_chain = create_retrieval_chain(retriever, question_answer_chain)
 
-        # 5. 問問題
-        # query = input("請輸入你的問題: ")
-        result = qa_chain.invoke({"input": questions})
-        print("問題:", questions)
-        print("回答:", result["answer"])    
-        return result["answer"]
+def get_shared_tool(texts: list = None) -> LangChainTool:
+    """取得進程內共用的 LangChainTool，第一次呼叫時載入或建立索引"""
+    global _shared_tool
+    with _shared_lock:
+        if _shared_tool is None:
+            tool = LangChainTool()
+            tool.load_or_build(texts)
+            _shared_tool = tool
+    return _shared_tool
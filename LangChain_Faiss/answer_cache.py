@@ -0,0 +1,166 @@
+"""
+語意答案快取
+放在 ImprovedRAG.answer_question 前面：
+1. 預處理後的查詢完全相同時直接命中
+2. (RAG_ANSWER_CACHE_SEMANTIC=1 時) 查詢向量與已快取的查詢餘弦相似度超過門檻，
+   且兩者的詞 (英數字詞與個別中文字) 集合相同時也命中 (例如「Kevin Sin是誰」與「誰是Kevin Sin」)；
+   只差一個人名的問題向量也很接近，詞集合的檢查避免回傳另一個人的答案
+項目有 TTL 並依 LRU 淘汰；知識庫變更時呼叫 invalidate() 清空，避免回傳過期答案。
+"""
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+DEFAULT_TTL_SECONDS = float(os.getenv("RAG_ANSWER_CACHE_TTL", "600"))
+DEFAULT_MAX_ENTRIES = int(os.getenv("RAG_ANSWER_CACHE_SIZE", "1024"))
+DEFAULT_SIMILARITY_THRESHOLD = float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", "0.95"))
+# 近似比對預設關閉，只有完全相同的查詢會命中
+DEFAULT_SEMANTIC = os.getenv("RAG_ANSWER_CACHE_SEMANTIC", "0") == "1"
+
+_TERM_PATTERN = re.compile(r"[a-z0-9]+|[㐀-鿿豈-﫿]")
+
+
+def query_terms(query: str) -> frozenset:
+    """查詢的英數字詞與個別中文字 (忽略標點、空白與順序)"""
+    return frozenset(_TERM_PATTERN.findall(query.lower()))
+
+
+class _Entry:
+    __slots__ = ("slot", "result", "expires_at", "terms")
+
+    def __init__(self, slot: int, result: Dict[str, Any], expires_at: float, terms: frozenset):
+        self.slot = slot
+        self.result = result
+        self.expires_at = expires_at
+        self.terms = terms
+
+
+class AnswerCache:
+    """以完全比對 + 向量近似比對的 LRU/TTL 答案快取"""
+
+    def __init__(self, ttl_seconds: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD, semantic: bool = DEFAULT_SEMANTIC):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self.similarity_threshold = similarity_threshold
+        self.semantic = semantic
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        # 查詢向量存在預先配置的矩陣，一次矩陣乘法就能比對所有快取項目
+        self._matrix: Optional[np.ndarray] = None
+        self._slot_keys: List[Optional[str]] = [None] * self.max_entries
+        self._free_slots = list(range(self.max_entries - 1, -1, -1))
+
+        # 知識庫版本：invalidate() 後，之前開始計算的答案不會被寫入
+        self.generation = 0
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_exact(self, query: str) -> Optional[Dict[str, Any]]:
+        """完全比對 (不需要 embedding)"""
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry is None:
+                return None
+            if entry.expires_at < time.monotonic():
+                self._remove(query)
+                return None
+            self._entries.move_to_end(query)
+            self.exact_hits += 1
+            return entry.result
+
+    def get_similar(self, query: str, query_vector: List[float]) -> Optional[Dict[str, Any]]:
+        """向量近似比對，找出相似度最高、超過門檻且詞集合與 query 相同的快取項目 (未啟用時一律未命中)"""
+        vector = self._normalize(query_vector)
+        terms = query_terms(query)
+        with self._lock:
+            if (not self.semantic or self._matrix is None or not self._entries
+                    or vector.shape[0] != self._matrix.shape[1]):
+                self.misses += 1
+                return None
+
+            scores = self._matrix @ vector
+            now = time.monotonic()
+            for slot in np.argsort(-scores):
+                if scores[slot] < self.similarity_threshold:
+                    break
+                key = self._slot_keys[slot]
+                if key is None:
+                    continue
+                entry = self._entries[key]
+                if entry.expires_at < now:
+                    self._remove(key)
+                    continue
+                if entry.terms != terms:
+                    continue
+                self._entries.move_to_end(key)
+                self.semantic_hits += 1
+                return entry.result
+
+            self.misses += 1
+            return None
+
+    def put(self, query: str, query_vector: List[float], result: Dict[str, Any], generation: int):
+        """寫入快取；generation 與目前版本不同 (期間知識庫已變更) 時忽略"""
+        vector = self._normalize(query_vector)
+        with self._lock:
+            if generation != self.generation:
+                return
+            if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+                self._matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+
+            if query in self._entries:
+                self._remove(query)
+            while not self._free_slots:
+                self._remove(next(iter(self._entries)))
+
+            slot = self._free_slots.pop()
+            self._matrix[slot] = vector
+            self._slot_keys[slot] = query
+            self._entries[query] = _Entry(slot, result, time.monotonic() + self.ttl_seconds, query_terms(query))
+
+    def invalidate(self):
+        """知識庫變更時清空所有快取答案"""
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            for key in list(self._entries):
+                self._remove(key)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._matrix[entry.slot] = 0.0
+        self._slot_keys[entry.slot] = None
+        self._free_slots.append(entry.slot)
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm > 0 else array
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "semantic": self.semantic,
+                "similarity_threshold": self.similarity_threshold,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "generation": self.generation,
+            }
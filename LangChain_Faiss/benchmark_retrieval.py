@@ -0,0 +1,122 @@
+"""
+單次檢索 vs 舊版兩次檢索的延遲對比
+舊版 answer_question 在 qa_chain.invoke 內檢索一次，
+再於 query_with_rerank 內重新預處理並檢索一次，只為了產生除錯輸出。
+"""
+import time
+import statistics
+from typing import Dict, Any
+from improved_rag import ImprovedRAG
+from tabulate import tabulate
+
+
+def legacy_answer_question(rag: ImprovedRAG, query: str) -> Dict[str, Any]:
+    """重現舊版兩次檢索的 answer_question"""
+    qa_chain = rag.create_advanced_chain()
+    processed_query = rag.preprocess_query(query)
+    result = qa_chain.invoke({"input": processed_query})
+    rerank_result = rag.query_with_rerank(query)
+    return {
+        "answer": result["answer"],
+        "source_documents": result.get("context", []),
+        "reranked_documents": rerank_result["documents"]
+    }
+
+
+class QueryEmbeddingCounter:
+    """
+    計算實際送到 embedding 模型的查詢數
+    包在 MicroBatchEmbeddings 的 query_underlying 上，最近查詢快取命中的不會被算進去；
+    批次窗口開啟時查詢經由 embed_documents 送出，以文本數計算
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = getattr(embeddings, "query_underlying", embeddings)
+        self.original_query = self.embeddings.embed_query
+        self.original_documents = self.embeddings.embed_documents
+        self.calls = 0
+
+        def counting_embed_query(text):
+            self.calls += 1
+            return self.original_query(text)
+
+        def counting_embed_documents(texts):
+            self.calls += len(texts)
+            return self.original_documents(texts)
+
+        self.embeddings.embed_query = counting_embed_query
+        self.embeddings.embed_documents = counting_embed_documents
+
+    def reset(self):
+        self.calls = 0
+
+
+def time_path(fn, rag, queries, rounds, counter):
+    latencies = []
+    counter.reset()
+    # 每個問題開始前清空最近查詢的向量，重複的問題不會因為上一輪的快取而少算 embedding
+    clear_recent = getattr(rag.embeddings, "clear_recent", None)
+    for _ in range(rounds):
+        for query in queries:
+            if clear_recent is not None:
+                clear_recent()
+            start = time.perf_counter()
+            fn(rag, query)
+            latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "mean": statistics.mean(latencies),
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "embed_calls_per_query": counter.calls / len(latencies)
+    }
+
+
+def benchmark_single_pass(rag: ImprovedRAG = None, rounds: int = 3):
+    """比較舊版兩次檢索與新版單次檢索的延遲"""
+    print("\n⚡ 單次檢索基準測試")
+    print("="*60)
+
+    if rag is None:
+        rag = ImprovedRAG(use_openai=False)
+        rag.setup_documents([
+            "LangChain 是一個強大的框架，用來建構 LLM 應用。",
+            "FAISS 是由 Facebook AI 提供的向量檢索資料庫。",
+            "Kevin Sin是NSG的大PM。",
+            "Danny Huang是NSG的總經理。",
+            "NSG是一個技術團隊，負責開發AI相關產品。",
+        ])
+
+    queries = [
+        "Kevin Sin是誰？",
+        "誰是NSG的總經理？",
+        "什麼是LangChain？",
+        "NSG團隊做什麼？",
+    ]
+
+    counter = QueryEmbeddingCounter(rag.embeddings)
+
+    # 先各跑一次熱身，避免模型載入時間影響結果
+    legacy_answer_question(rag, queries[0])
+    rag.answer_question(queries[0], use_cache=False)
+
+    legacy = time_path(legacy_answer_question, rag, queries, rounds, counter)
+    # 關閉答案快取，兩條路徑都實際檢索與生成
+    single = time_path(lambda r, q: r.answer_question(q, use_cache=False), rag, queries, rounds, counter)
+
+    table = [
+        ["舊版 (兩次檢索)", f"{legacy['mean']*1000:.1f}", f"{legacy['p50']*1000:.1f}",
+         f"{legacy['p95']*1000:.1f}", f"{legacy['embed_calls_per_query']:.1f}"],
+        ["新版 (單次檢索)", f"{single['mean']*1000:.1f}", f"{single['p50']*1000:.1f}",
+         f"{single['p95']*1000:.1f}", f"{single['embed_calls_per_query']:.1f}"],
+    ]
+    print(tabulate(table, headers=["路徑", "平均(ms)", "p50(ms)", "p95(ms)", "查詢embedding次數"], tablefmt="grid"))
+
+    saved = legacy["mean"] - single["mean"]
+    print(f"🎯 每個問題節省: {saved*1000:.1f}ms ({saved / legacy['mean'] * 100:.1f}%)")
+
+    return {"legacy": legacy, "single_pass": single, "saved_seconds": saved}
+
+
+if __name__ == "__main__":
+    benchmark_single_pass()
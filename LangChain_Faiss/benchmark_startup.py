@@ -0,0 +1,187 @@
+"""
+啟動時間基準測試
+每個目標在新的 Python 進程中執行，量測匯入時間與可以開始服務的時間 (time-to-ready)，
+並列出匯入最久的套件 (python -X importtime) 與實際載入的後端套件。
+- FlaskTool:          匯入模組後載入或建立共用的 LangChainTool 索引
+- improved_flask_api: 匯入模組 (背景開始載入索引) 後等到就緒 (含暖機)
+- faissTool:          匯入模組後 main() 讀取索引
+預設以 RAG_PROVIDER=fake 使用離線替身，在暫存目錄內執行；第一輪建立索引，之後各輪載入已存在的索引。
+
+用法:
+    python benchmark_startup.py --runs 3 --output startup_results.json
+    python benchmark_startup.py --provider ollama   # 使用真正的後端 (需要 Ollama 服務)
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import Any, Dict, List
+
+from tabulate import tabulate
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# 只在選用時才應該載入的套件
+BACKEND_MODULES = ("langchain_openai", "langchain_ollama", "langchain.chains", "langchain_text_splitters")
+
+# 子進程: 量測匯入與就緒時間，最後一行輸出 JSON
+CHILD_SCRIPT = """
+import io, sys, json, time, contextlib
+start = time.perf_counter()
+target = sys.argv[1]
+if target == "FlaskTool":
+    import FlaskTool
+    imported = time.perf_counter()
+    FlaskTool.get_shared_tool()
+elif target == "improved_flask_api":
+    with contextlib.redirect_stdout(io.StringIO()):
+        import improved_flask_api
+        imported = time.perf_counter()
+        improved_flask_api.lifecycle.wait()
+    assert improved_flask_api.lifecycle.ready, improved_flask_api.lifecycle.error
+elif target == "faissTool":
+    import faissTool
+    imported = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        faissTool.main(["faiss_index"])
+ready = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "ready_ms": (ready - start) * 1000,
+    "modules": len(sys.modules),
+    "backends": [name for name in %r if name in sys.modules],
+}))
+""" % (BACKEND_MODULES,)
+
+TARGETS = ("FlaskTool", "improved_flask_api", "faissTool")
+
+
+def parse_importtime(stderr: str, exclude: str = "", top: int = 5) -> List[Dict[str, Any]]:
+    """
+    彙總 -X importtime 的輸出: 依頂層套件加總各模組本身的匯入時間 (不含子匯入，避免重複計算)
+    exclude 為目標模組本身 (模組層級的載入與背景執行緒的工作會算在它身上)
+    """
+    totals: Dict[str, int] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        package = parts[2].strip().split(".")[0]
+        if package == exclude:
+            continue
+        totals[package] = totals.get(package, 0) + int(parts[0])
+    ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [{"package": package, "ms": us / 1000} for package, us in ranked]
+
+
+def run_target(target: str, workdir: str, env: Dict[str, str]) -> Dict[str, Any]:
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD_SCRIPT, target],
+        cwd=workdir, env=env, capture_output=True, text=True
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        tail = "\n".join(line for line in proc.stderr.splitlines() if not line.startswith("import time:"))
+        raise RuntimeError(f"{target} 啟動失敗:\n{tail[-2000:]}")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["process_ms"] = wall_ms
+    result["top_imports"] = parse_importtime(proc.stderr, exclude=target)
+    return result
+
+
+def interpreter_ms(env: Dict[str, str]) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], env=env, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def print_report(results: List[Dict[str, Any]], baseline_ms: float):
+    rows = [
+        [
+            item["target"],
+            item["phase"],
+            f"{item['process_ms']:.0f}",
+            f"{item['import_ms']:.0f}",
+            f"{item['ready_ms']:.0f}",
+            item["modules"],
+            ", ".join(item["backends"]) or "-",
+            ", ".join(f"{entry['package']} {entry['ms']:.0f}" for entry in item["top_imports"][:3]),
+        ]
+        for item in results
+    ]
+    print(f"\n🐍 直譯器啟動 (python -c pass): {baseline_ms:.0f}ms")
+    print(tabulate(rows, headers=[
+        "目標", "索引", "進程 (ms)", "匯入 (ms)", "就緒 (ms)", "模組數", "已載入後端", "匯入最久 (ms)"
+    ], tablefmt="github"))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="啟動時間基準測試")
+    parser.add_argument("--targets", default=",".join(TARGETS), help="逗號分隔的目標")
+    parser.add_argument("--runs", type=int, default=2, help="每個目標的執行次數 (第一次建立索引)")
+    parser.add_argument("--provider", default="fake", help="RAG_PROVIDER (fake / ollama / openai)")
+    parser.add_argument("--output", default="startup_results.json", help="JSON 結果輸出路徑")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    targets = [target for target in args.targets.split(",") if target]
+    for target in targets:
+        if target not in TARGETS:
+            raise SystemExit(f"不支援的目標: {target}，可用: {', '.join(TARGETS)}")
+
+    workdir = tempfile.mkdtemp(prefix="rag_startup_")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [HERE, env.get("PYTHONPATH")]))
+    env["EMBEDDING_CACHE_PATH"] = os.path.join(workdir, "embedding_cache.sqlite")
+    if args.provider:
+        env["RAG_PROVIDER"] = args.provider
+
+    print("⚡ 啟動時間基準測試")
+    print("="*60)
+    print(f"📂 工作目錄: {workdir} (RAG_PROVIDER={args.provider})")
+
+    results = []
+    try:
+        baseline_ms = interpreter_ms(env)
+        for run in range(args.runs):
+            for target in targets:
+                result = run_target(target, workdir, env)
+                result["target"] = target
+                result["phase"] = "建立" if run == 0 and target != "faissTool" else "載入"
+                results.append(result)
+                print(f"  {target} #{run + 1}: 就緒 {result['ready_ms']:.0f}ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results, baseline_ms)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": vars(args),
+        "interpreter_ms": baseline_ms,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📁 結果已保存到: {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+離線 RAG 基準測試套件
+使用 fake_backends 的確定性 embedding / 聊天模型替身 (延遲可設定)，
+逐一量測 ImprovedRAG 各階段的延遲分佈 (p50/p95/p99) 與記憶體，並輸出 JSON 結果。
+
+用法:
+    python benchmark_suite.py --sizes 10,100,1000,10000 --output benchmark_results.json
+    python benchmark_suite.py --sizes 1000000 --dim 32   # 一百萬句語料需要數 GB 記憶體
+"""
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+from typing import Callable, Dict, List, Any
+
+from tabulate import tabulate
+
+from improved_rag import ImprovedRAG
+from fake_backends import FakeEmbeddings, FakeChatModel
+
+
+NAMES = ["Kevin Sin", "Danny Huang", "Suet Tang", "Will", "Amy Lee", "Tom Chan", "Iris Wu", "Ken Ho"]
+TEAMS = ["NSG", "AI團隊", "平台部", "資料組", "研發中心"]
+TITLES = ["PM", "總經理", "工程師", "主管", "負責人", "總監"]
+TOPICS = ["LangChain", "FAISS", "Python", "RAG系統", "向量資料庫", "機器學習"]
+KINDS = ["框架", "資料庫", "工具", "技術", "平台"]
+
+QUERY_TEMPLATES = [
+    "{name}是誰？",
+    "誰是{team}的{title}？",
+    "什麼是{topic}？",
+    "{team}的總裁是誰？",
+    "如何使用{topic}？",
+]
+
+
+def generate_corpus(size: int, seed: int = 42) -> List[str]:
+    """產生確定性的合成語料，句型涵蓋人物職位與技術工具兩類"""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        if i % 2 == 0:
+            corpus.append(f"{rng.choice(NAMES)}{i}是{rng.choice(TEAMS)}的{rng.choice(TITLES)}。")
+        else:
+            corpus.append(f"{rng.choice(TOPICS)}{i}是一個用於AI開發的{rng.choice(KINDS)}。")
+    return corpus
+
+
+def generate_queries(count: int, seed: int = 7) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        rng.choice(QUERY_TEMPLATES).format(
+            name=rng.choice(NAMES), team=rng.choice(TEAMS),
+            title=rng.choice(TITLES), topic=rng.choice(TOPICS)
+        )
+        for _ in range(count)
+    ]
+
+
+def rss_mb() -> float:
+    """目前的常駐記憶體 (MB)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage / 1024 if sys.platform != "darwin" else usage / (1024 * 1024)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近秩 (nearest-rank) 百分位數"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(p / 100 * len(sorted_values) + 0.4999)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(samples_ms: List[float], rss_before: float, rss_after: float) -> Dict[str, Any]:
+    values = sorted(samples_ms)
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) if values else 0.0,
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+        "max_ms": values[-1] if values else 0.0,
+        "rss_mb": rss_after,
+        "rss_delta_mb": rss_after - rss_before,
+    }
+
+
+def measure(fn: Callable, inputs: List[Any], setup: Callable = None) -> (List[float], List[Any]):
+    """對每個輸入執行一次 fn，回傳每次延遲 (ms) 與輸出；setup(輸入) 在每次量測前執行，不計入延遲"""
+    samples, outputs = [], []
+    for item in inputs:
+        if setup is not None:
+            setup(item)
+        start = time.perf_counter()
+        outputs.append(fn(item))
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples, outputs
+
+
+def create_rag(args) -> ImprovedRAG:
+    embeddings = FakeEmbeddings(
+        dim=args.dim,
+        latency_ms=args.embed_latency_ms,
+        per_text_latency_ms=args.embed_per_text_latency_ms,
+    )
+    llm = FakeChatModel(ttft_ms=args.llm_ttft_ms, token_latency_ms=args.llm_token_latency_ms)
+    # 不使用持久化快取與微批次，量測的是管線本身的成本
+    return ImprovedRAG(embeddings=embeddings, llm=llm, use_embedding_cache=False, batch_window_ms=0,
+                       multi_vector=args.multi_vector)
+
+
+def benchmark_size(size: int, args) -> Dict[str, Any]:
+    corpus = generate_corpus(size, seed=args.seed)
+    queries = generate_queries(args.queries, seed=args.seed + 1)
+    rag = create_rag(args)
+    stages: Dict[str, Any] = {}
+
+    gc.collect()
+    # 變體生成：依批次量測 (每批最多 1000 句)
+    batches = [corpus[i:i + 1000] for i in range(0, len(corpus), 1000)]
+    before = rss_mb()
+    samples, _ = measure(rag.enhance_text_variants, batches)
+    stages["enhance_text_variants"] = summarize(samples, before, rss_mb())
+
+    # 建立索引 (單次量測，可用 --build-repeats 重複)
+    samples = []
+    before = rss_mb()
+    for _ in range(args.build_repeats):
+        start = time.perf_counter()
+        rag.setup_documents(corpus)
+        samples.append((time.perf_counter() - start) * 1000)
+    stages["setup_documents"] = summarize(samples, before, rss_mb())
+    vector_count = rag.vector_db.index.ntotal
+    parent_count = len(rag.parents) if rag.parents is not None else None
+
+    # 生成的查詢會重複，每次量測前清掉查詢正規化與最近查詢向量的快取，量測的是第一次處理的成本
+    def clear_query_caches(_):
+        rag.query_normalizer.normalize.cache_clear()
+        rag.embeddings.clear_recent()
+
+    before = rss_mb()
+    samples, processed = measure(rag.preprocess_query, queries, setup=clear_query_caches)
+    stages["preprocess_query"] = summarize(samples, before, rss_mb())
+
+    before = rss_mb()
+    samples, hits = measure(rag.search_hits, processed, setup=clear_query_caches)
+    stages["retrieval"] = summarize(samples, before, rss_mb())
+
+    # 與實際路徑相同: 傳入檢索得到的向量位置，查詢向量在檢索時剛嵌入過 (量測前先放進最近查詢表)
+    before = rss_mb()
+    samples, _ = measure(lambda item: rag.rerank(item[0][0], item[1], item[0][1]), list(zip(hits, processed)),
+                         setup=lambda item: rag.embeddings.embed_query(item[1]))
+    stages["rerank"] = summarize(samples, before, rss_mb())
+
+    if args.with_llm:
+        before = rss_mb()
+        samples, _ = measure(lambda q: rag.answer_question(q, use_cache=False), queries, setup=clear_query_caches)
+        stages["answer_question"] = summarize(samples, before, rss_mb())
+
+    # 快照目錄旁還有預寫日誌與暫存目錄，一起放在臨時根目錄下
+    bench_root = tempfile.mkdtemp(prefix="rag_bench_")
+    index_dir = os.path.join(bench_root, "index")
+    try:
+        before = rss_mb()
+        samples, _ = measure(lambda _: rag.save_index(index_dir), range(args.build_repeats))
+        stages["save_index"] = summarize(samples, before, rss_mb())
+        index_bytes = sum(
+            os.path.getsize(os.path.join(index_dir, name)) for name in os.listdir(index_dir)
+        )
+
+        loader = create_rag(args)
+        before = rss_mb()
+        samples, _ = measure(lambda _: loader.load_index(index_dir), range(args.build_repeats))
+        stages["load_index"] = summarize(samples, before, rss_mb())
+        loader.close_wal()
+    finally:
+        rag.close_wal()
+        shutil.rmtree(bench_root, ignore_errors=True)
+
+    return {
+        "corpus_size": size,
+        "vector_count": vector_count,
+        "parent_count": parent_count,
+        "index_bytes": index_bytes,
+        "embed_calls": rag.embeddings.underlying.calls,
+        "stages": stages,
+    }
+
+
+def print_report(results: List[Dict[str, Any]]):
+    rows = []
+    for result in results:
+        for stage, s in result["stages"].items():
+            rows.append([
+                result["corpus_size"], stage, s["count"],
+                f"{s['p50_ms']:.3f}", f"{s['p95_ms']:.3f}", f"{s['p99_ms']:.3f}",
+                f"{s['rss_mb']:.1f}", f"{s['rss_delta_mb']:+.1f}"
+            ])
+    headers = ["語料數", "階段", "樣本數", "p50(ms)", "p95(ms)", "p99(ms)", "RSS(MB)", "ΔRSS(MB)"]
+    print(tabulate(rows, headers=headers, tablefmt="grid"))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="離線 RAG 基準測試套件")
+    parser.add_argument("--sizes", default="10,100,1000,10000",
+                        help="逗號分隔的語料大小，最多支援 1000000")
+    parser.add_argument("--queries", type=int, default=200, help="每個語料大小的查詢數")
+    parser.add_argument("--dim", type=int, default=64, help="fake embedding 維度")
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0, help="每次 embedding 呼叫的模擬延遲")
+    parser.add_argument("--embed-per-text-latency-ms", type=float, default=0.0, help="每段文本的模擬延遲")
+    parser.add_argument("--llm-ttft-ms", type=float, default=0.0, help="模擬首個 token 延遲")
+    parser.add_argument("--llm-token-latency-ms", type=float, default=0.0, help="模擬每個 token 延遲")
+    parser.add_argument("--with-llm", action="store_true", help="同時量測完整 answer_question")
+    parser.add_argument("--multi-vector", action="store_true", help="變體只作為指向原句的向量 (父文檔模式)")
+    parser.add_argument("--build-repeats", type=int, default=1, help="建立/保存/載入索引的重複次數")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON 結果輸出路徑")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+
+    print("⚡ 離線 RAG 基準測試")
+    print("="*60)
+
+    results = []
+    for size in sizes:
+        print(f"📚 語料大小: {size}")
+        results.append(benchmark_size(size, args))
+        gc.collect()
+
+    print_report(results)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📁 結果已保存到: {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+查詢 embedding 微批次處理
+在短時間窗口內同時到達的查詢合併成一次 embed_documents 呼叫，
+再把向量分送回各自的呼叫者，減少對 embedding 後端的單筆 HTTP 請求。
+"""
+import os
+import time
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any
+
+from langchain_core.embeddings import Embeddings
+
+
+DEFAULT_WINDOW_MS = float(os.getenv("RAG_EMBED_BATCH_WINDOW_MS", "5"))
+DEFAULT_MAX_BATCH_SIZE = int(os.getenv("RAG_EMBED_MAX_BATCH_SIZE", "32"))
+DEFAULT_MAX_CONCURRENT_BATCHES = int(os.getenv("RAG_EMBED_MAX_CONCURRENT_BATCHES", "4"))
+DEFAULT_RECENT_QUERIES = int(os.getenv("RAG_EMBED_RECENT_QUERIES", "256"))
+
+# 批次大小分佈的統計區間
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class _PendingQuery:
+    __slots__ = ("text", "enqueued_at", "vector", "error", "done")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.enqueued_at = time.perf_counter()
+        self.vector = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatchEmbeddings(Embeddings):
+    """
+    包裝任意 LangChain Embeddings
+    embed_query 會在 window_ms 內等待其他查詢，湊滿 max_batch_size 或窗口結束時一起送出；
+    embed_documents 本身已是批次呼叫，直接轉交。
+    最多 max_concurrent_batches 個批次同時送往後端，前一批尚未完成時下一批可以先送出。
+    最近 recent_queries 個查詢的向量保留在記憶體，同一個問題在答案快取與檢索之間只嵌入一次。
+    query_underlying 為查詢使用的後端 (預設同 underlying)，例如文檔走持久化快取、查詢直接呼叫模型，
+    使用者的一次性問題不會寫進文檔 embedding 快取。
+    """
+
+    def __init__(self, underlying: Embeddings, window_ms: float = DEFAULT_WINDOW_MS,
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_concurrent_batches: int = DEFAULT_MAX_CONCURRENT_BATCHES,
+                 recent_queries: int = DEFAULT_RECENT_QUERIES, query_underlying: Embeddings = None):
+        self.underlying = underlying
+        self.query_underlying = query_underlying or underlying
+        self.window_ms = window_ms
+        self.max_batch_size = max(1, max_batch_size)
+        self.recent_queries = recent_queries
+        self._recent: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._recent_lock = threading.Lock()
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._worker = None
+        self._dispatch_slots = threading.BoundedSemaphore(max(1, max_concurrent_batches))
+        self._dispatcher = ThreadPoolExecutor(
+            max_workers=max(1, max_concurrent_batches), thread_name_prefix="embedding-batch"
+        )
+
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.queries = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.max_batch_seen = 0
+        self.batch_size_counts = {bucket: 0 for bucket in BATCH_SIZE_BUCKETS}
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self._recent_lock:
+            vector = self._recent.get(text)
+            if vector is not None:
+                self._recent.move_to_end(text)
+                return vector
+
+        vector = self._embed_query_batched(text)
+
+        if self.recent_queries > 0:
+            with self._recent_lock:
+                self._recent[text] = vector
+                while len(self._recent) > self.recent_queries:
+                    self._recent.popitem(last=False)
+        return vector
+
+    def clear_recent(self):
+        """清空最近查詢的向量 (基準測試量測未命中時的成本)"""
+        with self._recent_lock:
+            self._recent.clear()
+
+    def _embed_query_batched(self, text: str) -> List[float]:
+        # 窗口為 0 時不做批次處理
+        if self.window_ms <= 0:
+            return self.query_underlying.embed_query(text)
+
+        pending = _PendingQuery(text)
+        with self._cond:
+            self._ensure_worker()
+            self._queue.append(pending)
+            self._cond.notify()
+
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.vector
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            # 等到有空的發送名額才開始組下一批，後端忙碌時批次會自然變大
+            self._dispatch_slots.acquire()
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+
+                # 從第一個查詢到達開始計時，窗口結束或批次已滿就送出
+                deadline = self._queue[0].enqueued_at + self.window_ms / 1000
+                while len(self._queue) < self.max_batch_size:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch_size))]
+
+            self._dispatcher.submit(self._process, batch)
+
+    def _process(self, batch: List[_PendingQuery]):
+        sent_at = time.perf_counter()
+        try:
+            vectors = self.query_underlying.embed_documents([p.text for p in batch])
+            for pending, vector in zip(batch, vectors):
+                pending.vector = vector
+        except Exception as e:
+            for pending in batch:
+                pending.error = e
+        finally:
+            self._dispatch_slots.release()
+            for pending in batch:
+                pending.done.set()
+
+        self._record(batch, sent_at)
+
+    def _record(self, batch: List[_PendingQuery], sent_at: float):
+        waits = [(sent_at - p.enqueued_at) * 1000 for p in batch]
+        size = len(batch)
+        with self._stats_lock:
+            self.batches += 1
+            self.queries += size
+            self.total_wait_ms += sum(waits)
+            self.max_wait_ms = max(self.max_wait_ms, max(waits))
+            self.max_batch_seen = max(self.max_batch_seen, size)
+            for bucket in BATCH_SIZE_BUCKETS:
+                if size <= bucket:
+                    self.batch_size_counts[bucket] += 1
+                    break
+            else:
+                self.batch_size_counts[BATCH_SIZE_BUCKETS[-1]] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "window_ms": self.window_ms,
+                "max_batch_size": self.max_batch_size,
+                "batches": self.batches,
+                "queries": self.queries,
+                "avg_batch_size": self.queries / self.batches if self.batches else 0.0,
+                "max_batch_seen": self.max_batch_seen,
+                "batch_size_histogram": {f"<={b}": n for b, n in self.batch_size_counts.items()},
+                "avg_added_wait_ms": self.total_wait_ms / self.queries if self.queries else 0.0,
+                "max_added_wait_ms": self.max_wait_ms,
+            }
@@ -0,0 +1,196 @@
+"""
+持久化的 Embedding 快取
+以 (embedding 模型名稱, 文本雜湊) 為 key 存在 SQLite，超過容量上限時依 LRU 淘汰。
+所有建立索引的路徑共用同一份快取，重建或重啟時只需要為新文本付出 embedding 成本。
+"""
+import os
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from typing import List, Optional, Dict, Any
+
+from langchain_core.embeddings import Embeddings
+
+
+DEFAULT_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite")
+DEFAULT_MAX_BYTES = int(float(os.getenv("EMBEDDING_CACHE_MAX_MB", "512")) * 1024 * 1024)
+
+
+def _cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """以 SQLite 實作的 LRU embedding 快取"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_access INTEGER NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)"
+        )
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(nbytes), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """批次查詢，未命中的位置回傳 None"""
+        keys = [_cache_key(model, t) for t in texts]
+        found: Dict[str, List[float]] = {}
+
+        with self._lock:
+            # SQLite 單一查詢的參數數量有限，分批查詢
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+
+            if found:
+                now = time.time_ns()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+
+            results = [found.get(key) for key in keys]
+            hit_count = sum(1 for r in results if r is not None)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+
+        return results
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        """批次寫入，寫入後檢查容量並淘汰最久未使用的項目"""
+        now = time.time_ns()
+        rows = []
+        for text, vector in zip(texts, vectors):
+            blob = array("f", vector).tobytes()
+            rows.append((_cache_key(model, text), model, blob, len(blob), now))
+
+        with self._lock:
+            for key, _, blob, nbytes, _ in rows:
+                old = self._conn.execute(
+                    "SELECT nbytes FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if old:
+                    self._total_bytes -= old[0]
+                self._total_bytes += nbytes
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, nbytes, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """超過容量上限時依 last_access 淘汰 (呼叫者需持有鎖)"""
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, nbytes FROM embeddings ORDER BY last_access LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            freed = 0
+            evicted = []
+            for key, nbytes in rows:
+                evicted.append((key,))
+                freed += nbytes
+                if self._total_bytes - freed <= self.max_bytes:
+                    break
+            self._conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+            self._total_bytes -= freed
+            self.evictions += len(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "path": self.path,
+                "entries": entries,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """包裝任意 LangChain Embeddings，embed_documents 會先查詢持久化快取"""
+
+    def __init__(self, underlying: Embeddings, cache: EmbeddingCache, model_name: str = None):
+        self.underlying = underlying
+        self.cache = cache
+        self.model_name = model_name or (
+            f"{type(underlying).__name__}:{getattr(underlying, 'model', '')}"
+        )
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.cache.get_many(self.model_name, texts)
+
+        # 只為未命中的文本呼叫 embedding 模型 (同一批次內重複的文本只算一次)
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        if missing:
+            new_vectors = self.underlying.embed_documents(missing)
+            self.cache.put_many(self.model_name, missing, new_vectors)
+            computed = dict(zip(missing, new_vectors))
+            vectors = [v if v is not None else computed[t] for t, v in zip(texts, vectors)]
+
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.underlying.embed_query(text)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return {"model": self.model_name, **self.cache.stats()}
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache() -> EmbeddingCache:
+    """取得進程內共用的 embedding 快取"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+    return _default_cache
@@ -1,40 +1,36 @@
-import faiss
+import sys
 
-# 讀取索引
-index = faiss.read_index("faiss_index/index.faiss")
+from index_storage import ColumnarDocstore, DOCSTORE_FILE, INDEX_FILE, read_index_mmap
+from vector_index import load_index_config
 
-# 查看索引維度、向量數量
-print("維度:", index.d)
-print("向量數量:", index.ntotal)
 
-# 因為 FAISS 索引本身只有向量，文件內容是存在旁邊的 index.pkl 裡。
-# 所以要看原始文件，要用 LangChain 的 load_local：
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # 要查看的索引目錄 (預設是 LangChainTool 的 faiss_index)
+    folder = argv[0] if argv else "faiss_index"
+    config = load_index_config(folder) or {}
 
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.embeddings import OllamaEmbeddings
+    # 以 mmap 讀取索引，不會把整個索引載入記憶體
+    index = read_index_mmap(f"{folder}/{INDEX_FILE}", config.get("index_type", "flat"))
 
-import os 
-from dotenv import load_dotenv
-load_dotenv()
+    # 查看索引維度、向量數量
+    print("維度:", index.d)
+    print("向量數量:", index.ntotal)
+    print("索引類型:", type(index).__name__)
 
-# 環境變數
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-# embeddings = OpenAIEmbeddings(model="text-embedding-3-small", api_key=OPENAI_API_KEY)
+    # 因為 FAISS 索引本身只有向量，文件內容是存在旁邊的 docstore.bin 裡。
+    # docstore.bin 是欄式檔案，不需要 pickle，也不需要 embedding 模型，按位置逐筆讀取：
+    # (舊的 index.pkl 目錄請先執行 python index_storage.py migrate <目錄>)
 
-embeddings = OllamaEmbeddings(model="llama3.2:latest")
+    docstore = ColumnarDocstore(f"{folder}/{DOCSTORE_FILE}")
 
+    for position in range(docstore.count):
+        doc = docstore.row(position)
+        print("🆔 ID:", doc.id)
+        print("📄 內容:", doc.page_content)
+        print("📎 Metadata:", doc.metadata)
+        print("-" * 40)
 
-db = FAISS.load_local("faiss_index", embeddings, allow_dangerous_deserialization=True)
 
-# 看所有存的文件
-print(db.docstore._dict)   # 一個 dict，key 是 id，value 是 Document
-
-
-# 如果只想查一筆：
-
-for k, v in db.docstore._dict.items():
-    print("🆔 ID:", k)
-    print("📄 內容:", v.page_content)
-    print("📎 Metadata:", v.metadata)
-    print("-" * 40)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
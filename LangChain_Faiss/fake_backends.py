@@ -0,0 +1,115 @@
+"""
+確定性的離線 embedding 與聊天模型替身
+不需要 Ollama / OpenAI，可在 CI 上重現基準測試結果。
+- FakeEmbeddings: 以 token 雜湊產生向量，共用詞彙的文本向量也相近，延遲可設定
+- FakeChatModel: 回傳固定格式的答案，支援串流，首個 token 延遲與生成速度可設定
+"""
+import time
+import hashlib
+from typing import Any, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from keyword_index import tokenize
+
+
+def _hash64(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    確定性的 embedding 替身
+    每個 token 雜湊到一個維度 (正負號也由雜湊決定)，再加上一點由全文決定的雜訊，最後做 L2 正規化。
+    latency_ms 是每次呼叫的固定延遲，per_text_latency_ms 是每段文本額外的延遲。
+    """
+
+    def __init__(self, dim: int = 64, latency_ms: float = 0.0, per_text_latency_ms: float = 0.0,
+                 noise: float = 0.05, model: str = "fake-embed"):
+        self.dim = dim
+        self.latency_ms = latency_ms
+        self.per_text_latency_ms = per_text_latency_ms
+        self.noise = noise
+        self.model = model
+        self.calls = 0
+        self.texts_embedded = 0
+
+    def _vector(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in tokenize(text):
+            h = _hash64(token)
+            vector[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        rng = np.random.default_rng(_hash64(text))
+        vector += rng.standard_normal(self.dim).astype(np.float32) * self.noise
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm > 0 else vector).tolist()
+
+    def _sleep(self, count: int):
+        delay = self.latency_ms + self.per_text_latency_ms * count
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        self.texts_embedded += len(texts)
+        self._sleep(len(texts))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    確定性的聊天模型替身
+    答案為 "Will: " 加上問題的回聲，ttft_ms 為首個 token 前的延遲，
+    token_latency_ms 為之後每個 token 的延遲。
+    """
+
+    ttft_ms: float = 0.0
+    token_latency_ms: float = 0.0
+    answer_prefix: str = "Will: "
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _answer_tokens(self, messages: List[BaseMessage]) -> List[str]:
+        question = str(messages[-1].content) if messages else ""
+        answer = f"{self.answer_prefix}根據資料回答「{question}」。"
+        # 以 4 個字元為一個 token 模擬串流輸出
+        return [answer[i:i + 4] for i in range(0, len(answer), 4)]
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        tokens = self._answer_tokens(messages)
+        delay = self.ttft_ms + self.token_latency_ms * max(0, len(tokens) - 1)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        for i, token in enumerate(self._answer_tokens(messages)):
+            delay = self.ttft_ms if i == 0 else self.token_latency_ms
+            if delay > 0:
+                time.sleep(delay / 1000)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
@@ -0,0 +1,144 @@
+"""
+向量 + 關鍵詞的混合檢索
+兩種搜索同時進行 (FAISS 搜索在執行緒池執行，期間會釋放 GIL；BM25 在呼叫端執行緒)，
+結果以文檔的整數位置做加權 reciprocal rank fusion，最後才從 docstore 取出文檔。
+混合檢索的延遲約為 max(向量, 關鍵詞)，而不是兩者相加。
+多向量模式 (parents) 下多取幾倍的子向量，合併後依父文檔去重，回傳父文檔。
+"""
+import os
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from parent_documents import PARENT_FETCH_FACTOR
+from metrics import timed
+
+
+HYBRID_VECTOR_K = int(os.getenv("RAG_HYBRID_VECTOR_K", "5"))
+HYBRID_KEYWORD_K = int(os.getenv("RAG_HYBRID_KEYWORD_K", "3"))
+HYBRID_WEIGHTS = tuple(float(w) for w in os.getenv("RAG_HYBRID_WEIGHTS", "0.7,0.3").split(","))
+HYBRID_MAX_K = int(os.getenv("RAG_HYBRID_MAX_K", "1000"))
+HYBRID_WORKERS = int(os.getenv("RAG_HYBRID_WORKERS", "8"))
+# 與 EnsembleRetriever 相同的 RRF 常數
+RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+VECTOR_SCORE_THRESHOLD = float(os.getenv("RAG_VECTOR_SCORE_THRESHOLD", "0.1"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """所有檢索器共用一個執行緒池"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=HYBRID_WORKERS, thread_name_prefix="hybrid-search")
+        return _executor
+
+
+def weighted_rrf(rankings: Sequence[Sequence[int]], weights: Sequence[float],
+                 rrf_k: int = RRF_K) -> List[Tuple[int, float]]:
+    """加權 reciprocal rank fusion: score = Σ weight / (rrf_k + 名次)，回傳依分數排序的 (位置, 分數)"""
+    scores: Dict[int, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        if not weight:
+            continue
+        for rank, position in enumerate(ranking, 1):
+            scores[position] = scores.get(position, 0.0) + weight / (rrf_k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridRetriever(BaseRetriever):
+    """並行的向量 + BM25 檢索，以加權 RRF 合併；可以逐次指定權重與檢索深度"""
+
+    vector_db: Any
+    keyword_index: Any
+    embeddings: Any
+    vector_k: int = HYBRID_VECTOR_K
+    keyword_k: int = HYBRID_KEYWORD_K
+    weights: Tuple[float, float] = HYBRID_WEIGHTS
+    score_threshold: Optional[float] = VECTOR_SCORE_THRESHOLD
+    rrf_k: int = RRF_K
+    # 多向量模式的 ParentStore，None 表示每個向量就是一份文檔
+    parents: Any = None
+
+    def vector_search(self, query_vector, k: int) -> List[int]:
+        """直接查 FAISS 索引，回傳相關度達門檻的向量位置"""
+        if k <= 0 or self.vector_db.index.ntotal == 0:
+            return []
+        with timed("vector_search"):
+            vector = np.array([query_vector], dtype=np.float32)
+            if self.vector_db._normalize_L2:
+                faiss.normalize_L2(vector)
+            distances, indices = self.vector_db.index.search(vector, k)
+            relevance = self.vector_db._select_relevance_score_fn()
+            return [
+                int(position) for position, distance in zip(indices[0], distances[0])
+                if position >= 0 and (self.score_threshold is None or relevance(distance) >= self.score_threshold)
+            ]
+
+    def keyword_search(self, query: str, k: int) -> List[int]:
+        if k <= 0:
+            return []
+        with timed("keyword_search"):
+            return [position for position, _ in self.keyword_index.search(query, k)]
+
+    def search(self, query: str, query_vector=None, weights: Optional[Sequence[float]] = None,
+               vector_k: Optional[int] = None, keyword_k: Optional[int] = None) -> List[Tuple[int, float]]:
+        """回傳合併後的 (向量位置, RRF 分數)；權重為 0 的一側不會搜索"""
+        vector_weight, keyword_weight = self.weights if weights is None else weights
+        vector_k = self.vector_k if vector_k is None else vector_k
+        keyword_k = self.keyword_k if keyword_k is None else keyword_k
+        if not vector_weight:
+            vector_k = 0
+        if not keyword_weight:
+            keyword_k = 0
+        limit = None
+        if self.parents is not None:
+            # 同一父文檔的多個變體可能同時命中，多取一些再去重，回傳數量與一般模式相同
+            limit = vector_k + keyword_k
+            vector_k, keyword_k = vector_k * PARENT_FETCH_FACTOR, keyword_k * PARENT_FETCH_FACTOR
+
+        if vector_k > 0:
+            if query_vector is None:
+                with timed("embed_query"):
+                    query_vector = self.embeddings.embed_query(query)
+            if keyword_k > 0:
+                # 帶上目前的 context，請求分析的階段記錄也涵蓋執行緒池內的向量搜索
+                vector_future = _get_executor().submit(
+                    contextvars.copy_context().run, self.vector_search, query_vector, vector_k
+                )
+                keyword_hits = self.keyword_search(query, keyword_k)
+                vector_hits = vector_future.result()
+            else:
+                vector_hits, keyword_hits = self.vector_search(query_vector, vector_k), []
+        else:
+            vector_hits, keyword_hits = [], self.keyword_search(query, keyword_k)
+
+        with timed("fusion"):
+            hits = weighted_rrf([vector_hits, keyword_hits], [vector_weight, keyword_weight], self.rrf_k)
+            if self.parents is not None:
+                hits = self.parents.dedupe(hits, limit)
+            return hits
+
+    def child_document(self, position: int) -> Document:
+        return self.vector_db.docstore.search(self.vector_db.index_to_docstore_id[position])
+
+    def documents(self, hits: Sequence[Tuple[int, float]]) -> List[Document]:
+        """向量位置 -> 文檔 (多向量模式為父文檔)"""
+        with timed("fetch_documents"):
+            if self.parents is not None:
+                return self.parents.resolve([position for position, _ in hits], self.child_document)
+            return [self.child_document(position) for position, _ in hits]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.documents(self.search(query))
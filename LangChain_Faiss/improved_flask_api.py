@@ -1,6 +1,15 @@
-from flask import Flask, jsonify, request, render_template_string
-from improved_rag import ImprovedRAG
+from flask import Flask, Response, g, jsonify, request, render_template_string, stream_with_context
+from improved_rag import ImprovedRAG, INGEST_BATCH_SIZE
+from hybrid_retriever import HYBRID_MAX_K
+from serving import pool_from_env, serve_production
+import metrics
+from profiling import PROFILE_ENABLED, PROFILE_HEADER, PROFILE_TOKEN_HEADER, PROFILE_STORE, authorized, choose_mode, maybe_profile
+from lifecycle import ServiceLifecycle
+from index_registry import IndexRegistry, UnknownIndex, DEFAULT_INDEX
+import os
+import sys
 import json
+import time
 from datetime import datetime
 
 app = Flask(__name__)
@@ -8,10 +17,138 @@ app = Flask(__name__)
 # 全局RAG實例
 rag_instance = None
 
-def initialize_rag():
-    """初始化RAG系統"""
-    global rag_instance
-    
+# 生產模式下 embedding / LLM 路由共用的有上限工作池
+rag_pool = pool_from_env()
+
+# /rag/add_documents 單次請求的文檔數上限
+INGEST_MAX_DOCUMENTS = int(os.getenv("RAG_INGEST_MAX_DOCUMENTS", "10000"))
+
+# 匯入模組時就在背景載入索引並暖機 (任何 WSGI/ASGI 伺服器都適用)；
+# 0 表示第一個請求 (例如健康檢查) 時才開始，適合 gunicorn --preload 等會在 fork 前匯入的情況
+AUTOSTART = os.getenv("RAG_AUTOSTART", "1") != "0"
+
+# 就緒前回 503 的路由 (需要索引與模型)
+READY_ENDPOINTS = {"rag_ask", "rag_search", "add_document", "add_documents"}
+
+# /rag/metrics 輸出時才讀取的狀態值
+metrics.REGISTRY.gauge("rag_vectors", "Vectors in the FAISS index.",
+                       lambda: rag_instance.vector_db.index.ntotal if rag_instance and rag_instance.vector_db else None)
+metrics.REGISTRY.gauge("rag_parent_documents", "Parent documents in multi-vector mode.",
+                       lambda: len(rag_instance.parents) if rag_instance and rag_instance.parents is not None else None)
+metrics.REGISTRY.gauge("rag_worker_pool_in_flight", "Requests running in the worker pool.",
+                       lambda: rag_pool.stats()["in_flight"])
+metrics.REGISTRY.gauge("rag_worker_pool_queued", "Requests waiting for a worker.",
+                       lambda: rag_pool.stats()["queued"])
+metrics.REGISTRY.gauge("rag_index_loaded_disk_bytes", "On-disk size of the named indexes loaded on demand.",
+                       lambda: index_registry.stats()["loaded_disk_mb"] * 1024 * 1024)
+metrics.REGISTRY.gauge("rag_indexes_loaded", "Indexes resident in this process, including the default one.",
+                       lambda: index_registry.stats()["loaded"])
+metrics.REGISTRY.gauge("rag_ready", "1 once the index is loaded and the models are warmed up.",
+                       lambda: 1 if lifecycle.ready else 0)
+metrics.REGISTRY.gauge("rag_wal_docs_since_snapshot", "Documents added since the last snapshot.",
+                       lambda: rag_instance.persistence_stats()["docs_since_snapshot"] if rag_instance else None)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.before_request
+def require_ready():
+    """確保啟動流程已開始；索引與模型就緒前，需要它們的路由回 503"""
+    lifecycle.start()
+    if request.endpoint in READY_ENDPOINTS and not lifecycle.ready:
+        status = lifecycle.status()
+        return jsonify({
+            "success": False,
+            "error": "RAG系統尚未就緒",
+            "state": status["state"],
+            "detail": status["error"]
+        }), 503, {"Retry-After": "5"}
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """存活檢查：進程可以回應且啟動沒有失敗"""
+    status = lifecycle.status()
+    body = {"status": "alive" if lifecycle.alive else "failed", "state": status["state"], "error": status["error"]}
+    return jsonify(body), 200 if lifecycle.alive else 503
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """就緒檢查：索引已載入且暖機完成時回 200，負載平衡器這時才送流量"""
+    status = lifecycle.status()
+    if lifecycle.ready:
+        return jsonify(status)
+    return jsonify(status), 503, {"Retry-After": "5"}
+
+@app.after_request
+def record_request_metrics(response):
+    """以路由模板 (而不是實際路徑) 為標籤，避免標籤數量無限增長"""
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.HTTP_REQUESTS.inc(route, str(response.status_code))
+    start = g.get("request_start")
+    if start is not None:
+        metrics.HTTP_SECONDS.observe(time.perf_counter() - start, route)
+    return response
+
+@app.route("/rag/metrics", methods=["GET"])
+def rag_metrics():
+    """各階段延遲直方圖與計數 (Prometheus 文字格式)"""
+    return Response(metrics.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
+
+def profiles_forbidden():
+    """分析功能未啟用時回傳 404，token 不符時回傳 403；允許讀取時回傳 None"""
+    if not PROFILE_ENABLED:
+        return jsonify({"error": "請求分析未啟用 (RAG_PROFILE_ENABLED=1)"}), 404
+    if authorized(request.headers.get(PROFILE_TOKEN_HEADER)):
+        return None
+    return jsonify({"error": "缺少或錯誤的 X-RAG-Profile-Token"}), 403
+
+@app.route("/rag/profiles", methods=["GET"])
+def rag_profiles():
+    """最近的請求分析結果 (摘要)"""
+    forbidden = profiles_forbidden()
+    if forbidden is not None:
+        return forbidden
+    return jsonify({"profiles": PROFILE_STORE.summaries()})
+
+@app.route("/rag/profiles/<profile_id>", methods=["GET"])
+def rag_profile(profile_id):
+    """單一分析結果；?format=folded 回傳 flamegraph.pl / speedscope 可讀的 folded stacks"""
+    forbidden = profiles_forbidden()
+    if forbidden is not None:
+        return forbidden
+    report = PROFILE_STORE.get(profile_id)
+    if report is None:
+        return jsonify({"error": f"找不到分析結果: {profile_id}"}), 404
+    if request.args.get('format') == 'folded':
+        if 'folded' not in report:
+            return jsonify({"error": "只有 sample 模式有 folded stacks"}), 400
+        return Response(report['folded'] + "\n", mimetype="text/plain")
+    return jsonify(report)
+
+def parse_retrieval_options(data):
+    """
+    解析 /rag/search 的混合檢索參數，回傳 (參數, 錯誤訊息)
+    weights: [向量權重, 關鍵詞權重]；vector_k / keyword_k: 各自的檢索深度
+    """
+    options = {}
+    if data.get('weights') is not None:
+        weights = data['weights']
+        if (not isinstance(weights, list) or len(weights) != 2
+                or not all(isinstance(w, (int, float)) and not isinstance(w, bool) and w >= 0 for w in weights)
+                or not any(weights)):
+            return None, "'weights' 必須是兩個非負數 [向量, 關鍵詞]，且不能都是 0"
+        options['weights'] = [float(w) for w in weights]
+    for name in ('vector_k', 'keyword_k'):
+        if data.get(name) is not None:
+            value = data[name]
+            if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value <= HYBRID_MAX_K:
+                return None, f"'{name}' 必須是 0 到 {HYBRID_MAX_K} 的整數"
+            options[name] = value
+    return options, None
+
+def load_rag() -> ImprovedRAG:
+    """建立RAG系統：嘗試載入已存在的索引，如果失敗則重新建立"""
     texts = [
         "LangChain 是一個強大的框架，用來建構 LLM 應用。",
         "FAISS 是由 Facebook AI 提供的向量檢索資料庫。",
@@ -25,16 +162,35 @@ def initialize_rag():
         "自然語言處理幫助電腦理解人類語言。"
     ]
     
-    rag_instance = ImprovedRAG(use_openai=False)
+    rag = ImprovedRAG(use_openai=False)
     
-    # 嘗試載入已存在的索引，如果失敗則重新建立
-    if not rag_instance.load_index():
+    if not rag.load_index():
         print("建立新的RAG索引...")
-        rag_instance.setup_documents(texts)
-        rag_instance.save_index()
+        rag.setup_documents(texts)
+        rag.save_index()
         print("RAG索引建立完成！")
     else:
         print("載入已存在的RAG索引！")
+    return rag
+
+def install_rag(rag: ImprovedRAG):
+    """使用外部建立好的RAG實例 (例如壓力測試)，並視為已就緒"""
+    lifecycle.install(rag)
+
+def _set_rag_instance(rag: ImprovedRAG):
+    global rag_instance
+    rag_instance = rag
+    index_registry.pin(DEFAULT_INDEX, rag, rag.index_path)
+
+# 其他具名索引 (見 index_registry.py) 第一次使用時載入，共用預設實例的 embedding 與 LLM
+index_registry = IndexRegistry(lambda: ImprovedRAG(shared=rag_instance))
+
+# 啟動流程: 背景載入索引 -> 暖機 -> 就緒 (見 lifecycle.py)
+lifecycle = ServiceLifecycle(load_rag, warm_up=lambda rag: rag.warm_up(), on_loaded=_set_rag_instance)
+
+def initialize_rag():
+    """同步初始化RAG系統並暖機 (腳本使用；伺服器由 lifecycle 在背景執行)"""
+    lifecycle.run()
 
 
 # 原有的API
@@ -47,6 +203,62 @@ def echo():
     data = request.get_json()
     return jsonify({"you_sent": data})
 
+def wants_event_stream(data) -> bool:
+    """請求參數 stream=true 或 Accept: text/event-stream 時使用 SSE 串流回答"""
+    if data.get('stream') in (True, 1, "1", "true") or request.args.get('stream') in ("1", "true"):
+        return True
+    return "text/event-stream" in request.headers.get("Accept", "")
+
+def format_sse(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def profiling_mode():
+    """X-RAG-Profile 標頭或 ?profile= 主動要求分析 (結果附在回應中)，否則依 RAG_PROFILE_SAMPLE_RATE 隨機取樣"""
+    return choose_mode(request.headers.get(PROFILE_HEADER), request.args.get('profile'),
+                       request.headers.get(PROFILE_TOKEN_HEADER))
+
+def with_profile(payload: dict, profiler, inline: bool) -> Response:
+    """分析結果的 id 放在回應標頭，主動要求時另外附上完整結果"""
+    if profiler is None:
+        return jsonify(payload)
+    if inline:
+        payload["profile"] = profiler.result
+    response = jsonify(payload)
+    response.headers["X-RAG-Profile-Id"] = profiler.id
+    return response
+
+def selected_index():
+    """請求選擇的索引名稱 (JSON 的 index 或 ?index=)，未指定時為預設索引"""
+    data = request.get_json(silent=True) or {}
+    name = data.get('index') if data.get('index') is not None else request.args.get('index')
+    if name is None or name == "":
+        return DEFAULT_INDEX
+    if not isinstance(name, str):
+        raise UnknownIndex(str(name), "索引名稱必須是字串", 400)
+    index_registry.check(name)
+    return name
+
+def stream_answer_response(question: str, profile_mode=None, profile_inline=False,
+                           index_name: str = DEFAULT_INDEX) -> Response:
+    """以 Server-Sent Events 串流回答，done 事件附帶首個 token 延遲 (ttft_ms)；分析時最後送出 profile 事件"""
+    def generate():
+        profiler = None
+        try:
+            with index_registry.acquire(index_name) as rag, \
+                    maybe_profile(profile_mode, "/rag/ask (stream)") as profiler:
+                for event in rag.stream_answer(question):
+                    yield format_sse(event["event"], event)
+        except Exception as e:
+            yield format_sse("error", {"success": False, "error": f"處理問題時發生錯誤: {str(e)}"})
+        if profiler is not None and profile_inline and profiler.result is not None:
+            yield format_sse("profile", profiler.result)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # 新的RAG API
 @app.route("/rag/ask", methods=["POST"])
 def rag_ask():
@@ -63,19 +275,31 @@ def rag_ask():
         if not question:
             return jsonify({"error": "問題不能為空"}), 400
         
+        profile_mode, profile_inline = profiling_mode()
+        index_name = selected_index()
+        
+        # SSE 模式：逐一送出 LLM token
+        if wants_event_stream(data):
+            return stream_answer_response(question, profile_mode, profile_inline, index_name)
+        
         # 使用RAG系統回答問題
-        result = rag_instance.answer_question(question)
+        with index_registry.acquire(index_name) as rag, maybe_profile(profile_mode, "/rag/ask") as profiler:
+            result = rag.answer_question(question)
         
-        return jsonify({
+        return with_profile({
             "success": True,
             "timestamp": datetime.now().isoformat(),
+            "index": index_name,
             "question": result['question'],
             "processed_question": result['processed_question'],
             "answer": result['answer'],
+            "cache_hit": result.get('cache_hit', False),
             "source_count": len(result['source_documents']),
             "sources": [doc.page_content for doc in result['source_documents'][:3]]
-        })
+        }, profiler, profile_inline)
         
+    except UnknownIndex as e:
+        return jsonify(e.to_dict()), e.status_code
     except Exception as e:
         return jsonify({
             "success": False,
@@ -95,9 +319,16 @@ def rag_search():
         
         query = data['query'].strip()
         top_k = data.get('top_k', 5)
+        options, error = parse_retrieval_options(data)
+        if error:
+            return jsonify({"error": error}), 400
         
-        # 使用重新排序的搜索
-        result = rag_instance.query_with_rerank(query, top_k)
+        # 使用重新排序的搜索 (可逐次指定混合檢索的權重與深度)
+        profile_mode, profile_inline = profiling_mode()
+        index_name = selected_index()
+        with index_registry.acquire(index_name) as rag, maybe_profile(profile_mode, "/rag/search") as profiler:
+            result = rag.query_with_rerank(query, top_k, **options)
+            retriever = rag.hybrid_retriever
         
         documents = []
         for doc in result['documents']:
@@ -107,15 +338,23 @@ def rag_search():
                 "length": len(doc.page_content)
             })
         
-        return jsonify({
+        return with_profile({
             "success": True,
             "timestamp": datetime.now().isoformat(),
+            "index": index_name,
             "query": result['original_query'],
             "processed_query": result['processed_query'],
             "document_count": len(documents),
-            "documents": documents
-        })
+            "documents": documents,
+            "retrieval": {
+                "weights": options.get('weights', list(retriever.weights)),
+                "vector_k": options.get('vector_k', retriever.vector_k),
+                "keyword_k": options.get('keyword_k', retriever.keyword_k)
+            }
+        }, profiler, profile_inline)
         
+    except UnknownIndex as e:
+        return jsonify(e.to_dict()), e.status_code
     except Exception as e:
         return jsonify({
             "success": False,
@@ -129,18 +368,35 @@ def rag_status():
         if rag_instance is None:
             return jsonify({
                 "status": "not_initialized",
-                "message": "RAG系統尚未初始化"
+                "message": "RAG系統尚未初始化",
+                "lifecycle": lifecycle.status()
             })
         
         # 獲取向量資料庫資訊
+        stats = rag_instance.stream_stats
         vector_count = rag_instance.vector_db.index.ntotal if rag_instance.vector_db else 0
         
         return jsonify({
-            "status": "ready",
-            "message": "RAG系統已準備就緒",
+            "status": "ready" if lifecycle.ready else lifecycle.state,
+            "message": "RAG系統已準備就緒" if lifecycle.ready else "RAG系統暖機中",
+            "lifecycle": lifecycle.status(),
             "vector_count": vector_count,
             "embedding_model": "llama3.2:latest" if not rag_instance.use_openai else "text-embedding-3-small",
-            "llm_model": "llama3.2:latest" if not rag_instance.use_openai else "gpt-4o-mini"
+            "llm_model": "llama3.2:latest" if not rag_instance.use_openai else "gpt-4o-mini",
+            "embedding_cache": rag_instance.cached_embeddings.cache_stats() if rag_instance.cached_embeddings else None,
+            "query_batching": rag_instance.embeddings.stats(),
+            "answer_cache": rag_instance.answer_cache.stats(),
+            "worker_pool": rag_pool.stats(),
+            "persistence": rag_instance.persistence_stats(),
+            "concurrency": rag_instance.concurrency_stats(),
+            "query_normalizer": rag_instance.query_normalizer.stats(),
+            "parent_documents": rag_instance.parents.stats() if rag_instance.parents is not None else None,
+            "index_registry": index_registry.stats(),
+            "streaming": {
+                "requests": stats["requests"],
+                "avg_ttft_ms": stats["total_ttft_ms"] / stats["requests"] if stats["requests"] else None,
+                "last_ttft_ms": stats["last_ttft_ms"]
+            }
         })
         
     except Exception as e:
@@ -149,6 +405,11 @@ def rag_status():
             "error": f"獲取狀態時發生錯誤: {str(e)}"
         })
 
+@app.route("/rag/indexes", methods=["GET"])
+def rag_indexes():
+    """可以使用的索引名稱與目前常駐的索引 (大小、使用次數、閒置時間)"""
+    return jsonify({"indexes": index_registry.names(), "registry": index_registry.stats()})
+
 @app.route("/rag/add_document", methods=["POST"])
 def add_document():
     """添加新文檔到RAG系統"""
@@ -164,26 +425,13 @@ def add_document():
         if not content:
             return jsonify({"error": "文檔內容不能為空"}), 400
         
-        # 將新文檔添加到現有的向量資料庫
-        from langchain.docstore.document import Document
-        new_doc = Document(
-            page_content=content,
-            metadata={
-                "index": rag_instance.vector_db.index.ntotal,
-                "type": "user_added",
-                "timestamp": datetime.now().isoformat()
-            }
-        )
-        
-        # 添加到向量資料庫
-        rag_instance.vector_db.add_documents([new_doc])
-        
-        # 保存更新的索引
-        rag_instance.save_index()
+        # 切塊後添加到向量資料庫與關鍵詞索引 (寫入預寫日誌，不重寫整個索引)
+        stats = rag_instance.ingest_documents([{"content": content}])
         
         return jsonify({
             "success": True,
             "message": "文檔已成功添加到RAG系統",
+            "chunks": stats["chunks"],
             "document_count": rag_instance.vector_db.index.ntotal
         })
         
@@ -193,6 +441,57 @@ def add_document():
             "error": f"添加文檔時發生錯誤: {str(e)}"
         }), 500
 
+@app.route("/rag/add_documents", methods=["POST"])
+def add_documents():
+    """批次添加文檔：切塊、批次並行 embedding、整批寫一筆預寫日誌"""
+    try:
+        data = request.get_json()
+        if not data or not isinstance(data.get('documents'), list) or not data['documents']:
+            return jsonify({
+                "error": "請提供非空的 'documents' 列表",
+                "example": {"documents": ["新的知識內容", {"content": "長文本...", "metadata": {"source": "wiki"}}]}
+            }), 400
+        
+        if len(data['documents']) > INGEST_MAX_DOCUMENTS:
+            return jsonify({"error": f"單次最多 {INGEST_MAX_DOCUMENTS} 份文檔"}), 413
+        
+        batch_size = data.get('batch_size', INGEST_BATCH_SIZE)
+        if isinstance(batch_size, str) and batch_size.strip().isdigit():
+            batch_size = int(batch_size)
+        if not isinstance(batch_size, int) or isinstance(batch_size, bool) or batch_size <= 0:
+            return jsonify({"error": "'batch_size' 必須是正整數"}), 400
+        
+        documents = []
+        for item in data['documents']:
+            if isinstance(item, str):
+                item = {"content": item}
+            if not isinstance(item, dict) or not isinstance(item.get('content'), str):
+                return jsonify({"error": "每份文檔必須是字串或包含 'content' 的物件"}), 400
+            if not item['content'].strip():
+                continue
+            documents.append({"content": item['content'].strip(), "metadata": item.get('metadata') or {}})
+        
+        if not documents:
+            return jsonify({"error": "文檔內容不能為空"}), 400
+        
+        stats = rag_instance.ingest_documents(
+            documents,
+            batch_size=batch_size
+        )
+        
+        return jsonify({
+            "success": True,
+            "timestamp": datetime.now().isoformat(),
+            "document_count": rag_instance.vector_db.index.ntotal,
+            **stats
+        })
+        
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": f"批次添加文檔時發生錯誤: {str(e)}"
+        }), 500
+
 @app.route("/", methods=["GET"])
 def home():
     """主頁面，提供API文檔"""
@@ -215,12 +514,18 @@ def home():
             <h3><span class="method">POST</span> /rag/ask</h3>
             <p>使用RAG系統回答問題</p>
             <code>{"question": "Kevin Sin是誰？"}</code>
+            <p>加上 <code>"stream": true</code> 或 <code>Accept: text/event-stream</code> 以 SSE 逐字串流回答</p>
         </div>
         
         <div class="endpoint">
             <h3><span class="method">POST</span> /rag/search</h3>
-            <p>向量相似度搜索</p>
-            <code>{"query": "PM", "top_k": 5}</code>
+            <p>混合搜索 (向量 + 關鍵詞並行，加權 RRF 合併)</p>
+            <code>{"query": "PM", "top_k": 5, "weights": [0.7, 0.3], "vector_k": 5, "keyword_k": 3}</code>
+        </div>
+        
+        <div class="endpoint">
+            <h3><span class="method">GET</span> /rag/indexes</h3>
+            <p>可用的具名索引與常駐狀態；/rag/ask 與 /rag/search 可帶 "index": "名稱" 選擇知識庫 (RAG_INDEX_ROOT/名稱)，第一次使用時載入，已載入索引的目錄大小超過 RAG_INDEX_DISK_BUDGET_MB 時淘汰最久沒用的索引</p>
         </div>
         
         <div class="endpoint">
@@ -228,12 +533,33 @@ def home():
             <p>獲取RAG系統狀態</p>
         </div>
         
+        <div class="endpoint">
+            <h3><span class="method">GET</span> /rag/metrics</h3>
+            <p>各階段延遲直方圖與計數 (Prometheus 文字格式)</p>
+        </div>
+
+        <div class="endpoint">
+            <h3><span class="method">GET</span> /healthz 與 /readyz</h3>
+            <p>存活檢查 (啟動失敗時 503) 與就緒檢查 (索引載入且暖機完成前 503)；就緒前 /rag/ask、/rag/search 與新增文檔回 503</p>
+        </div>
+
+        <div class="endpoint">
+            <h3><span class="method">GET</span> /rag/profiles</h3>
+            <p>請求分析結果 (需設定 RAG_PROFILE_ENABLED=1；設定 RAG_PROFILE_TOKEN 時要帶上 X-RAG-Profile-Token 標頭)：/rag/ask 與 /rag/search 帶上標頭 X-RAG-Profile: 1 (或 cprofile) 或 ?profile=1 時，回應附帶階段分解與 folded stacks；/rag/profiles/&lt;id&gt;?format=folded 可直接畫火焰圖</p>
+        </div>
+        
         <div class="endpoint">
             <h3><span class="method">POST</span> /rag/add_document</h3>
             <p>添加新文檔到知識庫</p>
             <code>{"content": "新的知識內容"}</code>
         </div>
         
+        <div class="endpoint">
+            <h3><span class="method">POST</span> /rag/add_documents</h3>
+            <p>批次添加文檔 (自動切塊、並行 embedding，回傳每秒處理文檔數)</p>
+            <code>{"documents": ["文本一", {"content": "長文本...", "metadata": {"source": "wiki"}}]}</code>
+        </div>
+        
         <h2>測試範例</h2>
         <p>您可以使用以下curl命令測試API：</p>
         <pre>
@@ -246,7 +572,21 @@ curl -X POST http://localhost:5000/rag/ask \
     """
     return render_template_string(html_template)
 
+# WSGI/ASGI 伺服器匯入模組時在背景開始啟動流程，直接執行此文件時由下面決定；
+# multiprocessing 的 spawn / forkserver 子進程以 __mp_main__ 重新匯入主程式，不啟動
+if AUTOSTART and __name__ not in ("__main__", "__mp_main__"):
+    lifecycle.start()
+
 if __name__ == "__main__":
-    # 手動初始化RAG（用於直接運行此文件）
-    initialize_rag()
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # 生產模式: python improved_flask_api.py --production 或 RAG_SERVE_MODE=production
+    production = "--production" in sys.argv or os.getenv("RAG_SERVE_MODE") == "production"
+    
+    # 背景載入索引與暖機，伺服器先開始回應 /healthz 與 /readyz
+    # (debug 模式的重新載入器父進程不處理請求，只在子進程啟動)
+    if production or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        lifecycle.start()
+    
+    if production:
+        serve_production(app, rag_pool, host='0.0.0.0', port=5000)
+    else:
+        app.run(debug=True, host='0.0.0.0', port=5000)
@@ -1,130 +1,191 @@
 import os
-import re
-from typing import List, Dict, Any
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+import time
+import uuid
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterator, Optional, Sequence
+import numpy as np
 from langchain_community.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.prompts import ChatPromptTemplate
-from langchain.docstore.document import Document
-from langchain.retrievers import EnsembleRetriever
-from langchain_community.retrievers import BM25Retriever
+from langchain_core.documents import Document
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate, format_document
 from langchain_community.vectorstores.utils import DistanceStrategy
 
-# 使用新的 ollama 包
-try:
-    from langchain_ollama import OllamaEmbeddings, ChatOllama
-except ImportError:
-    from langchain_community.embeddings import OllamaEmbeddings
-    from langchain_community.chat_models import ChatOllama
-
 from dotenv import load_dotenv
+from embedding_cache import CachedEmbeddings, get_default_cache
+from embedding_batcher import MicroBatchEmbeddings, DEFAULT_WINDOW_MS, DEFAULT_MAX_BATCH_SIZE
+from keyword_index import KeywordIndex
+from answer_cache import AnswerCache
+from rw_lock import RWLock
+from index_storage import (
+    load_vector_store, make_writable, LegacyPickleIndexError, LEGACY_INDEX_CONFIG,
+    VectorStoreSnapshot, write_snapshot, reattach_docstore, ColumnarDocstore
+)
+from write_ahead_log import (
+    WriteAheadLog, wal_dir_for, encode_vector, decode_vector,
+    save_snapshot_manifest, load_snapshot_manifest
+)
+from vector_index import build_vector_store, build_vector_store_from_vectors, apply_search_params, resolve_params
+from variant_rules import VariantEngine, IMPROVED_RAG_RULES
+from query_normalizer import QueryNormalizer
+from reranker import VectorReranker
+from hybrid_retriever import HybridRetriever
+from parent_documents import MULTI_VECTOR, ParentStore, build_parent_documents, collapse_near_duplicates
+from metrics import timed, observe, event
+from providers import create_embeddings, create_chat_model, provider_name
 load_dotenv()
 
+# 與 create_stuff_documents_chain 相同的 context 格式 (不在啟動時匯入 langchain.chains)
+DEFAULT_DOCUMENT_PROMPT = PromptTemplate.from_template("{page_content}")
+DEFAULT_DOCUMENT_SEPARATOR = "\n\n"
+
+# 批次匯入: 每次 embedding 請求的文本數與同時進行的請求數
+INGEST_BATCH_SIZE = int(os.getenv("RAG_INGEST_BATCH_SIZE", "64"))
+INGEST_WORKERS = int(os.getenv("RAG_INGEST_WORKERS", "4"))
+
+# 背景快照: 累積新增文檔數達到門檻，或距離上次快照超過間隔 (秒) 且有變更時寫出
+SNAPSHOT_EVERY_DOCS = int(os.getenv("RAG_SNAPSHOT_EVERY_DOCS", "1000"))
+SNAPSHOT_INTERVAL_SECONDS = float(os.getenv("RAG_SNAPSHOT_INTERVAL", "300"))
+
+# 向量索引類型 (見 vector_index.py)；量化索引 (sq_fp16 / sq_int8 / ivf_pq) 以 k * RAG_RESCORE_FACTOR 個候選精確重算，0 表示不重算
+DEFAULT_INDEX_TYPE = os.getenv("RAG_INDEX_TYPE", "flat")
+DEFAULT_RESCORE_FACTOR = int(os.getenv("RAG_RESCORE_FACTOR", "0"))
+
+# 暖機: 以這個查詢重複跑完整路徑，直到某輪耗時不超過前一輪的 (1 + 容許比例) 倍或達到輪數上限
+WARMUP_QUERY = os.getenv("RAG_WARMUP_QUERY", "Kevin Sin是誰？")
+WARMUP_MAX_ROUNDS = int(os.getenv("RAG_WARMUP_MAX_ROUNDS", "5"))
+WARMUP_TOLERANCE = float(os.getenv("RAG_WARMUP_TOLERANCE", "0.5"))
+
 
 class ImprovedRAG:
-    def __init__(self, use_openai=False):
+    def __init__(self, use_openai=False, batch_window_ms=None, max_batch_size=None,
+                 embeddings=None, llm=None, use_embedding_cache=True,
+                 index_type=None, index_params=None, multi_vector=None, shared=None):
+        """
+        embeddings / llm 可傳入自訂的 LangChain 物件 (例如 fake_backends 的離線替身)，
+        未傳入時依 use_openai 使用 OpenAI 或 Ollama
+        index_type 可選 flat / ivf_flat / ivf_pq / hnsw / sq_fp16 / sq_int8 (預設讀取 RAG_INDEX_TYPE)，
+        index_params 覆寫 vector_index 的預設參數，例如 {"rescore_factor": 4} 以 float32 向量精確重算前 4k 個候選
+        multi_vector: 變體只作為指向原句 (父文檔) 的向量，預設讀取 RAG_MULTI_VECTOR
+        shared: 另一個 ImprovedRAG，共用它的 embedding (含批次與快取)、LLM 與查詢正規化 (多索引登錄表)
+        """
         self.use_openai = use_openai
+        self.index_type = index_type or DEFAULT_INDEX_TYPE
+        self.multi_vector = MULTI_VECTOR if multi_vector is None else multi_vector
+        self.index_params = resolve_params({"rescore_factor": DEFAULT_RESCORE_FACTOR, **(index_params or {})})
+        self.index_config = None
         
-        # 初始化 embeddings 和 LLM
-        if use_openai:
-            self.embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
-            self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+        if shared is not None:
+            self.use_openai = shared.use_openai
+            self.provider = shared.provider
+            self.embedding_model = shared.embedding_model
+            self.llm = shared.llm
+            self.base_embeddings = shared.base_embeddings
+            self.cached_embeddings = shared.cached_embeddings
+            self.embeddings = shared.embeddings
         else:
-            self.embeddings = OllamaEmbeddings(model="llama3.2:latest")
-            self.llm = ChatOllama(model="llama3.2:latest")
-        
-        # 改進的文本分割器
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=300,
-            chunk_overlap=50,
-            separators=["\n\n", "\n", "。", "，", " ", ""]
-        )
+            # 初始化 embeddings 和 LLM (只匯入選用的後端，見 providers.py)
+            self.provider = provider_name(use_openai)
+            if embeddings is not None:
+                base_embeddings = embeddings
+                self.embedding_model = getattr(embeddings, "model", type(embeddings).__name__)
+                cache_namespace = "custom"
+            else:
+                base_embeddings = create_embeddings(self.provider)
+                self.embedding_model = getattr(base_embeddings, "model", type(base_embeddings).__name__)
+                cache_namespace = self.provider
+            self.llm = llm or create_chat_model(self.provider)
+            # 暖機時直接呼叫模型 (不經過快取) 確保模型已載入記憶體
+            self.base_embeddings = base_embeddings
+
+            # 所有建立索引的路徑共用持久化 embedding 快取，只為新文本呼叫模型
+            if use_embedding_cache:
+                self.cached_embeddings = CachedEmbeddings(
+                    base_embeddings,
+                    get_default_cache(),
+                    model_name=f"{cache_namespace}:{self.embedding_model}"
+                )
+                document_embeddings = self.cached_embeddings
+            else:
+                self.cached_embeddings = None
+                document_embeddings = base_embeddings
+
+            # 並發查詢的 embedding 在短窗口內合併成一次批次呼叫；
+            # 查詢不經過持久化快取 (重複的問題由批次器的最近查詢表處理)，快取容量只留給語料向量
+            self.embeddings = MicroBatchEmbeddings(
+                document_embeddings,
+                window_ms=DEFAULT_WINDOW_MS if batch_window_ms is None else batch_window_ms,
+                max_batch_size=max_batch_size or DEFAULT_MAX_BATCH_SIZE,
+                query_underlying=base_embeddings
+            )
+
+        # 改進的文本分割器 (只有匯入文檔時才需要，第一次使用時建立)
+        self._text_splitter = None
         
         self.vector_db = None
-        self.bm25_retriever = None
-        self.ensemble_retriever = None
+        self.keyword_index = None
+        # 多向量模式的父文檔 (見 parent_documents.py)
+        self.parents = None
+        self.hybrid_retriever = None
+        self.answer_prompt = None
+        self.answer_chain = None
+        # 只負責生成 (prompt 已組合好)，分開量測 prompt 組合與 LLM 時間
+        self.generation_chain = self.llm | StrOutputParser()
         
-    def enhance_text_variants(self, texts: List[str]) -> List[str]:
-        """增強文本變體生成，包含更多語言模式"""
-        variants = []
+        # 語意答案快取 (知識庫變更時自動失效)
+        self.answer_cache = AnswerCache()
         
-        for text in texts:
-            text = text.strip("。，；,.;!?！?")
-            variants.append(text)  # 原句
-            
-            # 處理 "是" 句型
-            if "是" in text:
-                parts = text.split("是", 1)
-                if len(parts) == 2:
-                    left, right = parts[0].strip(), parts[1].strip()
-                    
-                    # 倒裝句
-                    variants.append(f"{right}是{left}。")
-                    
-                    # 問句變體
-                    if left and right:
-                        variants.extend([
-                            f"{left}是誰？",
-                            f"{left}是什麼？",
-                            f"誰是{right}？",
-                            f"什麼是{left}？",
-                            f"{right}的身份是什麼？",
-                            f"{left}的職位是什麼？"
-                        ])
-            
-            # 處理職位/身份句型
-            position_patterns = ["經理", "PM", "總監", "主管", "負責人", "工程師"]
-            for pattern in position_patterns:
-                if pattern in text:
-                    # 提取人名和職位
-                    match = re.search(rf"(\w+).*?{pattern}", text)
-                    if match:
-                        name = match.group(1)
-                        variants.extend([
-                            f"{name}的職位是什麼？",
-                            f"誰是{pattern}？",
-                            f"{pattern}是誰？"
-                        ])
-            
-            # 處理技術/工具句型
-            tech_keywords = ["框架", "資料庫", "工具", "技術", "平台"]
-            for keyword in tech_keywords:
-                if keyword in text:
-                    variants.extend([
-                        f"什麼是{keyword}？",
-                        f"如何使用{keyword}？",
-                        f"{keyword}的用途是什麼？"
-                    ])
-        
-        return list(set(variants))  # 去重
-    
-    def preprocess_query(self, query: str) -> str:
-        """預處理查詢，提升搜索準確性"""
-        # 去除多餘空格和標點
-        query = re.sub(r'\s+', ' ', query.strip())
-        
-        # 同義詞替換
-        synonyms = {
-            "總經理": ["總經理", "總裁", "CEO", "執行長"],
-            "PM": ["PM", "專案經理", "項目經理", "產品經理"],
-            "是誰": ["是誰", "是什麼人", "的身份"],
-            "做什麼": ["做什麼", "負責什麼", "的工作"],
-        }
+        # 串流回答的首個 token 延遲 (TTFT) 統計
+        self.stream_stats = {"requests": 0, "total_ttft_ms": 0.0, "last_ttft_ms": None}
         
-        for key, values in synonyms.items():
-            for value in values:
-                if value in query:
-                    query = query.replace(value, key)
-                    break
+        # 持久化: 新增文檔寫預寫日誌，完整索引由背景快照寫出
+        self.index_path = None
+        self.wal = None
+        # 讀寫鎖: 檢索可並行，新增文檔、快照替換文檔庫等寫入互斥，
+        # 讀者在持有讀鎖期間看到的 FAISS、docstore 與關鍵詞索引是同一個版本
+        self._lock = RWLock()
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_event = threading.Event()
+        self._snapshot_thread = None
+        self._closed = False
+        self._docs_since_snapshot = 0
+        self.snapshot_stats = {"snapshots": 0, "last_snapshot_ms": None, "last_snapshot_at": None, "last_error": None}
+        # 文本變體規則只編譯一次
+        self.variant_engine = VariantEngine(IMPROVED_RAG_RULES)
+        # 查詢同義詞字典 (RAG_SYNONYMS_FILE)，編譯一次
+        self.query_normalizer = shared.query_normalizer if shared is not None else QueryNormalizer.from_env()
+        self.reranker = VectorReranker()
+
+    @property
+    def text_splitter(self):
+        if self._text_splitter is None:
+            from langchain_text_splitters import RecursiveCharacterTextSplitter
+            self._text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=300,
+                chunk_overlap=50,
+                separators=["\n\n", "\n", "。", "，", " ", ""]
+            )
+        return self._text_splitter
         
-        return query
+    def enhance_text_variants(self, texts: List[str]) -> List[str]:
+        """增強文本變體生成，包含更多語言模式 (規則見 variant_rules.IMPROVED_RAG_RULES)"""
+        return self.variant_engine.variants(texts)
+    
+    def preprocess_query(self, query: str) -> str:
+        """預處理查詢，提升搜索準確性 (合併空白、同義詞替換，結果有 LRU 快取)"""
+        with timed("preprocess"):
+            return self.query_normalizer.normalize(query)
     
     def setup_documents(self, texts: List[str]):
         """建立文檔集合，包含多重檢索策略"""
+        if self.multi_vector:
+            vector_db, index_config, keyword_index, parents = self._build_parent_documents(texts)
+            self._install(vector_db, index_config, keyword_index, parents)
+            return
+        
         # 生成增強文本變體
-        enhanced_texts = self.enhance_text_variants(texts)
+        enhanced_texts = self.variant_engine.iter_variants(texts)
         
         # 創建文檔
         docs = [
@@ -133,40 +194,191 @@ class ImprovedRAG:
                 metadata={
                     "index": i, 
                     "length": len(text),
-                    "type": "enhanced" if i >= len(texts) else "original"
+                    "type": "original" if is_original else "enhanced"
                 }
             )
-            for i, text in enumerate(enhanced_texts)
+            for i, (text, is_original) in enumerate(enhanced_texts)
         ]
         
-        # 建立向量資料庫 (使用餘弦相似度)
-        self.vector_db = FAISS.from_documents(
-            docs, 
-            self.embeddings,
-            distance_strategy=DistanceStrategy.COSINE
-        )
+        vector_db, index_config = self._build_vector_store(docs)
         
-        # 建立 BM25 檢索器 (關鍵詞匹配)
-        self.bm25_retriever = BM25Retriever.from_documents(docs)
-        self.bm25_retriever.k = 3
+        # 建立 BM25 關鍵詞索引 (文檔位置與向量位置對應)
+        keyword_index = KeywordIndex()
+        keyword_index.add_texts([doc.page_content for doc in docs])
+        self._install(vector_db, index_config, keyword_index, None)
+    
+    def _build_vector_store(self, docs: List[Document], vectors=None):
+        """建立向量資料庫，回傳 (向量庫, 索引參數)；vectors 為已計算的向量 (省略時由 embeddings 計算)"""
+        if self.index_type == "flat":
+            # 建立向量資料庫 (使用餘弦相似度)
+            if vectors is None:
+                vector_db = FAISS.from_documents(
+                    docs, 
+                    self.embeddings,
+                    distance_strategy=DistanceStrategy.COSINE
+                )
+            else:
+                vector_db = FAISS.from_embeddings(
+                    [(doc.page_content, vector) for doc, vector in zip(docs, vectors)],
+                    self.embeddings,
+                    metadatas=[doc.metadata for doc in docs],
+                    distance_strategy=DistanceStrategy.COSINE
+                )
+            return vector_db, {"index_type": "flat", "distance_strategy": "COSINE", "normalize_L2": False}
         
-        # 建立向量檢索器
-        vector_retriever = self.vector_db.as_retriever(
-            search_type="similarity_score_threshold",
-            search_kwargs={
-                "k": 5,
-                "score_threshold": 0.1  # 降低閾值以獲得更多結果
-            }
-        )
+        # IVF / PQ / HNSW：在樣本上訓練後加入所有向量
+        if vectors is None:
+            vector_db, params = build_vector_store(docs, self.embeddings, self.index_type, self.index_params)
+        else:
+            vector_db, params = build_vector_store_from_vectors(
+                docs, vectors, self.embeddings, self.index_type, self.index_params
+            )
+        return vector_db, {**params, "distance_strategy": "EUCLIDEAN_DISTANCE", "normalize_L2": True}
+    
+    def _build_parent_documents(self, texts: List[str]):
+        """
+        多向量模式: 每句原文一份父文檔，變體嵌入後合併組內幾乎相同的向量，
+        向量庫只存空內容的子文檔，關鍵詞索引以變體文本建立 (位置與向量對應)
+        """
+        parents, variant_texts, sizes = build_parent_documents(list(self.variant_engine.iter_groups(texts)))
+        vectors = np.asarray(self.embed_texts(variant_texts), dtype=np.float32)
+        keep = collapse_near_duplicates(vectors, sizes)
+        rows = np.repeat(np.arange(len(parents), dtype=np.int32), sizes)[keep]
+        
+        docs = [Document(page_content="", metadata={"parent": row}) for row in rows.tolist()]
+        vector_db, index_config = self._build_vector_store(docs, vectors[keep])
+        index_config["multi_vector"] = True
         
-        # 組合檢索器 (混合語義和關鍵詞搜索)
-        self.ensemble_retriever = EnsembleRetriever(
-            retrievers=[vector_retriever, self.bm25_retriever],
-            weights=[0.7, 0.3]  # 70% 語義搜索，30% 關鍵詞搜索
+        keyword_index = KeywordIndex()
+        keyword_index.add_texts([text for text, kept in zip(variant_texts, keep) if kept])
+        print(f"🧩 多向量索引: {len(parents)} 份父文檔, {len(variant_texts)} 個變體合併為 {len(rows)} 個向量")
+        return vector_db, index_config, keyword_index, ParentStore(parents, rows)
+    
+    def _install(self, vector_db, index_config: Dict[str, Any], keyword_index: KeywordIndex,
+                 parents: Optional[ParentStore]):
+        # 在鎖外建好後一次替換，檢索中的請求不會看到建到一半的索引
+        with self._lock.write():
+            self.vector_db = vector_db
+            self.index_config = index_config
+            self.keyword_index = keyword_index
+            self.parents = parents
+            self._build_retrievers()
+        self.answer_cache.invalidate()
+    
+    def _build_retrievers(self):
+        """以現有的向量資料庫與關鍵詞索引組合混合檢索器 (向量與 BM25 並行搜索，加權 RRF 合併)"""
+        self.hybrid_retriever = HybridRetriever(
+            vector_db=self.vector_db,
+            keyword_index=self.keyword_index,
+            embeddings=self.embeddings,
+            parents=self.parents,
         )
     
-    def create_advanced_chain(self):
-        """創建進階問答鏈"""
+    def embed_texts(self, texts: List[str], batch_size: int = INGEST_BATCH_SIZE,
+                    max_workers: int = INGEST_WORKERS) -> List[List[float]]:
+        """把大量文本切成批次，並行送出 embedding 請求，回傳順序與輸入相同"""
+        batch_size = max(1, batch_size)
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        with timed("embed_documents"):
+            if len(batches) <= 1 or max_workers <= 1:
+                return [vector for batch in batches for vector in self.embeddings.embed_documents(batch)]
+            
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest-embed") as executor:
+                results = executor.map(self.embeddings.embed_documents, batches)
+                return [vector for batch_vectors in results for vector in batch_vectors]
+    
+    def _apply_documents(self, docs: List[Document], vectors: List[List[float]], log: bool = True):
+        """在寫入鎖內先寫日誌、再更新向量與關鍵詞索引，回傳日誌序號 (沒有日誌時為 None)"""
+        texts = [doc.page_content for doc in docs]
+        ids = [doc.id or str(uuid.uuid4()) for doc in docs]
+        with self._lock.write():
+            seq = None
+            if log and self.wal is not None:
+                with timed("wal_append"):
+                    seq = self.wal.append({"docs": [
+                        {"id": doc_id, "content": text, "metadata": doc.metadata, "vector": encode_vector(vector)}
+                        for doc_id, text, doc, vector in zip(ids, texts, docs, vectors)
+                    ]})
+            with timed("index_update"):
+                make_writable(self.vector_db)
+                self.vector_db.add_embeddings(
+                    list(zip(texts, vectors)),
+                    metadatas=[doc.metadata for doc in docs],
+                    ids=ids
+                )
+                self.keyword_index.add_texts(texts)
+                if self.parents is not None:
+                    # 新增的文檔各自是自己的父文檔
+                    self.parents.append_self(len(docs))
+            self._docs_since_snapshot += len(docs)
+            snapshot_due = self._docs_since_snapshot >= SNAPSHOT_EVERY_DOCS
+        
+        self.answer_cache.invalidate()
+        if snapshot_due:
+            self._snapshot_event.set()
+        return seq
+    
+    def add_documents(self, docs: List[Document], vectors: List[List[float]] = None):
+        """
+        同時新增文檔到向量資料庫與關鍵詞索引，只切詞新文檔 (vectors 可傳入已計算的向量)
+        有預寫日誌時，回傳前會等到日誌落盤
+        """
+        if vectors is None:
+            vectors = self.embed_texts([doc.page_content for doc in docs])
+        seq = self._apply_documents(docs, vectors)
+        if self.wal is not None:
+            with timed("wal_sync"):
+                self.wal.wait_durable(seq)
+    
+    def ingest_documents(self, documents: List[Dict[str, Any]], batch_size: int = INGEST_BATCH_SIZE,
+                         max_workers: int = INGEST_WORKERS) -> Dict[str, Any]:
+        """
+        批次匯入文檔：用 text_splitter 切塊、批次並行 embedding、一次更新向量與關鍵詞索引，
+        整批寫一筆預寫日誌並等待落盤。documents 為 {"content": ..., "metadata": {...}} 列表
+        """
+        start = time.perf_counter()
+        timestamp = datetime.now().isoformat()
+        
+        chunks = []
+        for doc_number, item in enumerate(documents):
+            metadata = {**(item.get("metadata") or {}), "type": "user_added", "timestamp": timestamp}
+            pieces = self.text_splitter.split_text(item["content"])
+            for chunk_number, piece in enumerate(pieces):
+                chunks.append(Document(
+                    page_content=piece,
+                    metadata={**metadata, "document": doc_number, "chunk": chunk_number, "length": len(piece)}
+                ))
+        chunked = time.perf_counter()
+        
+        vectors = self.embed_texts([doc.page_content for doc in chunks], batch_size, max_workers)
+        embedded = time.perf_counter()
+        
+        seq = self._apply_documents(chunks, vectors) if chunks else None
+        indexed = time.perf_counter()
+        
+        if self.wal is not None:
+            with timed("wal_sync"):
+                self.wal.wait_durable(seq)
+        finished = time.perf_counter()
+        
+        elapsed = finished - start
+        return {
+            "documents": len(documents),
+            "chunks": len(chunks),
+            "elapsed_ms": elapsed * 1000,
+            "chunk_ms": (chunked - start) * 1000,
+            "embed_ms": (embedded - chunked) * 1000,
+            "index_ms": (indexed - embedded) * 1000,
+            "persist_ms": (finished - indexed) * 1000,
+            "docs_per_second": len(documents) / elapsed if elapsed > 0 else 0.0,
+            "chunks_per_second": len(chunks) / elapsed if elapsed > 0 else 0.0,
+        }
+    
+    def create_answer_prompt(self) -> ChatPromptTemplate:
+        """問答的 prompt 模板 (context 為檢索到的文檔)"""
+        if self.answer_prompt is not None:
+            return self.answer_prompt
+
         system_prompt = """
 你是一個專業的AI助手。請根據以下檢索到的上下文資訊來回答問題。
 
@@ -182,52 +394,87 @@ class ImprovedRAG:
 {context}
 """
 
-        prompt = ChatPromptTemplate.from_messages([
+        self.answer_prompt = ChatPromptTemplate.from_messages([
             ("system", system_prompt),
             ("human", "{input}"),
         ])
-        
-        # 建立問答鏈
-        question_answer_chain = create_stuff_documents_chain(self.llm, prompt)
-        qa_chain = create_retrieval_chain(self.ensemble_retriever, question_answer_chain)
+        return self.answer_prompt
+
+    def create_answer_chain(self):
+        """創建只負責生成的問答鏈 (context 由呼叫者傳入，不在鏈內再次檢索)"""
+        if self.answer_chain is None:
+            from langchain.chains.combine_documents import create_stuff_documents_chain
+            self.answer_chain = create_stuff_documents_chain(self.llm, self.create_answer_prompt())
+        return self.answer_chain
+
+    def build_prompt(self, processed_query: str, docs: List[Document]):
+        """組合 LLM 的輸入，context 格式與 create_stuff_documents_chain 相同"""
+        with timed("prompt"):
+            context = DEFAULT_DOCUMENT_SEPARATOR.join(
+                format_document(doc, DEFAULT_DOCUMENT_PROMPT) for doc in docs
+            )
+            return self.create_answer_prompt().invoke({"input": processed_query, "context": context})
+
+    def generate(self, prompt_value) -> str:
+        with timed("llm_total"):
+            return self.generation_chain.invoke(prompt_value)
+
+    def generate_stream(self, prompt_value) -> Iterator[str]:
+        """逐一產生 LLM 輸出，記錄首個 token 與總生成時間"""
+        start = time.perf_counter()
+        first = True
+        with timed("llm_total"):
+            for token in self.generation_chain.stream(prompt_value):
+                if token and first:
+                    observe("llm_ttft", time.perf_counter() - start)
+                    first = False
+                yield token
+
+    def create_advanced_chain(self):
+        """創建進階問答鏈"""
+        from langchain.chains import create_retrieval_chain
+        question_answer_chain = self.create_answer_chain()
+        qa_chain = create_retrieval_chain(self.hybrid_retriever, question_answer_chain)
         
         return qa_chain
+
+    def search_hits(self, processed_query: str, weights: Optional[Sequence[float]] = None,
+                    vector_k: Optional[int] = None, keyword_k: Optional[int] = None):
+        """混合檢索，回傳 (候選文檔, 向量位置)；weights / vector_k / keyword_k 可逐次覆寫預設值"""
+        # 先在鎖外取得查詢向量 (留在最近查詢快取)，持有讀鎖期間只做索引查找
+        with timed("embed_query"):
+            query_vector = self.embeddings.embed_query(processed_query)
+        with self._lock.read():
+            hits = self.hybrid_retriever.search(processed_query, query_vector, weights, vector_k, keyword_k)
+            return self.hybrid_retriever.documents(hits), np.array([position for position, _ in hits], dtype=np.int64)
+
+    def retrieve(self, processed_query: str, weights: Optional[Sequence[float]] = None,
+                 vector_k: Optional[int] = None, keyword_k: Optional[int] = None) -> List[Document]:
+        """使用混合檢索器獲取候選文檔 (每個問題只執行一次)"""
+        return self.search_hits(processed_query, weights, vector_k, keyword_k)[0]
+
+    def rerank(self, candidate_docs: List[Document], processed_query: str,
+               positions: Optional[np.ndarray] = None) -> List[Document]:
+        """
+        重新排序：整批計算向量相似度 (索引中已存的向量)、關鍵詞重疊與原句加分，回傳排序後的全部候選文檔
+        查詢向量在檢索時已經嵌入過，這裡從最近查詢快取取得；positions 為檢索時得到的向量位置 (可省略)
+        """
+        with timed("rerank"):
+            query_vector = self.embeddings.embed_query(processed_query)
+            with self._lock.read():
+                return self.reranker.rerank(
+                    self.vector_db, self.keyword_index, candidate_docs, processed_query, query_vector, positions
+                )
     
-    def query_with_rerank(self, query: str, top_k: int = 3) -> Dict[str, Any]:
-        """使用重新排序的查詢方法"""
+    def query_with_rerank(self, query: str, top_k: int = 3, weights: Optional[Sequence[float]] = None,
+                          vector_k: Optional[int] = None, keyword_k: Optional[int] = None) -> Dict[str, Any]:
+        """使用重新排序的查詢方法 (weights 為 [向量, 關鍵詞] 的 RRF 權重，vector_k / keyword_k 為各自的檢索深度)"""
         # 預處理查詢
         processed_query = self.preprocess_query(query)
         
-        # 使用ensemble retriever獲取候選文檔
-        candidate_docs = self.ensemble_retriever.get_relevant_documents(processed_query)
-        
-        # 簡單的重新排序策略：基於查詢匹配度
-        def score_document(doc, query):
-            content = doc.page_content.lower()
-            query_terms = query.lower().split()
-            score = 0
-            
-            # 完全匹配得分更高
-            if query.lower() in content:
-                score += 10
-            
-            # 關鍵詞匹配
-            for term in query_terms:
-                if term in content:
-                    score += 1
-            
-            # 原始文檔得分更高
-            if doc.metadata.get("type") == "original":
-                score += 2
-                
-            return score
-        
-        # 重新排序
-        scored_docs = [(doc, score_document(doc, processed_query)) for doc in candidate_docs]
-        scored_docs.sort(key=lambda x: x[1], reverse=True)
-        
-        # 取前 top_k 個
-        reranked_docs = [doc for doc, score in scored_docs[:top_k]]
+        # 檢索並重新排序，取前 top_k 個
+        candidate_docs, positions = self.search_hits(processed_query, weights, vector_k, keyword_k)
+        reranked_docs = self.rerank(candidate_docs, processed_query, positions)[:top_k]
         
         return {
             "documents": reranked_docs,
@@ -235,44 +482,378 @@ class ImprovedRAG:
             "original_query": query
         }
     
-    def answer_question(self, query: str) -> Dict[str, Any]:
-        """回答問題的主要方法"""
-        # 創建問答鏈
-        qa_chain = self.create_advanced_chain()
+    def lookup_answer_cache(self, processed_query: str):
+        """
+        查詢答案快取：先完全比對，再以查詢向量做近似比對 (RAG_ANSWER_CACHE_SEMANTIC=1 時)
+        回傳 (快取結果或 None, 查詢向量, 知識庫版本)
+        """
+        generation = self.answer_cache.generation
+        cached = self.answer_cache.get_exact(processed_query)
+        if cached is not None:
+            event("answer_cache_exact_hit")
+            return cached, None, generation
         
+        # 查詢向量會保留在記憶體，接下來的檢索不會再次嵌入
+        with timed("embed_query"):
+            query_vector = self.embeddings.embed_query(processed_query)
+        cached = self.answer_cache.get_similar(processed_query, query_vector)
+        event("answer_cache_similar_hit" if cached is not None else "answer_cache_miss")
+        return cached, query_vector, generation
+    
+    def answer_question(self, query: str, top_k: int = 3, use_cache: bool = True) -> Dict[str, Any]:
+        """
+        回答問題的主要方法
+        檢索只執行一次：重新排序後的候選文檔同時作為 LLM 的 context 與回傳的 reranked_documents
+        相同或近似的問題直接從答案快取回傳
+        """
         # 預處理查詢
         processed_query = self.preprocess_query(query)
         
-        # 執行問答
-        result = qa_chain.invoke({"input": processed_query})
+        if use_cache:
+            cached, query_vector, generation = self.lookup_answer_cache(processed_query)
+            if cached is not None:
+                return {**cached, "question": query, "processed_question": processed_query, "cache_hit": True}
         
-        # 獲取重新排序的文檔用於調試
-        rerank_result = self.query_with_rerank(query)
+        # 單次檢索 + 重新排序
+        candidate_docs, positions = self.search_hits(processed_query)
+        ranked_docs = self.rerank(candidate_docs, processed_query, positions)
         
-        return {
+        # 執行問答 (直接傳入 context，不再於鏈內重新檢索)
+        answer = self.generate(self.build_prompt(processed_query, ranked_docs))
+        
+        result = {
             "question": query,
             "processed_question": processed_query,
-            "answer": result["answer"],
-            "source_documents": result.get("context", []),
-            "reranked_documents": rerank_result["documents"]
+            "answer": answer,
+            "source_documents": ranked_docs,
+            "reranked_documents": ranked_docs[:top_k],
+            "cache_hit": False
         }
+        
+        if use_cache and query_vector is not None:
+            self.answer_cache.put(processed_query, query_vector, result, generation)
+        
+        return result
+    
+    def stream_answer(self, query: str, top_k: int = 3, use_cache: bool = True) -> Iterator[Dict[str, Any]]:
+        """
+        串流回答：先送出來源文檔，再逐一送出 LLM token，最後送出完整答案與延遲指標
+        事件格式: {"event": "sources" | "token" | "done", ...}
+        """
+        start = time.perf_counter()
+        processed_query = self.preprocess_query(query)
+        
+        query_vector = None
+        if use_cache:
+            cached, query_vector, generation = self.lookup_answer_cache(processed_query)
+            if cached is not None:
+                yield {
+                    "event": "sources",
+                    "question": query,
+                    "processed_question": processed_query,
+                    "sources": [doc.page_content for doc in cached["reranked_documents"]]
+                }
+                yield {"event": "token", "token": cached["answer"]}
+                yield {
+                    "event": "done",
+                    "answer": cached["answer"],
+                    "source_count": len(cached["source_documents"]),
+                    "ttft_ms": (time.perf_counter() - start) * 1000,
+                    "total_ms": (time.perf_counter() - start) * 1000,
+                    "cache_hit": True
+                }
+                return
+        
+        candidate_docs, positions = self.search_hits(processed_query)
+        ranked_docs = self.rerank(candidate_docs, processed_query, positions)
+        
+        yield {
+            "event": "sources",
+            "question": query,
+            "processed_question": processed_query,
+            "sources": [doc.page_content for doc in ranked_docs[:top_k]]
+        }
+        
+        ttft_ms = None
+        tokens = []
+        for token in self.generate_stream(self.build_prompt(processed_query, ranked_docs)):
+            if not token:
+                continue
+            if ttft_ms is None:
+                ttft_ms = (time.perf_counter() - start) * 1000
+            tokens.append(token)
+            yield {"event": "token", "token": token}
+        
+        total_ms = (time.perf_counter() - start) * 1000
+        if ttft_ms is not None:
+            self.stream_stats["requests"] += 1
+            self.stream_stats["total_ttft_ms"] += ttft_ms
+            self.stream_stats["last_ttft_ms"] = ttft_ms
+        
+        answer = "".join(tokens)
+        if use_cache and query_vector is not None:
+            self.answer_cache.put(processed_query, query_vector, {
+                "question": query,
+                "processed_question": processed_query,
+                "answer": answer,
+                "source_documents": ranked_docs,
+                "reranked_documents": ranked_docs[:top_k],
+                "cache_hit": False
+            }, generation)
+        
+        yield {
+            "event": "done",
+            "answer": answer,
+            "source_count": len(ranked_docs),
+            "ttft_ms": ttft_ms,
+            "total_ms": total_ms,
+            "cache_hit": False
+        }
+
+    def warm_up(self, query: str = WARMUP_QUERY, max_rounds: int = WARMUP_MAX_ROUNDS,
+                tolerance: float = WARMUP_TOLERANCE) -> Dict[str, Any]:
+        """
+        暖機：直接呼叫 embedding 模型、跑一次檢索與重新排序、送出完整的回答 prompt 並在首個 token 停止
+        (Ollama 在首個 token 前載入模型並快取系統提示的前綴)，不經過答案快取
+        重複到某輪耗時不超過前一輪的 (1 + tolerance) 倍，回傳每輪各步驟的延遲 (ms)
+        """
+        rounds = []
+        converged = False
+        for _ in range(max(max_rounds, 1)):
+            timings = {}
+            start = time.perf_counter()
+            self.base_embeddings.embed_query(query)
+            timings["embed_ms"] = (time.perf_counter() - start) * 1000
+
+            step = time.perf_counter()
+            processed_query = self.preprocess_query(query)
+            candidate_docs, positions = self.search_hits(processed_query)
+            ranked_docs = self.rerank(candidate_docs, processed_query, positions)
+            timings["search_ms"] = (time.perf_counter() - step) * 1000
+
+            step = time.perf_counter()
+            for token in self.generation_chain.stream(self.build_prompt(processed_query, ranked_docs)):
+                if token:
+                    break
+            timings["llm_ttft_ms"] = (time.perf_counter() - step) * 1000
+            timings["total_ms"] = (time.perf_counter() - start) * 1000
+            rounds.append(timings)
+
+            if len(rounds) > 1 and timings["total_ms"] <= rounds[-2]["total_ms"] * (1 + tolerance):
+                converged = True
+                break
+
+        return {"query": query, "rounds": rounds, "converged": converged}
+
+    def set_search_params(self, nprobe=None, ef_search=None, rescore_factor=None):
+        """調整查詢時的召回率/延遲取捨 (IVF 的 nprobe、HNSW 的 efSearch、量化索引精確重算的候選倍數)"""
+        if nprobe is not None:
+            self.index_config["nprobe"] = nprobe
+        if ef_search is not None:
+            self.index_config["ef_search"] = ef_search
+        if rescore_factor is not None:
+            # 只對建立時保存了 float32 向量的量化索引有效
+            self.index_config["rescore_factor"] = rescore_factor
+        with self._lock.write():
+            apply_search_params(self.vector_db.index, resolve_params(self.index_config))
+    
+    def snapshot(self, path: str = None):
+        """
+        把目前的索引寫成完整快照並刪除已涵蓋的日誌
+        寫入者只在複製記憶體狀態時被擋住，寫檔期間新增文檔與檢索都不受影響
+        """
+        path = path or self.index_path
+        with self._snapshot_lock, timed("snapshot"):
+            start = time.perf_counter()
+            # 讀鎖: 複製狀態期間擋住寫入者，但檢索照常進行
+            with self._lock.read():
+                seq = self.wal.rotate() if self.wal is not None else 0
+                state = VectorStoreSnapshot.capture(self.vector_db)
+                keyword_index = self.keyword_index.copy()
+                parents = self.parents.copy() if self.parents is not None else None
+                config = dict(self.index_config)
+                self._docs_since_snapshot = 0
+            
+            manifest = {"wal_seq": seq, "vectors": state.count, "created_at": datetime.now().isoformat()}
+            writers = [keyword_index.save, lambda folder: save_snapshot_manifest(folder, manifest)]
+            if parents is not None:
+                writers.append(parents.save)
+            write_snapshot(path, state, config, writers)
+            
+            with self._lock.write():
+                reattach_docstore(self.vector_db, path, state.count)
+                if self.keyword_index is not None and self.keyword_index.base is keyword_index.base:
+                    self.keyword_index.reattach(path)
+                if parents is not None and self.parents is not None and self.parents.docs is parents.docs:
+                    self.parents.reattach(path)
+            if self.wal is not None:
+                self.wal.drop_through(seq)
+            
+            self.snapshot_stats["snapshots"] += 1
+            self.snapshot_stats["last_snapshot_ms"] = (time.perf_counter() - start) * 1000
+            self.snapshot_stats["last_snapshot_at"] = manifest["created_at"]
+    
+    def _snapshot_loop(self):
+        """背景快照: 新增文檔達到門檻時立即寫出，否則每隔一段時間檢查一次"""
+        while not self._closed:
+            self._snapshot_event.wait(SNAPSHOT_INTERVAL_SECONDS)
+            self._snapshot_event.clear()
+            if self._closed or self._docs_since_snapshot == 0 or self.index_path is None:
+                continue
+            try:
+                self.snapshot()
+                self.snapshot_stats["last_error"] = None
+            except Exception as e:
+                # 日誌分段沒有被刪除，下次快照或重啟重放時仍然完整
+                self.snapshot_stats["last_error"] = str(e)
+                print(f"⚠️ 背景快照失敗: {e}")
+    
+    def _open_wal(self, path: str):
+        self.close_wal()
+        self.index_path = path
+        self.wal = WriteAheadLog(wal_dir_for(path))
+        if self._snapshot_thread is None:
+            self._snapshot_thread = threading.Thread(target=self._snapshot_loop, name="index-snapshot", daemon=True)
+            self._snapshot_thread.start()
+    
+    def close_wal(self):
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+
+    def close(self):
+        """
+        釋放索引 (多索引登錄表淘汰時呼叫): 還有未寫入快照的文檔時先寫快照，
+        停止背景快照、關閉日誌與映射的檔案；共用的模型不受影響
+        """
+        if self._docs_since_snapshot and self.index_path is not None:
+            self.snapshot()
+        self._closed = True
+        self._snapshot_event.set()
+        self.close_wal()
+        with self._lock.write():
+            docstores = [self.vector_db.docstore if self.vector_db is not None else None,
+                         self.parents.docs if self.parents is not None else None]
+            self.vector_db = None
+            self.keyword_index = None
+            self.parents = None
+            self.hybrid_retriever = None
+        for docstore in docstores:
+            if isinstance(docstore, ColumnarDocstore):
+                docstore.close()
+        self.answer_cache.invalidate()
+    
+    def _replay_wal(self, after_seq: int) -> int:
+        """重放快照之後的日誌 (已在快照中的文檔 id 會略過)，回傳重放的文檔數"""
+        replayed = 0
+        for _, record in self.wal.replay(after_seq):
+            docs, vectors = [], []
+            for item in record["docs"]:
+                if isinstance(self.vector_db.docstore.search(item["id"]), Document):
+                    continue
+                docs.append(Document(id=item["id"], page_content=item["content"], metadata=item["metadata"]))
+                vectors.append(decode_vector(item["vector"]))
+            if docs:
+                self._apply_documents(docs, vectors, log=False)
+                replayed += len(docs)
+        return replayed
     
     def save_index(self, path="faiss_index_improved"):
-        """保存向量索引"""
-        if self.vector_db:
-            self.vector_db.save_local(path)
+        """寫出完整快照 (向量索引、欄式文檔庫、關鍵詞索引與索引參數)，之後的新增文檔寫入該目錄的日誌"""
+        if not self.vector_db:
+            return
+        if self.wal is None or os.path.normpath(path) != os.path.normpath(self.index_path):
+            # 新的索引目錄: 目錄旁舊的日誌對新快照無效
+            self.close_wal()
+            WriteAheadLog.reset(wal_dir_for(path))
+            self.snapshot(path)
+            self._open_wal(path)
+        else:
+            self.snapshot(path)
     
     def load_index(self, path="faiss_index_improved"):
-        """載入向量索引"""
+        """以 mmap 載入最近的快照並重放之後的日誌，載入後即可進行混合檢索"""
+        # 沒有 index_config.json 的舊索引目錄是 flat + COSINE
         try:
-            self.vector_db = FAISS.load_local(
-                path, 
-                self.embeddings, 
-                allow_dangerous_deserialization=True
-            )
-            return True
+            vector_db, config = load_vector_store(path, self.embeddings, LEGACY_INDEX_CONFIG)
+        except LegacyPickleIndexError as e:
+            print(f"⚠️ {e}")
+            return False
         except:
             return False
+        
+        apply_search_params(vector_db.index, resolve_params(config))
+        
+        parents = None
+        if config.get("multi_vector"):
+            try:
+                parents = ParentStore.load(path, vector_db.index.ntotal)
+            except (OSError, ValueError) as e:
+                # 子文檔沒有內容，缺少父文檔時無法回答
+                print(f"⚠️ 無法載入父文檔: {e}")
+                return False
+        
+        try:
+            keyword_index = KeywordIndex.load(path)
+        except (OSError, ValueError, KeyError):
+            keyword_index = None
+        
+        # 舊的索引目錄沒有關鍵詞索引，或數量與向量不一致時，從 docstore 重建一次
+        if keyword_index is None or len(keyword_index) != vector_db.index.ntotal:
+            if parents is not None:
+                # 子文檔沒有內容，以父文檔內容重建
+                keyword_index = KeywordIndex()
+                keyword_index.add_texts([
+                    doc.page_content for doc in parents.resolve(
+                        range(vector_db.index.ntotal),
+                        lambda position: vector_db.docstore.search(vector_db.index_to_docstore_id[position])
+                    )
+                ])
+            else:
+                keyword_index = KeywordIndex.from_vector_db(vector_db)
+            keyword_index.save(path)
+            keyword_index.reattach(path)
+        
+        with self._lock.write():
+            self.vector_db = vector_db
+            self.keyword_index = keyword_index
+            self.parents = parents
+            self.index_config = config
+            self.index_type = config["index_type"]
+            self.multi_vector = parents is not None
+            self._build_retrievers()
+        
+        self._docs_since_snapshot = 0
+        self._open_wal(path)
+        replayed = self._replay_wal(load_snapshot_manifest(path)["wal_seq"])
+        if replayed:
+            print(f"🔁 從預寫日誌重放 {replayed} 份文檔")
+        
+        self.answer_cache.invalidate()
+        return True
+    
+    def index_counts(self) -> Dict[str, int]:
+        """在讀鎖內讀取各結構的文檔數，一致時全部相同 (多向量模式另含父文檔對應表)"""
+        with self._lock.read():
+            counts = {
+                "vectors": self.vector_db.index.ntotal,
+                "docstore_ids": len(self.vector_db.index_to_docstore_id),
+                "keyword_docs": len(self.keyword_index),
+            }
+            if self.parents is not None:
+                counts["parent_map"] = len(self.parents.rows)
+            return counts
+    
+    def concurrency_stats(self) -> Dict[str, Any]:
+        return self._lock.stats()
+    
+    def persistence_stats(self) -> Dict[str, Any]:
+        return {
+            "index_path": self.index_path,
+            "docs_since_snapshot": self._docs_since_snapshot,
+            "wal": self.wal.stats() if self.wal is not None else None,
+            **self.snapshot_stats
+        }
 
 
 def main():
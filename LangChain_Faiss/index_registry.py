@@ -0,0 +1,239 @@
+"""
+多索引登錄表: 一個進程服務多個具名索引 (每個團隊 / 租戶一個知識庫)，請求以 index 參數選擇
+- 索引目錄: RAG_INDEX_ROOT/<名稱>，或以 RAG_INDEXES="名稱=路徑,名稱=路徑" 明確指定
+- 第一次使用時載入 (同一索引只載入一次，其他索引的請求不受影響)
+- 已載入索引的目錄大小總和超過 RAG_INDEX_DISK_BUDGET_MB 時，淘汰最久沒有使用且沒有請求正在使用的索引
+- 預設索引 (default) 由啟動流程載入並固定常駐，不會被淘汰
+預算以索引目錄內的檔案大小 (磁碟用量) 計算，不是實際的記憶體用量: 向量索引與文檔庫以 mmap 讀取，
+被查詢觸及的頁面才常駐；記憶體中的關鍵詞索引、父文檔對應表，以及新增文檔或快照後完整讀入記憶體的向量索引
+都不在計算內，實際記憶體可能高於預算，設定時需要預留空間。
+"""
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from index_storage import DOCSTORE_FILE
+from metrics import timed, event
+
+
+INDEX_ROOT = os.getenv("RAG_INDEX_ROOT", "rag_indexes")
+INDEX_DISK_BUDGET_MB = float(os.getenv("RAG_INDEX_DISK_BUDGET_MB", "2048"))
+DEFAULT_INDEX = "default"
+INDEX_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+
+
+class UnknownIndex(Exception):
+    """請求的索引名稱不合法或找不到索引目錄"""
+
+    def __init__(self, name: str, reason: str = "找不到索引", status_code: int = 404):
+        super().__init__(f"{reason}: {name}")
+        self.name = name
+        self.status_code = status_code
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"success": False, "error": str(self), "index": self.name}
+
+
+def parse_index_paths(value: Optional[str]) -> Dict[str, str]:
+    """解析 "名稱=路徑,名稱=路徑" (RAG_INDEXES)"""
+    paths = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, path = item.split("=", 1)
+            paths[name.strip()] = path.strip()
+    return paths
+
+
+def directory_bytes(path: str) -> int:
+    """索引目錄內檔案的總大小 (不含預寫日誌等子目錄)"""
+    total = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                total += entry.stat().st_size
+    return total
+
+
+class IndexEntry:
+    def __init__(self, name: str, path: Optional[str], rag, size_bytes: int, pinned: bool = False):
+        self.name = name
+        self.path = path
+        self.rag = rag
+        self.size_bytes = size_bytes
+        self.pinned = pinned
+        self.in_use = 0
+        self.hits = 0
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "path": self.path,
+            "size_mb": self.size_bytes / 1024 / 1024,
+            "pinned": self.pinned,
+            "in_use": self.in_use,
+            "hits": self.hits,
+            "idle_seconds": time.time() - self.last_used,
+        }
+
+
+class IndexRegistry:
+    """
+    factory() 建立空的 RAG 實例 (應共用模型，例如 ImprovedRAG(shared=預設實例))，
+    登錄表呼叫 rag.load_index(路徑) 載入，淘汰時呼叫 rag.close()
+    """
+
+    def __init__(self, factory: Callable[[], Any], root: str = INDEX_ROOT,
+                 disk_budget_mb: float = INDEX_DISK_BUDGET_MB, paths: Optional[Dict[str, str]] = None):
+        self.factory = factory
+        self.root = root
+        self.disk_budget_bytes = int(disk_budget_mb * 1024 * 1024)
+        self.paths = dict(paths if paths is not None else parse_index_paths(os.getenv("RAG_INDEXES")))
+        self._lock = threading.Lock()
+        # 名稱 -> IndexEntry，依最近使用排序 (最後一個最新)
+        self._entries: "OrderedDict[str, IndexEntry]" = OrderedDict()
+        # 載入中的索引: 名稱 -> 鎖，同一索引的並發請求等待同一次載入
+        self._loading: Dict[str, threading.Lock] = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def pin(self, name: str, rag, path: Optional[str] = None):
+        """登記固定常駐的索引 (預設索引)，不會被淘汰，目錄大小也不計入預算"""
+        size = directory_bytes(path) if path and os.path.isdir(path) else 0
+        with self._lock:
+            self._entries[name] = IndexEntry(name, path, rag, size, pinned=True)
+
+    def resolve_path(self, name: str) -> str:
+        if not INDEX_NAME_PATTERN.match(name):
+            raise UnknownIndex(name, "索引名稱只能包含英數字、底線與連字號", 400)
+        path = self.paths.get(name) or os.path.join(self.root, name)
+        if not os.path.exists(os.path.join(path, DOCSTORE_FILE)):
+            raise UnknownIndex(name)
+        return path
+
+    def check(self, name: str):
+        """確認索引可以使用 (已常駐或找得到目錄)，否則拋出 UnknownIndex"""
+        with self._lock:
+            if name in self._entries:
+                return
+        self.resolve_path(name)
+
+    def names(self) -> List[str]:
+        """可以使用的索引名稱 (已常駐、明確指定與索引根目錄下的目錄)"""
+        names = set(self._entries) | set(self.paths)
+        if os.path.isdir(self.root):
+            names.update(
+                entry for entry in os.listdir(self.root)
+                if INDEX_NAME_PATTERN.match(entry) and os.path.exists(os.path.join(self.root, entry, DOCSTORE_FILE))
+            )
+        return sorted(names)
+
+    def _checkout(self, name: str) -> Optional[IndexEntry]:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+                entry.in_use += 1
+                entry.hits += 1
+                entry.last_used = time.time()
+            return entry
+
+    def _load(self, name: str) -> IndexEntry:
+        path = self.resolve_path(name)
+        with self._lock:
+            loading = self._loading.setdefault(name, threading.Lock())
+        with loading:
+            try:
+                # 等待期間其他請求可能已經載入完成
+                entry = self._checkout(name)
+                if entry is not None:
+                    return entry
+                start = time.perf_counter()
+                rag = self.factory()
+                try:
+                    with timed("index_load"):
+                        loaded = rag.load_index(path)
+                except Exception:
+                    rag.close()
+                    raise
+                if not loaded:
+                    rag.close()
+                    raise UnknownIndex(name, "無法載入索引", 500)
+                entry = IndexEntry(name, path, rag, directory_bytes(path))
+                entry.in_use = 1
+                entry.hits = 1
+                with self._lock:
+                    self._entries[name] = entry
+                    self.loads += 1
+                    evicted = self._select_evictions()
+            finally:
+                # 載入失敗時也移除，下一個請求重新嘗試
+                with self._lock:
+                    if self._loading.get(name) is loading:
+                        del self._loading[name]
+            event("index_load")
+            print(f"📂 載入索引 {name} ({entry.size_bytes / 1024 / 1024:.1f}MB, "
+                  f"{(time.perf_counter() - start) * 1000:.0f}ms)")
+        for victim in evicted:
+            self._close(victim)
+        return entry
+
+    def _loaded_disk_bytes(self) -> int:
+        """可淘汰的已載入索引的目錄大小總和"""
+        return sum(entry.size_bytes for entry in self._entries.values() if not entry.pinned)
+
+    def _select_evictions(self) -> List[IndexEntry]:
+        """超過預算時由最久沒有使用的開始移除 (需要持有 self._lock)；正在使用的索引留到下次"""
+        victims = []
+        loaded = self._loaded_disk_bytes()
+        for name in list(self._entries):
+            if loaded <= self.disk_budget_bytes:
+                break
+            entry = self._entries[name]
+            if entry.pinned or entry.in_use:
+                continue
+            del self._entries[name]
+            loaded -= entry.size_bytes
+            victims.append(entry)
+        self.evictions += len(victims)
+        return victims
+
+    def _close(self, entry: IndexEntry):
+        try:
+            entry.rag.close()
+        except Exception as e:
+            print(f"⚠️ 關閉索引 {entry.name} 失敗: {e}")
+        event("index_evict")
+        print(f"🗑️ 淘汰索引 {entry.name} ({entry.size_bytes / 1024 / 1024:.1f}MB)")
+
+    @contextmanager
+    def acquire(self, name: Optional[str] = None) -> Iterator[Any]:
+        """取得索引 (需要時載入)；區塊執行期間該索引不會被淘汰"""
+        name = name or DEFAULT_INDEX
+        entry = self._checkout(name) or self._load(name)
+        try:
+            yield entry.rag
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                evicted = self._select_evictions() if entry.in_use == 0 else []
+            for victim in evicted:
+                self._close(victim)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = [entry.stats() for entry in reversed(self._entries.values())]
+            loaded_disk = self._loaded_disk_bytes()
+        return {
+            "disk_budget_mb": self.disk_budget_bytes / 1024 / 1024,
+            "loaded_disk_mb": loaded_disk / 1024 / 1024,
+            "loaded": len(entries),
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "indexes": entries,
+        }
@@ -0,0 +1,461 @@
+"""
+索引目錄的儲存格式 (不使用 pickle)
+- index.faiss:     FAISS 索引，以記憶體映射 (mmap) 開啟，多個進程共用 OS page cache
+- docstore.bin:    欄式文檔庫，id / 內容 / metadata 各自連續存放，依向量位置或文檔 id 按需讀取
+- index_config.json: 索引類型與距離設定 (見 vector_index.py)
+
+啟動時只需要映射檔案與讀取檔頭，不會把整個語料載入成 Python 物件。
+舊的 index.pkl 需要 unpickle，只有設定 RAG_ALLOW_PICKLE_INDEX=1 或執行
+`python index_storage.py migrate <索引目錄>` 時才會讀取，讀取後即轉換成新格式。
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+import shutil
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+
+from vector_index import save_index_config, load_index_config
+
+
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILE = "docstore.bin"
+LEGACY_PICKLE_FILE = "index.pkl"
+
+ALLOW_PICKLE_INDEX = os.getenv("RAG_ALLOW_PICKLE_INDEX", "0") == "1"
+
+# 檔頭: 魔術字串、文檔數、三個欄位與排序表的起始位置
+_MAGIC = b"RAGDOC01"
+_HEADER = struct.Struct("<8sQQQQQ")
+
+# 沒有 index_config.json 的舊索引目錄 (ImprovedRAG 舊版為 flat + COSINE)
+LEGACY_INDEX_CONFIG = {"index_type": "flat", "distance_strategy": "COSINE", "normalize_L2": False}
+
+
+class LegacyPickleIndexError(RuntimeError):
+    """索引目錄只有舊的 pickle 文檔庫，且未允許讀取"""
+
+    def __init__(self, folder_path: str):
+        super().__init__(
+            f"{folder_path} 只有舊格式的 {LEGACY_PICKLE_FILE}，讀取需要執行 pickle。"
+            f"確認來源可信後執行 `python index_storage.py migrate {folder_path}` 轉換，"
+            f"或設定 RAG_ALLOW_PICKLE_INDEX=1 於載入時自動轉換"
+        )
+        self.folder_path = folder_path
+
+
+def encode_row(doc_id: str, doc: Document) -> Tuple[bytes, bytes, bytes]:
+    metadata = json.dumps(doc.metadata or {}, ensure_ascii=False, default=str)
+    return doc_id.encode("utf-8"), doc.page_content.encode("utf-8"), metadata.encode("utf-8")
+
+
+def write_docstore(path: str, records: Iterable[Tuple[bytes, bytes, bytes]]):
+    """
+    依向量位置順序寫入欄式文檔庫，records 為 (id, 內容, metadata JSON) 的 UTF-8 位元組
+    先寫暫存檔再原子替換，已映射舊檔的讀者不受影響
+    """
+    ids, contents, metadatas = [], [], []
+    for doc_id, content, metadata in records:
+        ids.append(doc_id)
+        contents.append(content)
+        metadatas.append(metadata)
+    count = len(ids)
+
+    offsets = np.zeros((count + 1, 3), dtype=np.int64)
+    for column, values in enumerate((ids, contents, metadatas)):
+        offsets[1:, column] = np.cumsum([len(v) for v in values], dtype=np.int64)
+    # 依 id 排序的位置表，用二分搜尋以 id 找文檔 (UTF-8 位元組順序與字串順序相同)
+    order = np.array(sorted(range(count), key=ids.__getitem__), dtype=np.int64)
+
+    ids_start = _HEADER.size + offsets.nbytes
+    content_start = ids_start + int(offsets[-1, 0])
+    metadata_start = content_start + int(offsets[-1, 1])
+    order_start = metadata_start + int(offsets[-1, 2])
+    padding = (-order_start) % 8
+    order_start += padding
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, count, ids_start, content_start, metadata_start, order_start))
+        f.write(offsets.tobytes())
+        for values in (ids, contents, metadatas):
+            for value in values:
+                f.write(value)
+        f.write(b"\0" * padding)
+        f.write(order.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ColumnarDocstore(Docstore, AddableMixin):
+    """
+    以 mmap 讀取 docstore.bin 的文檔庫
+    檔案內的文檔唯讀，之後新增的文檔先放在記憶體，下次保存時一起寫回檔案。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        if self._mm is None or size < _HEADER.size:
+            raise ValueError(f"文檔庫檔案不完整: {path}")
+
+        magic, count, ids_start, content_start, metadata_start, order_start = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"不是欄式文檔庫檔案: {path}")
+        self.count = count
+        self._starts = (ids_start, content_start, metadata_start)
+        self._offsets = np.frombuffer(self._mm, dtype=np.int64, count=(count + 1) * 3,
+                                      offset=_HEADER.size).reshape(count + 1, 3)
+        self._order = np.frombuffer(self._mm, dtype=np.int64, count=count, offset=order_start)
+
+        self._added: Dict[str, Document] = {}
+        self._deleted = set()
+
+    def _column(self, position: int, column: int) -> str:
+        start = self._starts[column]
+        begin, end = self._offsets[position, column], self._offsets[position + 1, column]
+        return self._mm[start + begin:start + end].decode("utf-8")
+
+    def id_at(self, position: int) -> str:
+        return self._column(position, 0)
+
+    def row(self, position: int) -> Document:
+        doc_id = self.id_at(position)
+        return Document(
+            id=doc_id,
+            page_content=self._column(position, 1),
+            metadata=json.loads(self._column(position, 2)),
+        )
+
+    def raw_rows(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[bytes, bytes, bytes]]:
+        """直接回傳檔案中的位元組，快照時不需要解碼再編碼"""
+        stop = self.count if stop is None else stop
+        for position in range(start, stop):
+            yield tuple(
+                self._mm[self._starts[c] + self._offsets[position, c]:self._starts[c] + self._offsets[position + 1, c]]
+                for c in range(3)
+            )
+
+    def position_of(self, doc_id: str) -> Optional[int]:
+        """在依 id 排序的位置表上二分搜尋"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.id_at(int(self._order[mid])) < doc_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            position = int(self._order[lo])
+            if self.id_at(position) == doc_id:
+                return position
+        return None
+
+    def search(self, search: str) -> Any:
+        if search in self._deleted:
+            return f"ID {search} not found."
+        doc = self._added.get(search)
+        if doc is not None:
+            return doc
+        position = self.position_of(search)
+        if position is None:
+            return f"ID {search} not found."
+        return self.row(position)
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        overlapping = [doc_id for doc_id in texts if isinstance(self.search(doc_id), Document)]
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        for doc_id in texts:
+            self._deleted.discard(doc_id)
+        self._added.update(texts)
+
+    def delete(self, ids: List) -> None:
+        missing = [doc_id for doc_id in ids if not isinstance(self.search(doc_id), Document)]
+        if missing:
+            raise ValueError(f"Tried to delete ids that does not  exist: {missing}")
+        for doc_id in ids:
+            if self._added.pop(doc_id, None) is None:
+                self._deleted.add(doc_id)
+
+    def close(self):
+        self._offsets = self._order = None
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # 仍有 numpy 視圖引用映射時交給 GC 處理
+                pass
+        self._file.close()
+
+
+class ColumnarIdMap(MutableMapping):
+    """向量位置 -> 文檔 id，檔案內的部分直接從 docstore.bin 讀取"""
+
+    def __init__(self, docstore: ColumnarDocstore):
+        self.docstore = docstore
+        self._extra: Dict[int, str] = {}
+
+    def __getitem__(self, position: int) -> str:
+        position = int(position)
+        if 0 <= position < self.docstore.count:
+            return self.docstore.id_at(position)
+        return self._extra[position]
+
+    def __setitem__(self, position: int, doc_id: str):
+        position = int(position)
+        if position < self.docstore.count:
+            raise KeyError(f"位置 {position} 屬於唯讀的文檔庫檔案")
+        self._extra[position] = doc_id
+
+    def __delitem__(self, position: int):
+        raise NotImplementedError("ColumnarIdMap 不支援刪除單一位置")
+
+    def __iter__(self) -> Iterator[int]:
+        yield from range(self.docstore.count)
+        yield from sorted(self._extra)
+
+    def __len__(self) -> int:
+        return self.docstore.count + len(self._extra)
+
+
+def read_index_mmap(path: str, index_type: str = "flat"):
+    """以 mmap 開啟 FAISS 索引；IVF 映射倒排表，其餘映射向量資料"""
+    flags = faiss.IO_FLAG_MMAP if index_type.startswith("ivf") else faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+    try:
+        return faiss.read_index(path, flags)
+    except RuntimeError:
+        # 不支援映射的索引類型退回一般讀取
+        return faiss.read_index(path)
+
+
+def make_writable(vector_db: FAISS):
+    """新增向量前把映射的索引完整讀入記憶體 (對映射索引直接 add 會使 FAISS 中止進程)"""
+    path = getattr(vector_db, "mmap_index_path", None)
+    if path is not None:
+        vector_db.index = faiss.read_index(path)
+        vector_db.mmap_index_path = None
+
+
+class VectorStoreSnapshot:
+    """
+    向量庫某一時間點的狀態
+    capture() 需要在沒有寫入者的情況下呼叫，只複製記憶體中的索引與新增的文檔；
+    write_to() 可以在鎖外執行 (文檔庫檔案部分不可變，直接從舊映射複製)
+    """
+
+    def __init__(self, vector_db: FAISS):
+        self.count = vector_db.index.ntotal
+        source = getattr(vector_db, "mmap_index_path", None)
+        if source is not None:
+            # 映射中的索引沒有被修改過，保留檔案句柄，之後直接複製檔案；
+            # IVF 的映射倒排表序列化後只會引用原檔案，不能用 serialize_index
+            self.index_file = open(source, "rb")
+            self.index_bytes = None
+        else:
+            self.index_file = None
+            self.index_bytes = faiss.serialize_index(vector_db.index)
+
+        docstore = vector_db.docstore
+        id_map = vector_db.index_to_docstore_id
+        if isinstance(docstore, ColumnarDocstore) and isinstance(id_map, ColumnarIdMap) and not docstore._deleted:
+            self.base = docstore
+            start = docstore.count
+        else:
+            self.base = None
+            start = 0
+        self.extra_rows = []
+        for position in range(start, self.count):
+            doc_id = id_map[position]
+            doc = docstore.search(doc_id)
+            if not isinstance(doc, Document):
+                raise ValueError(f"文檔庫缺少向量位置 {position} 的文檔 {doc_id}")
+            self.extra_rows.append((doc_id, doc))
+
+    @classmethod
+    def capture(cls, vector_db: FAISS) -> "VectorStoreSnapshot":
+        return cls(vector_db)
+
+    def records(self) -> Iterator[Tuple[bytes, bytes, bytes]]:
+        if self.base is not None:
+            yield from self.base.raw_rows()
+        for doc_id, doc in self.extra_rows:
+            yield encode_row(doc_id, doc)
+
+    def write_to(self, folder_path: str):
+        index_path = os.path.join(folder_path, INDEX_FILE)
+        with open(index_path, "wb") as f:
+            if self.index_file is not None:
+                shutil.copyfileobj(self.index_file, f)
+                self.index_file.close()
+            else:
+                self.index_bytes.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        write_docstore(os.path.join(folder_path, DOCSTORE_FILE), self.records())
+
+
+def _fsync_dir(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def recover_directory(folder_path: str):
+    """快照替換目錄途中中斷時，恢復上一個完整的索引目錄並清掉未完成的暫存目錄"""
+    folder_path = os.path.normpath(folder_path)
+    previous = folder_path + ".previous"
+    if not os.path.isdir(folder_path) and os.path.isdir(previous):
+        os.rename(previous, folder_path)
+    shutil.rmtree(folder_path + ".staging", ignore_errors=True)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def write_snapshot(folder_path: str, snapshot: VectorStoreSnapshot, config: Optional[Dict[str, Any]] = None,
+                   extra_writers: Iterable[Callable[[str], None]] = ()):
+    """
+    在暫存目錄寫出完整索引後整個替換 folder_path，任何時間點磁碟上都有一份完整的索引
+    extra_writers 會收到暫存目錄路徑 (例如關鍵詞索引的 save)；舊目錄中其他檔案會保留
+    """
+    folder_path = os.path.normpath(folder_path)
+    staging = folder_path + ".staging"
+    previous = folder_path + ".previous"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    snapshot.write_to(staging)
+    if config is not None:
+        save_index_config(staging, config)
+    for writer in extra_writers:
+        writer(staging)
+
+    if os.path.isdir(folder_path):
+        for name in os.listdir(folder_path):
+            source = os.path.join(folder_path, name)
+            if os.path.isfile(source) and not name.endswith(".tmp") and not os.path.exists(os.path.join(staging, name)):
+                shutil.copy2(source, os.path.join(staging, name))
+    _fsync_dir(staging)
+
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.isdir(folder_path):
+        os.rename(folder_path, previous)
+    os.rename(staging, folder_path)
+    _fsync_dir(os.path.dirname(os.path.abspath(folder_path)))
+    # 舊檔案被映射的部分在取消映射前仍然有效
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def reattach_docstore(vector_db: FAISS, folder_path: str, count: int):
+    """
+    快照寫完後改從新的 docstore.bin 讀取，釋放記憶體中已寫入檔案的文檔
+    count 之後 (快照期間新增) 的文檔保留在記憶體；需要在沒有寫入者的情況下呼叫
+    """
+    docstore = ColumnarDocstore(os.path.join(folder_path, DOCSTORE_FILE))
+    id_map = ColumnarIdMap(docstore)
+    old_docstore, old_id_map = vector_db.docstore, vector_db.index_to_docstore_id
+    for position in range(count, len(old_id_map)):
+        doc_id = old_id_map[position]
+        docstore._added[doc_id] = old_docstore.search(doc_id)
+        id_map._extra[position] = doc_id
+    # 舊的映射可能還有查詢在讀，不主動關閉，由 GC 回收
+    vector_db.docstore = docstore
+    vector_db.index_to_docstore_id = id_map
+    if getattr(vector_db, "mmap_index_path", None) is not None:
+        vector_db.mmap_index_path = os.path.join(folder_path, INDEX_FILE)
+
+
+def save_vector_store(vector_db: FAISS, folder_path: str, config: Optional[Dict[str, Any]] = None,
+                      extra_writers: Iterable[Callable[[str], None]] = ()):
+    """保存 FAISS 索引、欄式文檔庫與索引參數 (整個目錄原子替換)，不寫 index.pkl"""
+    snapshot = VectorStoreSnapshot.capture(vector_db)
+    write_snapshot(folder_path, snapshot, config, extra_writers)
+    reattach_docstore(vector_db, folder_path, snapshot.count)
+
+
+def _load_legacy_pickle(folder_path: str, embeddings, config: Dict[str, Any], write_config: bool = True) -> FAISS:
+    vector_db = FAISS.load_local(
+        folder_path,
+        embeddings,
+        allow_dangerous_deserialization=True,
+        normalize_L2=config["normalize_L2"],
+        distance_strategy=DistanceStrategy(config["distance_strategy"]),
+    )
+    print(f"🔄 將舊格式索引轉換為欄式文檔庫: {folder_path}")
+    save_vector_store(vector_db, folder_path, config if write_config else None)
+    return vector_db
+
+
+def load_vector_store(folder_path: str, embeddings, default_config: Optional[Dict[str, Any]] = None,
+                      allow_pickle: bool = ALLOW_PICKLE_INDEX) -> Tuple[FAISS, Dict[str, Any]]:
+    """
+    載入索引目錄，回傳 (向量庫, 索引參數)
+    有 docstore.bin 時以 mmap 開啟；只有 index.pkl 時需要 allow_pickle 才會讀取並轉換。
+    """
+    recover_directory(folder_path)
+    config = dict(default_config or LEGACY_INDEX_CONFIG)
+    config.update(load_index_config(folder_path) or {})
+    config.setdefault("distance_strategy", DistanceStrategy.EUCLIDEAN_DISTANCE.value)
+
+    docstore_path = os.path.join(folder_path, DOCSTORE_FILE)
+    if not os.path.exists(docstore_path):
+        if not os.path.exists(os.path.join(folder_path, LEGACY_PICKLE_FILE)):
+            raise FileNotFoundError(f"找不到索引: {folder_path}")
+        if not allow_pickle:
+            raise LegacyPickleIndexError(folder_path)
+        return _load_legacy_pickle(folder_path, embeddings, config), config
+
+    docstore = ColumnarDocstore(docstore_path)
+    index = read_index_mmap(os.path.join(folder_path, INDEX_FILE), config.get("index_type", "flat"))
+    if index.ntotal != docstore.count:
+        docstore.close()
+        raise ValueError(f"索引向量數 {index.ntotal} 與文檔數 {docstore.count} 不一致: {folder_path}")
+
+    vector_db = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=ColumnarIdMap(docstore),
+        normalize_L2=config["normalize_L2"],
+        distance_strategy=DistanceStrategy(config["distance_strategy"]),
+    )
+    vector_db.mmap_index_path = os.path.join(folder_path, INDEX_FILE)
+    return vector_db, config
+
+
+def migrate(folder_path: str, default_config: Optional[Dict[str, Any]] = None):
+    """明確轉換舊的 pickle 索引目錄 (只應對可信來源執行)"""
+    saved_config = load_index_config(folder_path)
+    config = dict(default_config or LEGACY_INDEX_CONFIG)
+    config.update(saved_config or {})
+    config.setdefault("distance_strategy", DistanceStrategy.EUCLIDEAN_DISTANCE.value)
+    # 轉換只需要文檔與向量，不會呼叫 embedding；沒有參數檔的目錄維持由載入方決定預設值
+    _load_legacy_pickle(folder_path, None, config, write_config=saved_config is not None)
+    os.remove(os.path.join(folder_path, LEGACY_PICKLE_FILE))
+    print(f"✅ 轉換完成，已移除 {LEGACY_PICKLE_FILE}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "migrate":
+        for folder in sys.argv[2:]:
+            migrate(folder)
+    else:
+        print("用法: python index_storage.py migrate <索引目錄> [...]")
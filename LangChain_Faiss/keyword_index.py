@@ -0,0 +1,325 @@
+"""
+可增量更新、可持久化的 BM25 關鍵詞索引
+文檔位置與 FAISS 向量位置一一對應，文檔內容直接從 FAISS docstore 取得，
+因此索引只需保存倒排表與文檔長度，新增文檔時只需要切詞新文檔本身。
+
+磁碟格式 (CSR，以 np.load(mmap_mode="r") 映射，載入時不建立 Python 字典):
+- keyword_index.json:          參數與數量 (最後寫入，作為完整性標記)
+- keyword_terms.npy:           依字典序排列的詞 (UTF-8 連續存放)
+- keyword_term_offsets.npy:    每個詞在 keyword_terms.npy 的起始位置 (int64, 詞數 + 1)
+- keyword_posting_offsets.npy: 每個詞的倒排表在 positions / freqs 的起始位置 (int64, 詞數 + 1)
+- keyword_positions.npy / keyword_freqs.npy: 倒排表 (int32 文檔位置 / float32 詞頻)
+- keyword_doc_lengths.npy:     文檔長度 (int32)
+查詢時以二分搜尋找到詞，只讀取查詢詞的倒排表；載入後新增的文檔放在記憶體，保存時合併寫回。
+"""
+import os
+import re
+import json
+import math
+from typing import List, Dict, Optional, Tuple
+
+import numpy as np
+
+
+KEYWORD_INDEX_FILE = "keyword_index.json"
+KEYWORD_INDEX_FORMAT = "csr-v1"
+
+_ARRAY_FILES = {
+    "terms": "keyword_terms.npy",
+    "term_offsets": "keyword_term_offsets.npy",
+    "posting_offsets": "keyword_posting_offsets.npy",
+    "positions": "keyword_positions.npy",
+    "freqs": "keyword_freqs.npy",
+    "doc_lengths": "keyword_doc_lengths.npy",
+}
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[㐀-鿿豈-﫿]+")
+_CJK_PATTERN = re.compile(r"[㐀-鿿豈-﫿]")
+
+
+def tokenize(text: str) -> List[str]:
+    """英數字以單字切分，中文以字元 bigram 切分 (單字元詞保留原字)"""
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group()
+        if _CJK_PATTERN.match(token):
+            if len(token) == 1:
+                tokens.append(token)
+            else:
+                tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            tokens.append(token)
+    return tokens
+
+
+def _save_array(path: str, array: np.ndarray):
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+class _CsrPostings:
+    """唯讀的 CSR 倒排表 (通常映射自檔案)"""
+
+    def __init__(self, terms: np.ndarray, term_offsets: np.ndarray, posting_offsets: np.ndarray,
+                 positions: np.ndarray, freqs: np.ndarray, doc_lengths: np.ndarray, total_length: int):
+        self.terms = terms
+        self.term_offsets = term_offsets
+        self.posting_offsets = posting_offsets
+        self.positions = positions
+        self.freqs = freqs
+        self.doc_lengths = doc_lengths
+        self.total_length = total_length
+
+    @property
+    def term_count(self) -> int:
+        return len(self.term_offsets) - 1
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.doc_lengths)
+
+    def term_at(self, row: int) -> str:
+        return self.terms[self.term_offsets[row]:self.term_offsets[row + 1]].tobytes().decode("utf-8")
+
+    def find(self, term: str) -> int:
+        """在依字典序排列的詞表上二分搜尋，找不到回傳 -1"""
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term_at(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.term_count and self.term_at(lo) == term:
+            return lo
+        return -1
+
+    def postings(self, row: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.posting_offsets[row], self.posting_offsets[row + 1]
+        return self.positions[start:end], self.freqs[start:end]
+
+    @classmethod
+    def empty(cls) -> "_CsrPostings":
+        offsets = np.zeros(1, dtype=np.int64)
+        return cls(np.zeros(0, dtype=np.uint8), offsets, offsets, np.zeros(0, dtype=np.int32),
+                   np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int32), 0)
+
+
+class KeywordIndex:
+    """BM25 倒排索引，文檔以整數位置識別"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # 檔案中的文檔 (位置 0 ~ base.doc_count - 1)
+        self.base = _CsrPostings.empty()
+        # 之後新增的文檔: 詞 -> {位置: 詞頻}
+        self.added_postings: Dict[str, Dict[int, int]] = {}
+        self.added_lengths: List[int] = []
+        self.added_length = 0
+
+    def __len__(self):
+        return self.base.doc_count + len(self.added_lengths)
+
+    @property
+    def total_length(self) -> int:
+        return self.base.total_length + self.added_length
+
+    def add_texts(self, texts: List[str]) -> List[int]:
+        """追加文檔，只切詞新文檔；回傳新文檔的位置"""
+        positions = []
+        for text in texts:
+            position = len(self)
+            tokens = tokenize(text)
+            term_freqs: Dict[str, int] = {}
+            for token in tokens:
+                term_freqs[token] = term_freqs.get(token, 0) + 1
+            for term, freq in term_freqs.items():
+                self.added_postings.setdefault(term, {})[position] = freq
+            self.added_lengths.append(len(tokens))
+            self.added_length += len(tokens)
+            positions.append(position)
+        return positions
+
+    def postings_for(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """回傳詞的倒排表 (文檔位置, 詞頻)，只讀取這個詞的部分"""
+        row = self.base.find(term) if self.base.term_count else -1
+        base_positions, base_freqs = self.base.postings(row) if row >= 0 else (None, None)
+        added = self.added_postings.get(term)
+        if not added:
+            if base_positions is None:
+                return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+            return base_positions, base_freqs
+        added_positions = np.fromiter(added.keys(), dtype=np.int32, count=len(added))
+        added_freqs = np.fromiter(added.values(), dtype=np.float32, count=len(added))
+        if base_positions is None:
+            return added_positions, added_freqs
+        return np.concatenate([base_positions, added_positions]), np.concatenate([base_freqs, added_freqs])
+
+    def doc_lengths_at(self, positions: np.ndarray) -> np.ndarray:
+        base_count = self.base.doc_count
+        if not self.added_lengths:
+            return self.base.doc_lengths[positions]
+        lengths = np.empty(len(positions), dtype=np.float32)
+        in_base = positions < base_count
+        lengths[in_base] = self.base.doc_lengths[positions[in_base]]
+        added = (positions[~in_base] - base_count).tolist()
+        lengths[~in_base] = [self.added_lengths[i] for i in added]
+        return lengths
+
+    def search(self, query: str, k: int = 3) -> List[Tuple[int, float]]:
+        """回傳 (文檔位置, BM25 分數)，依分數由高到低排序"""
+        doc_count = len(self)
+        if doc_count == 0 or k <= 0:
+            return []
+
+        avg_length = self.total_length / doc_count or 1.0
+        hit_positions, hit_scores = [], []
+        for term in set(tokenize(query)):
+            positions, freqs = self.postings_for(term)
+            if len(positions) == 0:
+                continue
+            idf = math.log((doc_count - len(positions) + 0.5) / (len(positions) + 0.5) + 1.0)
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths_at(positions) / avg_length)
+            hit_positions.append(positions)
+            hit_scores.append(idf * freqs * (self.k1 + 1) / (freqs + norm))
+        if not hit_positions:
+            return []
+
+        scores = np.bincount(np.concatenate(hit_positions), weights=np.concatenate(hit_scores))
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(position), float(scores[position])) for position in candidates]
+
+    def copy(self) -> "KeywordIndex":
+        """複製一份 (快照時在鎖內複製，鎖外再寫檔)；檔案部分唯讀可直接共用"""
+        index = KeywordIndex(k1=self.k1, b=self.b)
+        index.base = self.base
+        index.added_postings = {term: dict(postings) for term, postings in self.added_postings.items()}
+        index.added_lengths = list(self.added_lengths)
+        index.added_length = self.added_length
+        return index
+
+    def _merged(self) -> _CsrPostings:
+        """把新增的文檔合併進 CSR 倒排表 (保存時使用)"""
+        base = self.base
+        if not self.added_postings and not self.added_lengths:
+            return base
+
+        base_terms = [base.term_at(row) for row in range(base.term_count)]
+        base_rows = {term: row for row, term in enumerate(base_terms)}
+        terms = sorted(set(base_terms).union(self.added_postings))
+
+        term_bytes, position_parts, freq_parts = [], [], []
+        term_lengths = np.zeros(len(terms), dtype=np.int64)
+        posting_counts = np.zeros(len(terms), dtype=np.int64)
+        for i, term in enumerate(terms):
+            encoded = term.encode("utf-8")
+            term_bytes.append(encoded)
+            term_lengths[i] = len(encoded)
+            row = base_rows.get(term, -1)
+            if row >= 0:
+                positions, freqs = base.postings(row)
+                position_parts.append(positions)
+                freq_parts.append(freqs)
+                posting_counts[i] += len(positions)
+            added = self.added_postings.get(term)
+            if added:
+                position_parts.append(np.fromiter(added.keys(), dtype=np.int32, count=len(added)))
+                freq_parts.append(np.fromiter(added.values(), dtype=np.float32, count=len(added)))
+                posting_counts[i] += len(added)
+
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(term_lengths, out=term_offsets[1:])
+        posting_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(posting_counts, out=posting_offsets[1:])
+        return _CsrPostings(
+            terms=np.frombuffer(b"".join(term_bytes), dtype=np.uint8),
+            term_offsets=term_offsets,
+            posting_offsets=posting_offsets,
+            positions=np.concatenate(position_parts) if position_parts else np.zeros(0, dtype=np.int32),
+            freqs=np.concatenate(freq_parts) if freq_parts else np.zeros(0, dtype=np.float32),
+            doc_lengths=np.concatenate([base.doc_lengths, np.asarray(self.added_lengths, dtype=np.int32)]),
+            total_length=self.total_length,
+        )
+
+    def save(self, folder_path: str):
+        """保存到索引目錄 (與 FAISS 索引放在一起)；陣列先寫，最後寫參數檔"""
+        os.makedirs(folder_path, exist_ok=True)
+        merged = self._merged()
+        for name, filename in _ARRAY_FILES.items():
+            _save_array(os.path.join(folder_path, filename), np.asarray(getattr(merged, name)))
+
+        data = {
+            "format": KEYWORD_INDEX_FORMAT,
+            "k1": self.k1,
+            "b": self.b,
+            "doc_count": merged.doc_count,
+            "term_count": merged.term_count,
+            "postings": len(merged.positions),
+            "total_length": merged.total_length,
+        }
+        path = os.path.join(folder_path, KEYWORD_INDEX_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, folder_path: str) -> "KeywordIndex":
+        """映射倒排表檔案，載入時間與語料大小無關；舊的 JSON 格式會拋出 ValueError (由呼叫方重建)"""
+        with open(os.path.join(folder_path, KEYWORD_INDEX_FILE), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format") != KEYWORD_INDEX_FORMAT:
+            raise ValueError(f"不支援的關鍵詞索引格式: {folder_path}")
+
+        arrays = {
+            name: np.load(os.path.join(folder_path, filename), mmap_mode="r")
+            for name, filename in _ARRAY_FILES.items()
+        }
+        base = _CsrPostings(total_length=data["total_length"], **arrays)
+        if (base.doc_count != data["doc_count"] or base.term_count != data["term_count"]
+                or len(base.positions) != data["postings"] or len(base.freqs) != data["postings"]):
+            raise ValueError(f"關鍵詞索引檔案不完整: {folder_path}")
+
+        index = cls(k1=data["k1"], b=data["b"])
+        index.base = base
+        return index
+
+    def reattach(self, folder_path: str):
+        """
+        快照寫完後改從新的檔案讀取，釋放記憶體中已寫入檔案的文檔
+        快照之後新增的文檔保留在記憶體；需要在沒有寫入者的情況下呼叫
+        """
+        saved = KeywordIndex.load(folder_path)
+        count = saved.base.doc_count
+        base_count = self.base.doc_count
+        if count < base_count:
+            raise ValueError(f"快照的關鍵詞索引比目前的舊: {folder_path}")
+        self.base = saved.base
+        self.added_postings = {
+            term: kept for term, kept in (
+                (term, {position: freq for position, freq in postings.items() if position >= count})
+                for term, postings in self.added_postings.items()
+            ) if kept
+        }
+        self.added_lengths = self.added_lengths[count - base_count:]
+        self.added_length = sum(self.added_lengths)
+
+    @classmethod
+    def from_vector_db(cls, vector_db) -> "KeywordIndex":
+        """從 FAISS docstore 依向量位置順序重建 (舊索引目錄沒有關鍵詞索引時使用)"""
+        index = cls()
+        id_map = vector_db.index_to_docstore_id
+        index.add_texts([
+            vector_db.docstore.search(id_map[position]).page_content
+            for position in range(len(id_map))
+        ])
+        return index
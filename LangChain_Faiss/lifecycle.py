@@ -0,0 +1,165 @@
+"""
+服務啟動流程: 背景載入或建立索引 -> 暖機 (embedding 模型與 LLM 載入記憶體、檢索路徑跑過一次) -> 就緒
+- 存活 (liveness, /healthz): 進程可以回應而且啟動沒有失敗；失敗時由外部重新啟動進程
+- 就緒 (readiness, /readyz): 索引已載入且暖機完成，負載平衡器這時才送流量過來，首個查詢的延遲與穩定狀態相同
+暖機失敗 (例如 Ollama 還沒啟動) 時每隔 RAG_WARMUP_RETRY_SECONDS 重試，重試 RAG_WARMUP_ATTEMPTS 次仍失敗視為啟動失敗。
+"""
+import os
+import time
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+from metrics import timed
+
+
+WARMUP_ENABLED = os.getenv("RAG_WARMUP", "1") != "0"
+WARMUP_ATTEMPTS = int(os.getenv("RAG_WARMUP_ATTEMPTS", "5"))
+WARMUP_RETRY_SECONDS = float(os.getenv("RAG_WARMUP_RETRY_SECONDS", "5"))
+
+STATES = ("idle", "loading", "warming_up", "ready", "failed")
+
+
+class ServiceLifecycle:
+    """
+    load() 載入服務物件，on_loaded(物件) 把它交給呼叫者，warm_up(物件) 回傳暖機結果
+    start() 在背景執行緒執行 (只會執行一次)；run() 同步執行，供腳本使用
+    """
+
+    def __init__(self, load: Callable[[], Any], warm_up: Optional[Callable[[Any], Any]] = None,
+                 on_loaded: Optional[Callable[[Any], None]] = None, name: str = "rag"):
+        self.load = load
+        self.warm_up = warm_up if WARMUP_ENABLED else None
+        self.on_loaded = on_loaded
+        self.name = name
+        self.state = "idle"
+        self.error = None
+        self.started_at = None
+        self.ready_at = None
+        self.load_ms = None
+        self.warmup_ms = None
+        self.warmup_attempts = 0
+        self.warmup_report = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    @property
+    def alive(self) -> bool:
+        return self.state != "failed"
+
+    def _claim(self) -> bool:
+        """只有第一個呼叫者可以開始啟動流程"""
+        with self._lock:
+            if self.state != "idle":
+                return False
+            self.state = "loading"
+            self.started_at = datetime.now().isoformat()
+            return True
+
+    def start(self) -> bool:
+        """在背景開始啟動流程；已經開始 (或已經就緒) 時不做任何事"""
+        if not self._claim():
+            return False
+        self._thread = threading.Thread(target=self._run_background, name=f"{self.name}-startup", daemon=True)
+        self._thread.start()
+        return True
+
+    def run(self):
+        """同步執行啟動流程並回傳載入的物件 (已經在背景執行時等待它完成)"""
+        if not self._claim():
+            self._done.wait()
+            if self.state == "failed":
+                raise RuntimeError(f"啟動失敗: {self.error}")
+            return None
+        return self._execute()
+
+    def install(self, instance):
+        """直接使用外部建立好的物件並視為就緒 (測試、壓力測試)"""
+        with self._lock:
+            self.state = "ready"
+            self.started_at = self.started_at or datetime.now().isoformat()
+            self.ready_at = datetime.now().isoformat()
+        if self.on_loaded is not None:
+            self.on_loaded(instance)
+        self._ready.set()
+        self._done.set()
+
+    def _run_background(self):
+        try:
+            self._execute()
+        except Exception:
+            # 錯誤已記錄在 self.error，存活檢查會回報失敗
+            pass
+
+    def _execute(self):
+        try:
+            print(f"🚀 [{self.name}] 載入索引...")
+            start = time.perf_counter()
+            with timed("startup_load"):
+                instance = self.load()
+            self.load_ms = (time.perf_counter() - start) * 1000
+            if self.ready:
+                # 載入期間已經 install() 了外部的物件
+                return instance
+            if self.on_loaded is not None:
+                self.on_loaded(instance)
+            print(f"📚 [{self.name}] 索引已載入 ({self.load_ms:.0f}ms)")
+
+            if self.warm_up is not None:
+                self.state = "warming_up"
+                self._warm_up(instance)
+
+            self.state = "ready"
+            self.ready_at = datetime.now().isoformat()
+            self._ready.set()
+            print(f"✅ [{self.name}] 已就緒")
+            return instance
+        except Exception as e:
+            self.state = "failed"
+            self.error = f"{type(e).__name__}: {e}"
+            print(f"❌ [{self.name}] 啟動失敗: {self.error}")
+            raise
+        finally:
+            self._done.set()
+
+    def _warm_up(self, instance):
+        start = time.perf_counter()
+        for attempt in range(1, WARMUP_ATTEMPTS + 1):
+            self.warmup_attempts = attempt
+            try:
+                with timed("warmup"):
+                    self.warmup_report = self.warm_up(instance)
+                break
+            except Exception as e:
+                self.error = f"{type(e).__name__}: {e}"
+                print(f"⚠️ [{self.name}] 暖機失敗 ({attempt}/{WARMUP_ATTEMPTS}): {self.error}")
+                if attempt == WARMUP_ATTEMPTS:
+                    raise
+                time.sleep(WARMUP_RETRY_SECONDS)
+        self.error = None
+        self.warmup_ms = (time.perf_counter() - start) * 1000
+        print(f"🔥 [{self.name}] 暖機完成 ({self.warmup_ms:.0f}ms)")
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待啟動流程結束，回傳是否就緒"""
+        self._done.wait(timeout)
+        return self.ready
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "ready": self.ready,
+            "started_at": self.started_at,
+            "ready_at": self.ready_at,
+            "load_ms": self.load_ms,
+            "warmup_ms": self.warmup_ms,
+            "warmup_attempts": self.warmup_attempts,
+            "warmup": self.warmup_report,
+            "error": self.error,
+        }
@@ -0,0 +1,221 @@
+"""
+RAG 管線的延遲指標，以 Prometheus 文字格式輸出 (/rag/metrics)，不依賴 prometheus_client
+- rag_stage_duration_seconds{stage}: 各階段延遲直方圖 (查詢前處理、查詢嵌入、向量/關鍵詞搜索、融合、
+  重新排序、prompt 組合、LLM 首個 token / 總時間、預寫日誌與快照...)
+- rag_stage_errors_total{stage}: 各階段拋出例外的次數
+- rag_events_total{event}: 答案快取命中等事件
+- rag_http_requests_total{route, status} / rag_http_request_duration_seconds{route}: API 請求
+指標只存在目前進程的記憶體，每個階段的記錄只是一次加鎖的計數更新。
+請求啟用分析 (profiling.py) 時，同樣的階段另外記錄到該請求的 trace。
+"""
+import os
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+
+METRICS_ENABLED = os.getenv("RAG_METRICS", "1") != "0"
+# 直方圖的桶上界 (秒)
+STAGE_BUCKETS = tuple(sorted(float(b) for b in os.getenv(
+    "RAG_METRICS_BUCKETS",
+    "0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30"
+).split(",") if b))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Tuple[str, str] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = STAGE_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # 標籤 -> [各桶計數 (不累計，最後一格為 +Inf), 總和]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, *labels: str) -> int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                label_text = _format_labels(self.label_names, labels, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{label_text} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """輸出時才呼叫 fn 取值 (例如向量數、工作池排隊數)，fn 回傳 None 時不輸出"""
+
+    def __init__(self, name: str, help_text: str, fn: Callable[[], Optional[float]]):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            value = None
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        if value is not None:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        with self._lock:
+            # 同名指標重複註冊時沿用第一個 (例如模組重新載入、gauge 重新綁定)
+            if isinstance(metric, Gauge) or metric.name not in self._metrics:
+                self._metrics[metric.name] = metric
+            return self._metrics[metric.name]
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = STAGE_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, label_names, buckets))
+
+    def gauge(self, name: str, help_text: str, fn: Callable[[], Optional[float]]) -> Gauge:
+        return self._register(Gauge(name, help_text, fn))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "rag_stage_duration_seconds", "Latency of each RAG pipeline stage in seconds.", ["stage"]
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "rag_stage_errors_total", "Exceptions raised inside each RAG pipeline stage.", ["stage"]
+)
+EVENTS = REGISTRY.counter("rag_events_total", "RAG pipeline events such as answer cache hits.", ["event"])
+HTTP_REQUESTS = REGISTRY.counter("rag_http_requests_total", "HTTP requests by route and status.", ["route", "status"])
+HTTP_SECONDS = REGISTRY.histogram(
+    "rag_http_request_duration_seconds", "HTTP request handling time in seconds (until the response starts).",
+    ["route"]
+)
+
+
+# 目前請求的階段記錄 (profiling.StageTrace)，沒有啟用分析時為 None
+current_trace: ContextVar = ContextVar("rag_stage_trace", default=None)
+
+
+def observe(stage: str, seconds: float):
+    """記錄一次階段延遲 (秒)"""
+    if METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, stage)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.record(stage, time.perf_counter() - seconds, seconds)
+
+
+def event(name: str, amount: float = 1.0):
+    if METRICS_ENABLED:
+        EVENTS.inc(name, amount=amount)
+
+
+@contextmanager
+def timed(stage: str):
+    """量測區塊的執行時間；區塊拋出例外時另外計入 rag_stage_errors_total"""
+    trace = current_trace.get()
+    if not METRICS_ENABLED and trace is None:
+        yield
+        return
+    if trace is not None:
+        trace.enter()
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        if METRICS_ENABLED:
+            STAGE_ERRORS.inc(stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        if METRICS_ENABLED:
+            STAGE_SECONDS.observe(elapsed, stage)
+        if trace is not None:
+            trace.leave()
+            trace.record(stage, start, elapsed)
+
+
+def render() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,163 @@
+"""
+多向量 (父文檔) 模式
+每句原文是一份父文檔，它的變體 (倒裝句、問句、職位模板...) 只作為指向父文檔的向量:
+- 向量庫的 docstore 只存空內容的子文檔，父文檔內容只存一份 (parents.bin，與 docstore.bin 同格式、以 mmap 讀取)
+- 同一父文檔下幾乎相同的變體向量 (餘弦相似度 >= 門檻) 在建立索引時合併成一個
+- 檢索結果依父文檔去重，LLM 的 context 每句原文只出現一次
+向量位置 -> 父文檔列號存成 parent_map.npy；-1 表示該向量的文檔本身就是父文檔 (例如之後新增的文檔)
+"""
+import os
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from index_storage import ColumnarDocstore, encode_row, write_docstore
+
+
+MULTI_VECTOR = os.getenv("RAG_MULTI_VECTOR", "0") == "1"
+# 同一父文檔下的變體向量相似度達到門檻時只保留先出現的一個 (>= 1 表示不合併)
+VARIANT_COLLAPSE_THRESHOLD = float(os.getenv("RAG_VARIANT_COLLAPSE_THRESHOLD", "0.97"))
+# 依父文檔去重會減少結果數，檢索時多取幾倍的子向量
+PARENT_FETCH_FACTOR = int(os.getenv("RAG_PARENT_FETCH_FACTOR", "4"))
+
+PARENTS_FILE = "parents.bin"
+PARENT_MAP_FILE = "parent_map.npy"
+
+
+def collapse_near_duplicates(vectors: np.ndarray, group_sizes: Sequence[int],
+                             threshold: float = VARIANT_COLLAPSE_THRESHOLD) -> np.ndarray:
+    """
+    回傳要保留的向量 (bool 遮罩)：每組依序檢查，與組內已保留的向量相似度都低於門檻才保留
+    每組第一個 (原句) 一定保留；vectors 依組連續排列
+    """
+    keep = np.ones(len(vectors), dtype=bool)
+    if threshold >= 1.0 or len(vectors) == 0:
+        return keep
+    norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+    norms[norms == 0] = 1.0
+    unit = vectors / norms[:, None]
+    start = 0
+    for size in group_sizes:
+        if size > 1:
+            block = unit[start:start + size]
+            similar = (block @ block.T) >= threshold
+            kept = keep[start:start + size]
+            for j in range(1, size):
+                if similar[:j, j][kept[:j]].any():
+                    kept[j] = False
+        start += size
+    return keep
+
+
+class ParentStore:
+    """
+    父文檔與向量位置 -> 父文檔列號的對應
+    父文檔在建立索引後不再變更 (新增文檔各自是自己的父文檔)，只有對應表會隨新增向量增長
+    """
+
+    def __init__(self, docs=None, rows: Optional[np.ndarray] = None):
+        # List[Document] (剛建立) 或 ColumnarDocstore (保存/載入後)
+        self.docs = docs if docs is not None else []
+        self.rows = rows if rows is not None else np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return self.docs.count if isinstance(self.docs, ColumnarDocstore) else len(self.docs)
+
+    def document(self, row: int) -> Document:
+        if isinstance(self.docs, ColumnarDocstore):
+            return self.docs.row(row)
+        return self.docs[row]
+
+    def append_self(self, count: int):
+        """新增 count 個自成父文檔的向量 (需要在寫入鎖內呼叫)"""
+        if count:
+            self.rows = np.concatenate([self.rows, np.full(count, -1, dtype=np.int32)])
+
+    def dedupe(self, hits: List[Tuple[int, float]], limit: Optional[int] = None) -> List[Tuple[int, float]]:
+        """依父文檔去重，保留每份父文檔分數最高 (最先出現) 的向量位置"""
+        rows = self.rows
+        seen = set()
+        unique = []
+        for position, score in hits:
+            row = int(rows[position]) if position < len(rows) else -1
+            key = row if row >= 0 else -1 - position
+            if key in seen:
+                continue
+            seen.add(key)
+            unique.append((position, score))
+            if limit is not None and len(unique) >= limit:
+                break
+        return unique
+
+    def resolve(self, positions: Sequence[int], child_docs) -> List[Document]:
+        """向量位置 -> 父文檔；沒有父文檔的位置使用 child_docs(position) 取回的文檔本身"""
+        rows = self.rows
+        return [
+            self.document(int(rows[position])) if position < len(rows) and rows[position] >= 0
+            else child_docs(position)
+            for position in positions
+        ]
+
+    def copy(self) -> "ParentStore":
+        """快照用: 父文檔不會變更可直接共用，對應表複製一份"""
+        return ParentStore(self.docs, self.rows.copy())
+
+    def records(self):
+        if isinstance(self.docs, ColumnarDocstore):
+            yield from self.docs.raw_rows()
+        else:
+            for doc in self.docs:
+                yield encode_row(doc.id, doc)
+
+    def save(self, folder_path: str):
+        write_docstore(os.path.join(folder_path, PARENTS_FILE), self.records())
+        path = os.path.join(folder_path, PARENT_MAP_FILE)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, self.rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def reattach(self, folder_path: str):
+        """保存後改從新的 parents.bin 讀取父文檔，釋放記憶體中的副本 (需要在沒有寫入者的情況下呼叫)"""
+        self.docs = ColumnarDocstore(os.path.join(folder_path, PARENTS_FILE))
+
+    @classmethod
+    def load(cls, folder_path: str, vector_count: int) -> "ParentStore":
+        docs = ColumnarDocstore(os.path.join(folder_path, PARENTS_FILE))
+        # 對應表以唯讀映射開啟，新增向量時 append_self 才會複製到記憶體
+        rows = np.load(os.path.join(folder_path, PARENT_MAP_FILE), mmap_mode="r")
+        if len(rows) != vector_count:
+            docs.close()
+            raise ValueError(f"父文檔對應數 {len(rows)} 與向量數 {vector_count} 不一致: {folder_path}")
+        return cls(docs, rows if rows.dtype == np.int32 else rows.astype(np.int32))
+
+    @staticmethod
+    def exists(folder_path: str) -> bool:
+        return os.path.exists(os.path.join(folder_path, PARENTS_FILE))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"parents": len(self), "vectors": len(self.rows)}
+
+
+def build_parent_documents(groups: List[List[str]]) -> Tuple[List[Document], List[str], List[int]]:
+    """
+    由變體組建立父文檔，回傳 (父文檔, 攤平的變體文本, 每組變體數)
+    與前面的組完全相同的變體 (例如固定模板的問句) 只留給第一個父文檔，與單向量模式的全域去重一致
+    """
+    parents, texts, sizes = [], [], []
+    seen = set()
+    for i, group in enumerate(groups):
+        original = group[0]
+        parents.append(Document(
+            id=str(uuid.uuid4()),
+            page_content=original,
+            metadata={"index": i, "length": len(original), "type": "original"}
+        ))
+        fresh = [original] + [text for text in group[1:] if text not in seen]
+        seen.update(fresh)
+        texts += fresh
+        sizes.append(len(fresh))
+    return parents, texts, sizes
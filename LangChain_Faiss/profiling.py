@@ -0,0 +1,293 @@
+"""
+單一請求的效能分析 (請求標頭 X-RAG-Profile 或查詢參數 profile=... 啟用)
+- 階段分解: metrics.timed 量測的每個階段 (含執行緒池內的向量搜索) 記錄到該請求的 StageTrace
+- sample:   背景執行緒每隔 RAG_PROFILE_INTERVAL_MS 讀取一次請求相關執行緒的呼叫堆疊 (sys._current_frames)，
+            輸出 flamegraph.pl / speedscope 可讀的 folded stacks ("a;b;c 次數")，開銷與取樣間隔成正比
+- cprofile: 確定性分析 (cProfile)，只涵蓋請求執行緒，開銷較大，輸出累計時間最高的函數
+RAG_PROFILE_SAMPLE_RATE > 0 時隨機分析該比例的請求，結果只保存在記憶體 (/rag/profiles)，不附在回應中。
+預設關閉: 需要 RAG_PROFILE_ENABLED=1 才會分析請求或提供 /rag/profiles；
+設定 RAG_PROFILE_TOKEN 時，客戶端要求分析與讀取結果都必須帶上相同的 X-RAG-Profile-Token 標頭。
+"""
+import hmac
+import os
+import sys
+import time
+import uuid
+import random
+import cProfile
+import pstats
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+from metrics import current_trace
+
+
+PROFILE_ENABLED = os.getenv("RAG_PROFILE_ENABLED", "0") == "1"
+PROFILE_TOKEN = os.getenv("RAG_PROFILE_TOKEN") or None
+PROFILE_SAMPLE_RATE = float(os.getenv("RAG_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("RAG_PROFILE_INTERVAL_MS", "2"))
+PROFILE_KEEP = int(os.getenv("RAG_PROFILE_KEEP", "50"))
+PROFILE_TOP_FUNCTIONS = int(os.getenv("RAG_PROFILE_TOP_FUNCTIONS", "30"))
+
+PROFILE_MODES = ("sample", "cprofile")
+PROFILE_HEADER = "X-RAG-Profile"
+PROFILE_TOKEN_HEADER = "X-RAG-Profile-Token"
+
+
+class StageTrace:
+    """一個請求內各階段的開始時間與耗時，以及參與處理的執行緒"""
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self.stages: List[Dict[str, Any]] = []
+        # 請求執行緒一直取樣；其他執行緒 (例如向量搜索的執行緒池) 只在執行本請求的階段時取樣
+        self.owner = threading.get_ident()
+        self._active: Dict[int, int] = {}
+
+    def enter(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._active[ident] = self._active.get(ident, 0) + 1
+
+    def leave(self):
+        ident = threading.get_ident()
+        with self._lock:
+            depth = self._active.get(ident, 0) - 1
+            if depth > 0:
+                self._active[ident] = depth
+            else:
+                self._active.pop(ident, None)
+
+    def threads(self) -> List[int]:
+        with self._lock:
+            return [self.owner, *(ident for ident in self._active if ident != self.owner)]
+
+    def record(self, stage: str, start: float, seconds: float):
+        with self._lock:
+            self.stages.append({
+                "stage": stage,
+                "start_ms": (start - self.origin) * 1000,
+                "duration_ms": seconds * 1000,
+                "thread": threading.current_thread().name,
+            })
+
+    def breakdown(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = sorted(self.stages, key=lambda item: item["start_ms"])
+        totals: Dict[str, float] = {}
+        for item in stages:
+            totals[item["stage"]] = totals.get(item["stage"], 0.0) + item["duration_ms"]
+        return {"stages": stages, "stage_totals_ms": totals}
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """定期讀取指定執行緒的呼叫堆疊並累計相同堆疊的次數"""
+
+    def __init__(self, trace: StageTrace, interval_ms: float = PROFILE_INTERVAL_MS):
+        self.trace = trace
+        self.interval = max(interval_ms, 0.1) / 1000
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._labels: Dict[Any, str] = {}
+        self._stop = threading.Event()
+        self._own_ident = None
+        self._thread = threading.Thread(target=self._run, name="rag-profiler", daemon=True)
+
+    def _stack(self, frame) -> str:
+        labels = self._labels
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = _frame_label(code)
+            parts.append(label)
+            frame = frame.f_back
+        parts.reverse()
+        return ";".join(parts)
+
+    def _run(self):
+        self._own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident in self.trace.threads():
+                frame = frames.get(ident)
+                if frame is not None and ident != self._own_ident:
+                    self.stacks[self._stack(frame)] += 1
+                    self.samples += 1
+            del frames
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class RequestProfiler:
+    """分析一個請求；with 區塊內的階段與堆疊都會記錄下來"""
+
+    def __init__(self, mode: str = "sample", interval_ms: float = PROFILE_INTERVAL_MS, label: str = ""):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"不支援的分析模式: {mode}，可用: {', '.join(PROFILE_MODES)}")
+        self.mode = mode
+        self.interval_ms = interval_ms
+        self.label = label
+        self.id = uuid.uuid4().hex[:12]
+        self.trace = StageTrace()
+        self.sampler = None
+        self.profile = None
+        self.wall_ms = None
+        # 區塊結束後 maybe_profile 填入 report()
+        self.result = None
+        self._token = None
+        self._start = None
+
+    def __enter__(self) -> "RequestProfiler":
+        self._token = current_trace.set(self.trace)
+        self._start = time.perf_counter()
+        if self.mode == "sample":
+            self.sampler = StackSampler(self.trace, self.interval_ms)
+            self.sampler.start()
+        else:
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError:
+                # 同時只能有一個確定性分析器 (Python 3.12+)，改用取樣
+                self.profile = None
+                self.mode = "sample"
+                self.sampler = StackSampler(self.trace, self.interval_ms)
+                self.sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profile is not None:
+            self.profile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.wall_ms = (time.perf_counter() - self._start) * 1000
+        current_trace.reset(self._token)
+        return False
+
+    def top_functions(self, limit: int = PROFILE_TOP_FUNCTIONS) -> List[Dict[str, Any]]:
+        stats = pstats.Stats(self.profile)
+        rows = []
+        for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({
+                "function": f"{name} ({os.path.basename(filename)}:{line})",
+                "calls": ncalls,
+                "self_ms": tottime * 1000,
+                "cumulative_ms": cumtime * 1000,
+            })
+        rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+        return rows[:limit]
+
+    def report(self) -> Dict[str, Any]:
+        report = {
+            "id": self.id,
+            "label": self.label,
+            "mode": self.mode,
+            "created_at": datetime.now().isoformat(),
+            "wall_ms": self.wall_ms,
+            **self.trace.breakdown(),
+        }
+        if self.sampler is not None:
+            report["interval_ms"] = self.interval_ms
+            report["samples"] = self.sampler.samples
+            report["folded"] = self.sampler.folded()
+        else:
+            report["top_functions"] = self.top_functions()
+        return report
+
+
+class ProfileStore:
+    """最近的分析結果 (隨機取樣與主動要求的請求)"""
+
+    def __init__(self, keep: int = PROFILE_KEEP):
+        self._lock = threading.Lock()
+        self._reports = deque(maxlen=keep)
+
+    def add(self, report: Dict[str, Any]):
+        with self._lock:
+            self._reports.append(report)
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            for report in self._reports:
+                if report["id"] == profile_id:
+                    return report
+        return None
+
+    def summaries(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            reports = list(self._reports)
+        return [
+            {key: report.get(key) for key in ("id", "label", "mode", "created_at", "wall_ms", "samples")}
+            for report in reversed(reports)
+        ]
+
+
+PROFILE_STORE = ProfileStore()
+
+
+def requested_mode(header_value: Optional[str], query_value: Optional[str]) -> Optional[str]:
+    """解析標頭或查詢參數: 1/true/sample -> sample, cprofile -> cprofile，其餘視為未要求"""
+    for value in (header_value, query_value):
+        if not value:
+            continue
+        value = value.strip().lower()
+        if value in ("1", "true", "yes", "sample"):
+            return "sample"
+        if value == "cprofile":
+            return "cprofile"
+    return None
+
+
+def authorized(token_value: Optional[str]) -> bool:
+    """分析功能已啟用，且沒有設定 RAG_PROFILE_TOKEN 或請求帶上相同的 token"""
+    if not PROFILE_ENABLED:
+        return False
+    if PROFILE_TOKEN is None:
+        return True
+    return token_value is not None and hmac.compare_digest(token_value.encode("utf-8"), PROFILE_TOKEN.encode("utf-8"))
+
+
+def choose_mode(header_value: Optional[str], query_value: Optional[str], token_value: Optional[str] = None):
+    """
+    回傳 (分析模式或 None, 是否附在回應中)；主動要求 (需通過 authorized) 優先，
+    否則依 RAG_PROFILE_SAMPLE_RATE 隨機取樣
+    """
+    if not PROFILE_ENABLED:
+        return None, False
+    mode = requested_mode(header_value, query_value)
+    if mode is not None and authorized(token_value):
+        return mode, True
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "sample", False
+    return None, False
+
+
+@contextmanager
+def maybe_profile(mode: Optional[str], label: str = "") -> Iterator[Optional[RequestProfiler]]:
+    """mode 為 None 時不做任何事；否則分析區塊，結束後結果放在 profiler.result 並存入 PROFILE_STORE"""
+    if mode is None:
+        yield None
+        return
+    profiler = RequestProfiler(mode, label=label)
+    with profiler:
+        yield profiler
+    profiler.result = profiler.report()
+    PROFILE_STORE.add(profiler.result)
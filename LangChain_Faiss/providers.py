@@ -0,0 +1,118 @@
+"""
+嵌入模型與 LLM 後端的註冊表
+後端套件 (langchain_openai、langchain_ollama...) 只在實際建立該後端時才匯入，
+啟動時不會為沒有使用的後端付出匯入時間 (langchain_openai / langchain_ollama 各約 1 秒)。
+RAG_PROVIDER 可覆寫所有呼叫者選擇的後端，例如 RAG_PROVIDER=fake 使用 fake_backends 的離線替身 (啟動基準測試)。
+"""
+import os
+from typing import Any, Callable, Dict, Optional
+
+
+PROVIDER_OVERRIDE = os.getenv("RAG_PROVIDER") or None
+# Ollama 模型在最後一次呼叫後留在記憶體的時間 (秒數或 "30m"，-1 表示不卸載)；未設定時使用 Ollama 的預設 (5 分鐘)
+OLLAMA_KEEP_ALIVE = os.getenv("RAG_OLLAMA_KEEP_ALIVE") or None
+
+# 各後端未指定模型時的預設值
+DEFAULT_MODELS = {
+    "openai": {"embeddings": "text-embedding-3-small", "chat": "gpt-4o-mini"},
+    "ollama": {"embeddings": "llama3.2:latest", "chat": "llama3.2:latest"},
+    "fake": {"embeddings": "fake-embed", "chat": "fake-chat"},
+}
+
+
+def _openai_embeddings(model: str, **kwargs):
+    from langchain_openai import OpenAIEmbeddings
+    return OpenAIEmbeddings(model=model, **kwargs)
+
+
+def _openai_chat(model: str, **kwargs):
+    from langchain_openai import ChatOpenAI
+    kwargs.setdefault("temperature", 0)
+    return ChatOpenAI(model=model, **kwargs)
+
+
+def _keep_alive(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    if OLLAMA_KEEP_ALIVE is not None:
+        value = OLLAMA_KEEP_ALIVE
+        kwargs.setdefault("keep_alive", int(value) if value.lstrip("-").isdigit() else value)
+    return kwargs
+
+
+def _ollama_embeddings(model: str, **kwargs):
+    # 優先使用新的 ollama 包
+    try:
+        from langchain_ollama import OllamaEmbeddings
+    except ImportError:
+        # 舊版的 OllamaEmbeddings 不支援 keep_alive
+        from langchain_community.embeddings import OllamaEmbeddings
+        return OllamaEmbeddings(model=model, **kwargs)
+    return OllamaEmbeddings(model=model, **_keep_alive(kwargs))
+
+
+def _ollama_chat(model: str, **kwargs):
+    try:
+        from langchain_ollama import ChatOllama
+    except ImportError:
+        from langchain_community.chat_models import ChatOllama
+    return ChatOllama(model=model, **_keep_alive(kwargs))
+
+
+def _fake_embeddings(model: str, **kwargs):
+    from fake_backends import FakeEmbeddings
+    return FakeEmbeddings(model=model, **kwargs)
+
+
+def _fake_chat(model: str, **kwargs):
+    from fake_backends import FakeChatModel
+    return FakeChatModel(**kwargs)
+
+
+# 後端名稱 -> 建立函數 (model, **kwargs)，函數內才匯入後端套件
+EMBEDDING_PROVIDERS: Dict[str, Callable[..., Any]] = {
+    "openai": _openai_embeddings,
+    "ollama": _ollama_embeddings,
+    "fake": _fake_embeddings,
+}
+CHAT_PROVIDERS: Dict[str, Callable[..., Any]] = {
+    "openai": _openai_chat,
+    "ollama": _ollama_chat,
+    "fake": _fake_chat,
+}
+
+
+def register_provider(name: str, embeddings: Callable[..., Any] = None, chat: Callable[..., Any] = None,
+                      default_models: Optional[Dict[str, str]] = None):
+    """註冊新的後端；建立函數應在函數內匯入後端套件，保持啟動時不匯入"""
+    if embeddings is not None:
+        EMBEDDING_PROVIDERS[name] = embeddings
+    if chat is not None:
+        CHAT_PROVIDERS[name] = chat
+    if default_models:
+        DEFAULT_MODELS.setdefault(name, {}).update(default_models)
+
+
+def provider_name(use_openai: bool = False) -> str:
+    """use_openai 對應的後端名稱 (RAG_PROVIDER 優先)"""
+    return PROVIDER_OVERRIDE or ("openai" if use_openai else "ollama")
+
+
+def _resolve(registry: Dict[str, Callable[..., Any]], kind: str, provider: str, model: Optional[str]):
+    provider = PROVIDER_OVERRIDE or provider
+    factory = registry.get(provider)
+    if factory is None:
+        raise ValueError(f"不支援的後端: {provider}，可用: {', '.join(sorted(registry))}")
+    if model is None or PROVIDER_OVERRIDE:
+        model = DEFAULT_MODELS.get(provider, {}).get(kind, model)
+    return factory, model
+
+
+def create_embeddings(provider: str, model: Optional[str] = None, **kwargs):
+    """建立嵌入模型 (第一次建立某個後端時才匯入它的套件)"""
+    factory, model = _resolve(EMBEDDING_PROVIDERS, "embeddings", provider, model)
+    return factory(model, **kwargs)
+
+
+def create_chat_model(provider: str, model: Optional[str] = None, **kwargs):
+    """建立聊天模型 (第一次建立某個後端時才匯入它的套件)"""
+    factory, model = _resolve(CHAT_PROVIDERS, "chat", provider, model)
+    return factory(model, **kwargs)
@@ -0,0 +1,133 @@
+"""
+查詢正規化: 合併空白並把同義詞換成標準詞
+同義詞字典編譯成前綴表 (以雜湊表存放的 trie)，由左到右掃描一次，每個位置取最長的同義詞替換；
+正規化結果放在 LRU 快取，同一查詢在 ask/search 的多個階段重複呼叫時不再重算。
+
+同義詞檔案 (RAG_SYNONYMS_FILE):
+- .json: {"標準詞": ["同義詞", ...], ...}
+- 其他: 每行 "標準詞: 同義詞, 同義詞, ..."，# 開頭為註解
+"""
+import os
+import re
+import json
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional
+
+
+SYNONYMS_FILE = os.getenv("RAG_SYNONYMS_FILE", "")
+QUERY_CACHE_SIZE = int(os.getenv("RAG_QUERY_CACHE_SIZE", "10000"))
+
+# 沒有指定同義詞檔案時使用的內建字典
+DEFAULT_SYNONYMS: Dict[str, List[str]] = {
+    "總經理": ["總裁", "CEO", "執行長"],
+    "PM": ["專案經理", "項目經理", "產品經理"],
+    "是誰": ["是什麼人", "的身份"],
+    "做什麼": ["負責什麼", "的工作"],
+}
+
+_WHITESPACE = re.compile(r"\s+")
+# 前綴表中只是某個同義詞前綴 (本身不是同義詞) 的值
+_PREFIX_ONLY = ""
+
+
+def load_synonyms(path: str) -> Dict[str, List[str]]:
+    """讀取同義詞檔案，回傳 {標準詞: [同義詞, ...]}"""
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            return {key: list(values) for key, values in json.load(f).items()}
+
+    synonyms: Dict[str, List[str]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key, sep, values = line.partition(":")
+            if not sep or not key.strip():
+                raise ValueError(f"{path}:{line_no} 格式應為 '標準詞: 同義詞, 同義詞'")
+            synonyms.setdefault(key.strip(), []).extend(
+                value.strip() for value in values.split(",") if value.strip()
+            )
+    return synonyms
+
+
+class QueryNormalizer:
+    """單次掃描的同義詞替換 + LRU 快取"""
+
+    def __init__(self, synonyms: Optional[Dict[str, Iterable[str]]] = None, cache_size: int = QUERY_CACHE_SIZE):
+        synonyms = DEFAULT_SYNONYMS if synonyms is None else synonyms
+        # 前綴 -> 標準詞 (完整同義詞) 或 _PREFIX_ONLY
+        self._nodes: Dict[str, str] = {}
+        self.terms = 0
+        self.conflicts = 0
+        for canonical, values in synonyms.items():
+            if not canonical:
+                continue
+            # 標準詞本身也登記，避免它被其中較短的同義詞改寫
+            for term in [canonical, *values]:
+                self._add(term, canonical)
+        self.cache_size = cache_size
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    @classmethod
+    def from_env(cls) -> "QueryNormalizer":
+        if SYNONYMS_FILE:
+            return cls(load_synonyms(SYNONYMS_FILE))
+        return cls()
+
+    def _add(self, term: str, canonical: str):
+        if not term:
+            return
+        current = self._nodes.get(term)
+        if current:
+            # 同一個詞對應多個標準詞時以先出現的為準
+            if current != canonical:
+                self.conflicts += 1
+            return
+        self._nodes[term] = canonical
+        self.terms += 1
+        for end in range(1, len(term)):
+            self._nodes.setdefault(term[:end], _PREFIX_ONLY)
+
+    def rewrite(self, text: str) -> str:
+        """由左到右，每個位置替換最長的同義詞 (替換後的文字不會再被改寫)"""
+        nodes = self._nodes
+        parts = []
+        length = len(text)
+        start = i = 0
+        while i < length:
+            match_end = 0
+            canonical = None
+            j = i + 1
+            while j <= length:
+                value = nodes.get(text[i:j])
+                if value is None:
+                    break
+                if value:
+                    match_end, canonical = j, value
+                j += 1
+            if canonical is None:
+                i += 1
+                continue
+            parts.append(text[start:i])
+            parts.append(canonical)
+            start = i = match_end
+        if not parts:
+            return text
+        parts.append(text[start:])
+        return "".join(parts)
+
+    def _normalize(self, query: str) -> str:
+        return self.rewrite(_WHITESPACE.sub(" ", query.strip()))
+
+    def stats(self) -> Dict[str, Any]:
+        info = self.normalize.cache_info()
+        return {
+            "terms": self.terms,
+            "prefixes": len(self._nodes),
+            "conflicts": self.conflicts,
+            "cache_size": self.cache_size,
+            "cache_entries": info.currsize,
+            "cache_hits": info.hits,
+            "cache_misses": info.misses,
+        }
@@ -1,7 +1,10 @@
+import sys
 import json
 import time
 from typing import List, Dict, Any
+import numpy as np
 from improved_rag import ImprovedRAG
+from vector_index import build_faiss_index, apply_search_params, index_memory_bytes, rescore_memory_bytes
 from tabulate import tabulate
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -9,8 +12,15 @@ import seaborn as sns
 
 class RAGEvaluator:
     def __init__(self):
-        self.rag = ImprovedRAG(use_openai=False)
+        self._rag = None
         self.test_results = []
+    
+    @property
+    def rag(self) -> ImprovedRAG:
+        """第一次使用時才建立 RAG (只比較 FAISS 索引的離線評估不需要 embedding / LLM 後端)"""
+        if self._rag is None:
+            self._rag = ImprovedRAG(use_openai=False)
+        return self._rag
         
     def setup_test_data(self):
         """設置測試數據"""
@@ -288,10 +298,189 @@ class RAGEvaluator:
         print(f"📁 評估結果已保存到: {filename}")
 
 
+    def evaluate_index_tradeoff(self, corpus_size: int = 20000, num_queries: int = 200, k: int = 5,
+                                index_types=("flat", "ivf_flat", "ivf_pq", "hnsw", "sq_fp16", "sq_int8"),
+                                nprobe_values=(1, 4, 16, 64), ef_search_values=(16, 64, 256),
+                                embeddings=None) -> List[Dict[str, Any]]:
+        """比較不同索引類型的召回率、查詢延遲與記憶體，以精確 flat 搜尋的結果為基準"""
+        from benchmark_suite import generate_corpus, generate_queries
+        import faiss
+        
+        print(f"🚀 開始索引類型評估 (語料 {corpus_size} 句, 查詢 {num_queries} 個, k={k})...")
+        embeddings = embeddings or self.rag.embeddings
+        
+        vectors = np.asarray(embeddings.embed_documents(generate_corpus(corpus_size)), dtype=np.float32)
+        query_vectors = np.asarray(embeddings.embed_documents(generate_queries(num_queries)), dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        faiss.normalize_L2(query_vectors)
+        
+        # 精確搜尋的結果作為召回率基準
+        baseline, _ = build_faiss_index(vectors, "flat")
+        _, truth = baseline.search(query_vectors, k)
+        
+        results = []
+        for index_type in index_types:
+            build_start = time.time()
+            index, params = build_faiss_index(vectors, index_type)
+            build_time = time.time() - build_start
+            
+            # IVF 掃描不同 nprobe，HNSW 掃描不同 efSearch
+            if params["index_type"] in ("ivf_flat", "ivf_pq"):
+                settings = [{"nprobe": n} for n in nprobe_values]
+            elif params["index_type"] == "hnsw":
+                settings = [{"ef_search": ef} for ef in ef_search_values]
+            else:
+                settings = [{}]
+            
+            for setting in settings:
+                apply_search_params(index, {**params, **setting})
+                results.append({
+                    "index_type": params["index_type"],
+                    "requested_type": index_type,
+                    "setting": setting,
+                    **self._measure_search(index, query_vectors, truth, k),
+                    "memory_mb": index_memory_bytes(index) / (1024 * 1024),
+                    "build_time": build_time
+                })
+        
+        self.index_tradeoff_results = results
+        return results
+    
+    @staticmethod
+    def _measure_search(index, query_vectors: np.ndarray, truth: np.ndarray, k: int) -> Dict[str, float]:
+        """逐一查詢，回傳相對於 truth (精確搜尋結果) 的 Recall@k 與延遲"""
+        latencies = []
+        found = []
+        for query_vector in query_vectors:
+            start = time.perf_counter()
+            _, ids = index.search(query_vector.reshape(1, -1), k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append(ids[0])
+        
+        recall = float(np.mean([
+            len(set(f.tolist()) & set(t.tolist())) / k for f, t in zip(found, truth)
+        ]))
+        latencies.sort()
+        return {
+            "recall_at_k": recall,
+            "avg_latency_ms": sum(latencies) / len(latencies),
+            "p95_latency_ms": latencies[int(len(latencies) * 0.95) - 1],
+        }
+    
+    def evaluate_quantization(self, corpus_size: int = 20000, num_queries: int = 200, k: int = 5,
+                              variants=(("sq_fp16", 0), ("sq_int8", 0), ("sq_int8", 4), ("sq_fp16", 4)),
+                              embeddings=None) -> List[Dict[str, Any]]:
+        """
+        比較量化向量儲存 (float16 / int8，可選精確重算) 與 float32 精確搜尋的記憶體與召回率
+        variants 為 (索引類型, rescore_factor)；memory_mb 為索引總大小 (含精確重算用的 float32 向量)，
+        rescore_mb 另外列出其中 float32 重算向量的部分 (以 mmap 讀取時只有候選所在的頁面常駐)
+        """
+        from benchmark_suite import generate_corpus, generate_queries
+        import faiss
+        
+        print(f"🚀 開始量化儲存評估 (語料 {corpus_size} 句, 查詢 {num_queries} 個, k={k})...")
+        embeddings = embeddings or self.rag.embeddings
+        
+        vectors = np.asarray(embeddings.embed_documents(generate_corpus(corpus_size)), dtype=np.float32)
+        query_vectors = np.asarray(embeddings.embed_documents(generate_queries(num_queries)), dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        faiss.normalize_L2(query_vectors)
+        
+        baseline, _ = build_faiss_index(vectors, "flat")
+        _, truth = baseline.search(query_vectors, k)
+        baseline_mb = index_memory_bytes(baseline) / (1024 * 1024)
+        
+        results = [{
+            "index_type": "flat", "rescore_factor": 0,
+            **self._measure_search(baseline, query_vectors, truth, k),
+            "memory_mb": baseline_mb, "rescore_mb": 0.0, "build_time": 0.0
+        }]
+        for index_type, rescore_factor in variants:
+            build_start = time.time()
+            index, params = build_faiss_index(vectors, index_type, {"rescore_factor": rescore_factor})
+            build_time = time.time() - build_start
+            rescore_mb = rescore_memory_bytes(index) / (1024 * 1024)
+            results.append({
+                "index_type": params["index_type"],
+                "rescore_factor": params["rescore_factor"],
+                **self._measure_search(index, query_vectors, truth, k),
+                "memory_mb": index_memory_bytes(index) / (1024 * 1024),
+                "rescore_mb": rescore_mb,
+                "build_time": build_time
+            })
+        
+        for r in results:
+            r["memory_saved_mb"] = baseline_mb - r["memory_mb"]
+            r["memory_saved_pct"] = r["memory_saved_mb"] / baseline_mb * 100 if baseline_mb else 0.0
+            r["recall_change"] = r["recall_at_k"] - results[0]["recall_at_k"]
+        
+        self.quantization_results = results
+        return results
+    
+    def print_quantization(self, results: List[Dict[str, Any]]):
+        """打印量化儲存相對於 float32 的記憶體節省與召回率變化"""
+        print("\n" + "="*80)
+        print("🗜️ 量化向量儲存 記憶體 / 召回率 (基準: float32 精確搜尋)")
+        print("="*80)
+        
+        table = [
+            [
+                r["index_type"],
+                f"{r['rescore_factor']}x" if r["rescore_factor"] else "-",
+                f"{r['memory_mb']:.2f}",
+                f"{r['memory_saved_mb']:.2f} ({r['memory_saved_pct']:.0f}%)",
+                f"{r['rescore_mb']:.2f}" if r["rescore_mb"] else "-",
+                f"{r['recall_at_k']:.3f}",
+                f"{r['recall_change']:+.3f}",
+                f"{r['avg_latency_ms']:.3f}",
+                f"{r['p95_latency_ms']:.3f}"
+            ]
+            for r in results
+        ]
+        print(tabulate(table, headers=["索引類型", "精確重算", "記憶體(MB)", "節省(MB)", "其中重算向量(MB, mmap)",
+                                       "Recall@k", "Recall變化", "平均延遲(ms)", "p95延遲(ms)"], tablefmt="grid"))
+    
+    def print_index_tradeoff(self, results: List[Dict[str, Any]]):
+        """打印索引類型的召回率/延遲取捨"""
+        print("\n" + "="*80)
+        print("📐 索引類型 召回率 / 延遲 / 記憶體 取捨")
+        print("="*80)
+        
+        table = [
+            [
+                r["index_type"],
+                ", ".join(f"{key}={value}" for key, value in r["setting"].items()) or "-",
+                f"{r['recall_at_k']:.3f}",
+                f"{r['avg_latency_ms']:.3f}",
+                f"{r['p95_latency_ms']:.3f}",
+                f"{r['memory_mb']:.2f}",
+                f"{r['build_time']:.2f}秒"
+            ]
+            for r in results
+        ]
+        print(tabulate(table, headers=["索引類型", "參數", "Recall@k", "平均延遲(ms)", "p95延遲(ms)", "記憶體(MB)", "建立時間"], tablefmt="grid"))
+
+
 def main():
     """主函數"""
     evaluator = RAGEvaluator()
     
+    # 索引類型評估 (使用離線 fake embedding，不需要 Ollama): python rag_evaluator.py --index-tradeoff
+    if "--index-tradeoff" in sys.argv:
+        from fake_backends import FakeEmbeddings
+        results = evaluator.evaluate_index_tradeoff(embeddings=FakeEmbeddings(dim=64))
+        evaluator.print_index_tradeoff(results)
+        return
+    
+    # 量化儲存評估 (離線): python rag_evaluator.py --quantization [維度]
+    if "--quantization" in sys.argv:
+        from fake_backends import FakeEmbeddings
+        position = sys.argv.index("--quantization") + 1
+        dim = int(sys.argv[position]) if position < len(sys.argv) and sys.argv[position].isdigit() else 256
+        results = evaluator.evaluate_quantization(embeddings=FakeEmbeddings(dim=dim))
+        evaluator.print_quantization(results)
+        return
+    
     # 運行評估
     results = evaluator.run_evaluation()
     
@@ -0,0 +1,176 @@
+"""
+向量化的候選文檔重新排序
+一次對整批候選文檔計分 (NumPy)，不再對每份文檔逐詞做子字串搜尋:
+- 向量相似度: 從 FAISS 索引取回已存的向量 (reconstruct)，不重新嵌入文檔
+- 詞彙重疊: 查詢詞在關鍵詞索引倒排表中的命中 (以 idf 加權)
+- metadata 先驗: type == "original" 的原句加分
+"""
+import os
+import math
+import threading
+from itertools import repeat
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+from index_storage import ColumnarIdMap
+from keyword_index import KeywordIndex, tokenize
+
+
+RERANK_VECTOR_WEIGHT = float(os.getenv("RAG_RERANK_VECTOR_WEIGHT", "0.6"))
+RERANK_LEXICAL_WEIGHT = float(os.getenv("RAG_RERANK_LEXICAL_WEIGHT", "0.3"))
+RERANK_ORIGINAL_BOOST = float(os.getenv("RAG_RERANK_ORIGINAL_BOOST", "0.1"))
+
+
+class PositionCache:
+    """
+    文檔 id -> 向量位置，以及各位置的 metadata 先驗 (是否為原句)
+    欄式文檔庫 (mmap) 中的文檔位置即向量位置，直接在檔案的 id 排序表上二分搜尋；
+    記憶體中的文檔建立反查表，索引新增向量後只補上新增的部分。
+    先驗在第一次看到該位置的文檔時記下，之後重新排序不必再讀文檔的 metadata。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._id_map = None
+        self._columnar = None
+        self._positions: Dict[str, int] = {}
+        self._synced = 0
+        # -1: 尚未看過, 0/1: 是否為原句
+        self.original = np.full(0, -1, dtype=np.int8)
+
+    def _sync(self, id_map):
+        with self._lock:
+            if id_map is not self._id_map:
+                self._id_map = id_map
+                self._columnar = id_map.docstore if isinstance(id_map, ColumnarIdMap) else None
+                self._positions = {}
+                self._synced = self._columnar.count if self._columnar is not None else 0
+                self.original = np.full(0, -1, dtype=np.int8)
+            total = len(id_map)
+            for position in range(self._synced, total):
+                self._positions[id_map[position]] = position
+            self._synced = max(self._synced, total)
+            if len(self.original) < total:
+                self.original = np.concatenate([
+                    self.original, np.full(total - len(self.original), -1, dtype=np.int8)
+                ])
+
+    def sync(self, vector_db):
+        """索引替換或新增向量後更新反查表與先驗陣列"""
+        id_map = vector_db.index_to_docstore_id
+        if id_map is not self._id_map or len(id_map) != self._synced:
+            self._sync(id_map)
+
+    def lookup(self, vector_db, doc_ids: List[Optional[str]]) -> np.ndarray:
+        """回傳各 id 的向量位置，找不到的為 -1"""
+        self.sync(vector_db)
+        found = np.fromiter(map(self._positions.get, doc_ids, repeat(-1)), dtype=np.int64, count=len(doc_ids))
+        columnar = self._columnar
+        if columnar is not None:
+            for i in np.flatnonzero(found < 0):
+                doc_id = doc_ids[i]
+                position = columnar.position_of(doc_id) if doc_id is not None else None
+                if position is not None:
+                    # 記下二分搜尋的結果，常被檢索到的文檔之後直接查表
+                    found[i] = self._positions[doc_id] = position
+        return found
+
+    def original_flags(self, candidate_docs: List[Document], positions: np.ndarray) -> np.ndarray:
+        """各候選文檔是否為原句；沒看過的位置才讀 metadata"""
+        original = self.original
+        valid = (positions >= 0) & (positions < len(original))
+        flags = np.full(len(positions), -1, dtype=np.int8)
+        flags[valid] = original[positions[valid]]
+        for i in np.flatnonzero(flags < 0):
+            flags[i] = candidate_docs[i].metadata.get("type") == "original"
+            if valid[i]:
+                original[positions[i]] = flags[i]
+        return flags.astype(bool)
+
+
+class VectorReranker:
+    """整批計分的重新排序器: 向量相似度 + 詞彙重疊 + metadata 先驗"""
+
+    def __init__(self, vector_weight: float = RERANK_VECTOR_WEIGHT,
+                 lexical_weight: float = RERANK_LEXICAL_WEIGHT,
+                 original_boost: float = RERANK_ORIGINAL_BOOST):
+        self.vector_weight = vector_weight
+        self.lexical_weight = lexical_weight
+        self.original_boost = original_boost
+        self.positions = PositionCache()
+
+    def stored_vectors(self, vector_db, positions: np.ndarray) -> Optional[np.ndarray]:
+        """從索引取回已存的向量 (找不到位置的為零向量)；索引不支援 reconstruct 時回傳 None"""
+        valid = positions >= 0
+        try:
+            if valid.all():
+                return vector_db.index.reconstruct_batch(positions)
+            vectors = np.zeros((len(positions), vector_db.index.d), dtype=np.float32)
+            if valid.any():
+                vectors[valid] = vector_db.index.reconstruct_batch(positions[valid])
+            return vectors
+        except RuntimeError:
+            return None
+
+    @staticmethod
+    def vector_scores(query_vector, vectors: np.ndarray, normalized: bool = False) -> np.ndarray:
+        """餘弦相似度；normalized 表示索引內的向量已正規化 (normalize_L2)，只需除以查詢向量長度"""
+        query = np.asarray(query_vector, dtype=np.float32)
+        query_norm = float(np.sqrt(query @ query)) or 1.0
+        if normalized:
+            return vectors @ query / query_norm
+        norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors)) * query_norm
+        norms[norms == 0] = 1.0
+        return vectors @ query / norms
+
+    @staticmethod
+    def lexical_scores(keyword_index: KeywordIndex, query: str, positions: np.ndarray) -> np.ndarray:
+        """查詢詞命中比例，以 idf 加權後正規化到 0~1"""
+        scores = np.zeros(len(positions), dtype=np.float32)
+        doc_count = len(keyword_index)
+        if doc_count == 0:
+            return scores
+        total_weight = 0.0
+        for term in set(tokenize(query)):
+            term_positions, _ = keyword_index.postings_for(term)
+            df = len(term_positions)
+            idf = math.log((doc_count - df + 0.5) / (df + 0.5) + 1.0)
+            total_weight += idf
+            if df:
+                scores[np.isin(positions, term_positions)] += idf
+        if total_weight > 0:
+            scores /= total_weight
+        return scores
+
+    def score(self, vector_db, keyword_index: Optional[KeywordIndex], candidate_docs: List[Document],
+              query: str, query_vector=None, positions: Optional[np.ndarray] = None) -> np.ndarray:
+        """positions: 檢索時已知的向量位置 (與 candidate_docs 對應)，省略時由文檔 id 反查"""
+        if positions is None:
+            positions = self.positions.lookup(vector_db, [doc.id for doc in candidate_docs])
+        else:
+            self.positions.sync(vector_db)
+        scores = np.zeros(len(candidate_docs), dtype=np.float32)
+
+        if query_vector is not None and self.vector_weight:
+            vectors = self.stored_vectors(vector_db, positions)
+            if vectors is not None:
+                normalized = getattr(vector_db, "_normalize_L2", False)
+                scores += self.vector_weight * self.vector_scores(query_vector, vectors, normalized)
+
+        if keyword_index is not None and self.lexical_weight:
+            scores += self.lexical_weight * self.lexical_scores(keyword_index, query, positions)
+
+        if self.original_boost:
+            scores[self.positions.original_flags(candidate_docs, positions)] += self.original_boost
+        return scores
+
+    def rerank(self, vector_db, keyword_index: Optional[KeywordIndex], candidate_docs: List[Document],
+               query: str, query_vector=None, positions: Optional[np.ndarray] = None) -> List[Document]:
+        """回傳依分數由高到低排序的全部候選文檔 (同分時保留檢索順序)"""
+        if not candidate_docs:
+            return []
+        scores = self.score(vector_db, keyword_index, candidate_docs, query, query_vector, positions)
+        order = np.argsort(-scores, kind="stable")
+        return [candidate_docs[i] for i in order]
@@ -0,0 +1,80 @@
+"""
+讀寫鎖
+多個讀者可以同時持有讀鎖；寫者獨佔，且有寫者在等待時新的讀者會先排隊，避免寫者餓死。
+不可重入：持有讀鎖時不要再取讀鎖或寫鎖。
+"""
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict
+
+
+class RWLock:
+    """寫者優先的讀寫鎖"""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+        self.read_acquisitions = 0
+        self.write_acquisitions = 0
+        self.read_waits = 0
+
+    def acquire_read(self):
+        with self._cond:
+            if self._writer or self._waiting_writers:
+                self.read_waits += 1
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+            self.read_acquisitions += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+            self.write_acquisitions += 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "active_readers": self._readers,
+                "writer_active": self._writer,
+                "waiting_writers": self._waiting_writers,
+                "read_acquisitions": self.read_acquisitions,
+                "write_acquisitions": self.write_acquisitions,
+                "reads_blocked_by_writer": self.read_waits,
+            }
@@ -0,0 +1,343 @@
+"""
+生產環境服務模式
+- WorkerPool: 有上限的 embedding / LLM 工作池，排隊已滿時立即回 429，排隊逾時回 503
+- BoundedASGIApp: 以 ASGI (uvicorn) 非同步處理連線，重的 RAG 路由交給 WorkerPool 執行
+"""
+import os
+import sys
+import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
+from typing import Any, Callable, Dict, Tuple
+
+from asgiref.sync import AsyncToSync
+
+
+class ServiceOverloaded(Exception):
+    """工作池無法接受請求：排隊已滿 (429) 或排隊逾時 (503)"""
+
+    def __init__(self, message: str, status_code: int = 429, retry_after: int = 1):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"success": False, "error": str(self), "retry_after": self.retry_after}
+
+
+class WorkerPool:
+    """
+    有上限的工作池
+    最多 max_workers 個工作同時執行，另外最多 max_queue 個在排隊，
+    超過的請求不等待直接拒絕，在排隊中超過 queue_timeout 秒的請求也會被拒絕。
+    """
+
+    def __init__(self, max_workers: int = 4, max_queue: int = 32, queue_timeout: float = 30.0,
+                 name: str = "rag-worker"):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._admission = threading.BoundedSemaphore(max_workers + max_queue)
+        self._workers = threading.BoundedSemaphore(max_workers)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _admit(self):
+        if not self._admission.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise ServiceOverloaded("伺服器忙碌中，排隊已滿，請稍後再試", status_code=429)
+        with self._lock:
+            self.queued += 1
+
+    def _leave_queue(self):
+        with self._lock:
+            self.queued -= 1
+
+    def _finish(self, ran: bool):
+        with self._lock:
+            if ran:
+                self.in_flight -= 1
+                self.completed += 1
+        self._admission.release()
+
+    def _timeout(self):
+        with self._lock:
+            self.timed_out += 1
+        return ServiceOverloaded("伺服器忙碌中，排隊逾時，請稍後再試", status_code=503,
+                                 retry_after=max(1, int(self.queue_timeout)))
+
+    @contextmanager
+    def slot(self):
+        """在呼叫者的執行緒佔用一個工作名額 (用於同步伺服器與串流回應)"""
+        self._admit()
+        acquired = self._workers.acquire(timeout=self.queue_timeout)
+        self._leave_queue()
+        if not acquired:
+            self._finish(ran=False)
+            raise self._timeout()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            self._workers.release()
+            self._finish(ran=True)
+
+    def run(self, fn: Callable, *args, **kwargs):
+        """在工作名額內同步執行 fn"""
+        with self.slot():
+            return fn(*args, **kwargs)
+
+    async def run_async(self, fn: Callable, *args):
+        """
+        在背景執行緒池執行 fn，事件迴圈不會被阻塞；排隊超過 queue_timeout 時回 503
+        還在排隊時被取消 (客戶端斷線、關閉服務) 的工作不會執行；已經開始的工作跑完後自己釋放名額
+        """
+        self._admit()
+        state = {"started": False, "cancelled": False}
+        state_lock = threading.Lock()
+
+        def task():
+            with state_lock:
+                if state["cancelled"]:
+                    return None
+                state["started"] = True
+            self._leave_queue()
+            self._workers.acquire()
+            with self._lock:
+                self.in_flight += 1
+            try:
+                return fn(*args)
+            finally:
+                self._workers.release()
+                self._finish(ran=True)
+
+        def cancel_if_queued() -> bool:
+            """還沒開始時標記取消並釋放排隊名額，回傳是否取消成功"""
+            with state_lock:
+                if state["started"] or state["cancelled"]:
+                    return False
+                state["cancelled"] = True
+            self._leave_queue()
+            self._finish(ran=False)
+            return True
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, task)
+        try:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if cancel_if_queued():
+                    raise self._timeout()
+                return await future
+        except asyncio.CancelledError:
+            cancel_if_queued()
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queue_timeout": self.queue_timeout,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+            }
+
+
+def pool_from_env(prefix: str = "RAG") -> WorkerPool:
+    """依環境變數建立工作池: RAG_WORKERS, RAG_QUEUE_DEPTH, RAG_QUEUE_TIMEOUT"""
+    return WorkerPool(
+        max_workers=int(os.getenv(f"{prefix}_WORKERS", "4")),
+        max_queue=int(os.getenv(f"{prefix}_QUEUE_DEPTH", "32")),
+        queue_timeout=float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", "30")),
+    )
+
+
+class _WsgiRequest:
+    """
+    單一 HTTP 請求的 WSGI 轉接器：自行建立 environ、處理 start_response，
+    並在指定執行緒 (工作池或輕量執行緒池) 執行 WSGI 應用，回應逐塊串流送回 ASGI。
+    """
+
+    def __init__(self, wsgi_app, scope, send):
+        self.wsgi_app = wsgi_app
+        self.scope = scope
+        self.sync_send = AsyncToSync(send)
+        self.response_start = None
+        self.response_started = False
+
+    def build_environ(self, body) -> Dict[str, Any]:
+        scope = self.scope
+        root_path = scope.get("root_path", "")
+        path = scope["path"]
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": root_path.encode("utf8").decode("latin1"),
+            "PATH_INFO": path.encode("utf8").decode("latin1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        server = scope.get("server") or ("localhost", 80)
+        environ["SERVER_NAME"] = server[0]
+        environ["SERVER_PORT"] = str(server[1] or 0)
+        if scope.get("client"):
+            environ["REMOTE_ADDR"] = scope["client"][0]
+            environ["REMOTE_PORT"] = str(scope["client"][1])
+
+        for raw_name, raw_value in scope.get("headers", []):
+            name = raw_name.decode("latin1").lower()
+            value = raw_value.decode("latin1")
+            if name == "content-type":
+                key = "CONTENT_TYPE"
+            elif name == "content-length":
+                key = "CONTENT_LENGTH"
+            else:
+                key = "HTTP_" + name.upper().replace("-", "_")
+            # 重複的標頭依 RFC 7230 以逗號合併
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def start_response(self, status: str, response_headers, exc_info=None):
+        if exc_info and self.response_started:
+            raise exc_info[1].with_traceback(exc_info[2])
+        self.response_start = {
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [(name.lower().encode("latin1"), value.encode("latin1"))
+                        for name, value in response_headers],
+        }
+        return self.write
+
+    def write(self, data: bytes):
+        self._send_start()
+        self.sync_send({"type": "http.response.body", "body": data, "more_body": True})
+
+    def _send_start(self):
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+
+    def run(self, body):
+        """在目前執行緒執行 WSGI 應用 (由工作池呼叫)"""
+        response = self.wsgi_app(self.build_environ(body), self.start_response)
+        try:
+            for output in response:
+                if output:
+                    self.write(output)
+        finally:
+            if hasattr(response, "close"):
+                response.close()
+        self._send_start()
+        self.sync_send({"type": "http.response.body"})
+
+    @staticmethod
+    async def read_body(receive, body):
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                raise ValueError("WSGI adapter received a non-HTTP-request message")
+            body.write(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body.seek(0)
+
+
+# 需要 embedding / LLM 的路由
+POOLED_ROUTES = ("/rag/ask", "/rag/search", "/rag/add_document", "/rag/add_documents", "/ask/")
+
+
+class BoundedASGIApp:
+    """
+    ASGI 入口
+    pooled_prefixes 內的路由 (embedding / LLM) 交給有上限的 WorkerPool；
+    其他輕量路由 (狀態、健康檢查) 使用獨立的小型執行緒池，在高負載時仍能回應。
+    """
+
+    def __init__(self, wsgi_app, pool: WorkerPool, pooled_prefixes: Tuple[str, ...] = POOLED_ROUTES,
+                 light_workers: int = 4):
+        self.wsgi_app = wsgi_app
+        self.pool = pool
+        self.pooled_prefixes = pooled_prefixes
+        self._light_executor = ThreadPoolExecutor(max_workers=light_workers, thread_name_prefix="rag-light")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        request = _WsgiRequest(self.wsgi_app, scope, send)
+        with SpooledTemporaryFile(max_size=65536) as body:
+            await request.read_body(receive, body)
+
+            if scope["path"].startswith(self.pooled_prefixes):
+                try:
+                    await self.pool.run_async(request.run, body)
+                except ServiceOverloaded as e:
+                    await self._send_overloaded(send, e)
+            else:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self._light_executor, request.run, body)
+
+    @staticmethod
+    async def _send_overloaded(send, error: ServiceOverloaded):
+        payload = json.dumps(error.to_dict(), ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": error.status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"retry-after", str(error.retry_after).encode("ascii")),
+                (b"content-length", str(len(payload)).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+
+def serve_production(app, pool: WorkerPool, host: str = "0.0.0.0", port: int = 5000, **kwargs):
+    """以 uvicorn 啟動 (關閉 debug)，重的路由經過有上限的工作池"""
+    import uvicorn
+
+    asgi_app = BoundedASGIApp(app, pool, **kwargs)
+    # 連線數上限：超過時 uvicorn 直接回 503，避免無上限地累積等待中的連線
+    max_connections = int(os.getenv("RAG_MAX_CONNECTIONS", str((pool.max_workers + pool.max_queue) * 4)))
+    print(f"🚀 生產模式啟動: workers={pool.max_workers}, queue={pool.max_queue}, "
+          f"queue_timeout={pool.queue_timeout}s, max_connections={max_connections}")
+    uvicorn.run(
+        asgi_app,
+        host=host,
+        port=port,
+        limit_concurrency=max_connections,
+        timeout_keep_alive=5,
+        log_level=os.getenv("RAG_LOG_LEVEL", "info"),
+    )
@@ -0,0 +1,199 @@
+"""
+ImprovedRAG 並發讀寫壓力測試 (離線，使用 fake_backends，不需要 Ollama)
+以 Flask test client 同時送出 /rag/search 與 /rag/add_document，並在背景寫快照，檢查:
+- 沒有請求失敗
+- 任何時刻讀到的 FAISS 向量數、docstore 與關鍵詞索引文檔數一致
+- 結束後每份新增的文檔都能以關鍵詞找回，重新載入索引後數量不變
+
+用法:
+    python stress_test.py --readers 8 --writers 2 --duration 10
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from typing import Dict, List
+
+from tabulate import tabulate
+
+# RAG 實例由壓力測試自己建立 (install_rag)，匯入 API 模組時不要在背景載入預設索引
+os.environ.setdefault("RAG_AUTOSTART", "0")
+
+import improved_rag
+import improved_flask_api
+from improved_rag import ImprovedRAG
+from fake_backends import FakeEmbeddings, FakeChatModel
+from benchmark_suite import generate_corpus, generate_queries, percentile
+
+
+def create_rag(args) -> ImprovedRAG:
+    return ImprovedRAG(
+        embeddings=FakeEmbeddings(dim=args.dim, latency_ms=args.embed_latency_ms),
+        llm=FakeChatModel(),
+        use_embedding_cache=False,
+        multi_vector=args.multi_vector,
+    )
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {"search": [], "add_document": []}
+        self.errors: List[str] = []
+        self.added: List[str] = []
+
+    def record(self, kind: str, latency_ms: float):
+        with self.lock:
+            self.latencies[kind].append(latency_ms)
+
+    def error(self, message: str):
+        with self.lock:
+            self.errors.append(message)
+
+
+def reader(client, queries: List[str], stop: threading.Event, recorder: Recorder):
+    i = 0
+    while not stop.is_set():
+        query = queries[i % len(queries)]
+        i += 1
+        start = time.perf_counter()
+        response = client.post("/rag/search", json={"query": query, "top_k": 3})
+        recorder.record("search", (time.perf_counter() - start) * 1000)
+        data = response.get_json()
+        if response.status_code != 200 or not data.get("success"):
+            recorder.error(f"search {response.status_code}: {data}")
+        elif any(not isinstance(doc.get("content"), str) for doc in data["documents"]):
+            recorder.error(f"search 回傳不完整的文檔: {data['documents']}")
+
+
+def writer(client, writer_id: int, stop: threading.Event, recorder: Recorder):
+    n = 0
+    while not stop.is_set():
+        content = f"壓測員工W{writer_id}N{n}是XQ{writer_id}Z{n}部門的工程師。"
+        n += 1
+        start = time.perf_counter()
+        response = client.post("/rag/add_document", json={"content": content})
+        recorder.record("add_document", (time.perf_counter() - start) * 1000)
+        if response.status_code != 200 or not response.get_json().get("success"):
+            recorder.error(f"add_document {response.status_code}: {response.get_json()}")
+        else:
+            with recorder.lock:
+                recorder.added.append(content)
+
+
+def checker(rag: ImprovedRAG, stop: threading.Event, recorder: Recorder, counter: Dict[str, int]):
+    """持續在讀鎖內比對三個結構的文檔數"""
+    while not stop.is_set():
+        counts = rag.index_counts()
+        counter["checks"] += 1
+        if len(set(counts.values())) != 1:
+            recorder.error(f"狀態不一致: {counts}")
+        time.sleep(0.001)
+
+
+def stop_snapshots(rag: ImprovedRAG):
+    """停止背景快照，等進行中的快照寫完"""
+    rag._closed = True
+    rag._snapshot_event.set()
+    if rag._snapshot_thread is not None:
+        rag._snapshot_thread.join()
+
+
+def run(args) -> bool:
+    work_dir = tempfile.mkdtemp(prefix="rag_stress_")
+    index_path = os.path.join(work_dir, "index")
+    improved_rag.SNAPSHOT_EVERY_DOCS = args.snapshot_every
+
+    rag = create_rag(args)
+    rag.setup_documents(generate_corpus(args.corpus_size))
+    rag.save_index(index_path)
+    improved_flask_api.install_rag(rag)
+    initial = rag.vector_db.index.ntotal
+
+    recorder = Recorder()
+    counter = {"checks": 0}
+    stop = threading.Event()
+    queries = generate_queries(200)
+    threads = [
+        threading.Thread(target=reader, args=(improved_flask_api.app.test_client(), queries, stop, recorder))
+        for _ in range(args.readers)
+    ] + [
+        threading.Thread(target=writer, args=(improved_flask_api.app.test_client(), w, stop, recorder))
+        for w in range(args.writers)
+    ] + [threading.Thread(target=checker, args=(rag, stop, recorder, counter))]
+
+    print(f"🔥 壓力測試: {args.readers} 個讀者, {args.writers} 個寫者, {args.duration} 秒")
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    # 之後的檢查不加鎖，重新載入與刪除目錄時也不能有快照在寫
+    stop_snapshots(rag)
+
+    # 每份新增文檔都要能以關鍵詞找回
+    missing = []
+    for content in recorder.added:
+        hits = rag.keyword_index.search(content, k=1)
+        doc = rag.vector_db.docstore.search(rag.vector_db.index_to_docstore_id[hits[0][0]]) if hits else None
+        if doc is None or doc.page_content != content:
+            missing.append(content)
+
+    # 重新載入 (快照 + 日誌重放) 後數量應該相同
+    final_counts = rag.index_counts()
+    rag.close_wal()
+    reloaded = create_rag(args)
+    reloaded.load_index(index_path)
+    reloaded_counts = reloaded.index_counts()
+    stop_snapshots(reloaded)
+    reloaded.close_wal()
+    persistence = rag.persistence_stats()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    rows = []
+    for kind, samples in recorder.latencies.items():
+        values = sorted(samples)
+        rows.append([
+            kind, len(values), f"{len(values) / args.duration:.1f}",
+            f"{percentile(values, 50):.2f}", f"{percentile(values, 95):.2f}", f"{percentile(values, 99):.2f}"
+        ])
+    print(tabulate(rows, headers=["請求", "次數", "每秒", "p50(ms)", "p95(ms)", "p99(ms)"], tablefmt="grid"))
+    print(f"📊 新增文檔: {len(recorder.added)} 份, 向量: {initial} -> {final_counts['vectors']}, "
+          f"一致性檢查: {counter['checks']} 次, 背景快照: {persistence['snapshots']} 次")
+    print(f"🔒 讀寫鎖: {rag.concurrency_stats()}")
+
+    ok = True
+    if recorder.errors:
+        ok = False
+        print(f"❌ {len(recorder.errors)} 個錯誤，例如: {recorder.errors[:3]}")
+    if missing:
+        ok = False
+        print(f"❌ {len(missing)} 份新增文檔找不到，例如: {missing[:3]}")
+    if reloaded_counts != final_counts:
+        ok = False
+        print(f"❌ 重新載入後數量不同: {final_counts} -> {reloaded_counts}")
+    if ok:
+        print("✅ 並發讀寫一致，沒有錯誤")
+    return ok
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ImprovedRAG 並發讀寫壓力測試")
+    parser.add_argument("--readers", type=int, default=8, help="並行 /rag/search 的執行緒數")
+    parser.add_argument("--writers", type=int, default=2, help="並行 /rag/add_document 的執行緒數")
+    parser.add_argument("--duration", type=float, default=10.0, help="測試秒數")
+    parser.add_argument("--corpus-size", type=int, default=500, help="初始語料句數")
+    parser.add_argument("--dim", type=int, default=64, help="fake embedding 維度")
+    parser.add_argument("--embed-latency-ms", type=float, default=1.0, help="每次 embedding 呼叫的模擬延遲")
+    parser.add_argument("--multi-vector", action="store_true", help="使用父文檔 (多向量) 模式")
+    parser.add_argument("--snapshot-every", type=int, default=50, help="每新增幾份文檔觸發背景快照")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(parse_args()) else 1)
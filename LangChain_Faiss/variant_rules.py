@@ -0,0 +1,338 @@
+"""
+宣告式的文本變體規則引擎
+規則只描述「句型 -> 模板」，VariantEngine 編譯一次後重複使用:
+- 所有關鍵詞合併成一個多模式正則，一次掃描找出句子中出現的全部關鍵詞 (包含互相重疊的關鍵詞)
+- 變體逐批輸出，跨批次去重最多只記住固定數量的文本，記憶體不隨語料增長
+- 句子數量很大時分塊交給進程池並行展開
+"""
+import os
+import re
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+from string import Formatter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+VARIANT_WORKERS = int(os.getenv("RAG_VARIANT_WORKERS", str(os.cpu_count() or 1)))
+VARIANT_PARALLEL_MIN = int(os.getenv("RAG_VARIANT_PARALLEL_MIN", "50000"))
+VARIANT_CHUNK_SIZE = int(os.getenv("RAG_VARIANT_CHUNK_SIZE", "5000"))
+VARIANT_DEDUP_CAPACITY = int(os.getenv("RAG_VARIANT_DEDUP_CAPACITY", "1000000"))
+
+
+# ImprovedRAG.enhance_text_variants 的規則
+IMPROVED_RAG_RULES: Dict[str, Any] = {
+    "strip": "。，；,.;!?！?",
+    "strip_whitespace": False,
+    "skip_empty": False,
+    "split_rules": [
+        {
+            # 「A是B」句型
+            "separator": "是",
+            "templates": ["{right}是{left}。"],
+            "templates_if_both": [
+                "{left}是誰？",
+                "{left}是什麼？",
+                "誰是{right}？",
+                "什麼是{left}？",
+                "{right}的身份是什麼？",
+                "{left}的職位是什麼？",
+            ],
+        },
+    ],
+    "keyword_rules": [
+        {
+            # 職位/身份句型，name 為關鍵詞前面的第一個詞
+            "keywords": ["經理", "PM", "總監", "主管", "負責人", "工程師"],
+            "capture_name": True,
+            "templates": ["{name}的職位是什麼？", "誰是{keyword}？", "{keyword}是誰？"],
+        },
+        {
+            # 技術/工具句型
+            "keywords": ["框架", "資料庫", "工具", "技術", "平台"],
+            "templates": ["什麼是{keyword}？", "如何使用{keyword}？", "{keyword}的用途是什麼？"],
+        },
+    ],
+}
+
+# LangChainTool.generate_variants 的規則
+LANGCHAIN_TOOL_RULES: Dict[str, Any] = {
+    "strip": "。；；,.;!?！？、",
+    "strip_whitespace": True,
+    "skip_empty": True,
+    "split_rules": [
+        {
+            "separator": "是",
+            "templates_if_both": [
+                "{right}是{left}。",
+                "誰是{right}？是{left}。",
+                "{left}是誰？是{right}。",
+                "{right}是什麼？是{left}。",
+            ],
+        },
+    ],
+    "keyword_rules": [],
+}
+
+
+def compile_template(template: str, fields: Tuple[str, ...]) -> Callable[..., str]:
+    """
+    檢查 "{right}是{left}。" 之類的模板只使用 fields 中的欄位 (不支援格式規格)，
+    回傳依 fields 順序接收位置參數、以 str.format 填入的函數
+    """
+    for _, field, spec, conversion in Formatter().parse(template):
+        if field is not None and (field not in fields or spec or conversion):
+            raise ValueError(f"模板 {template!r} 只能使用欄位 {fields}")
+    render = template.format
+
+    def apply(*values: str) -> str:
+        return render(**dict(zip(fields, values)))
+    return apply
+
+
+def _overlapping(keywords: List[str]) -> bool:
+    """是否有關鍵詞的後綴是另一個關鍵詞的前綴 (此時一般的正則掃描會漏掉後者)"""
+    for a in keywords:
+        for b in keywords:
+            if a != b and any(a.endswith(b[:size]) for size in range(1, min(len(a), len(b)))):
+                return True
+    return False
+
+
+class BoundedDedup:
+    """
+    跨批次去重，最多記住約 capacity 個文本；超過時整批淘汰最早記錄的批次
+    (被淘汰的文本之後再出現會再輸出一次)
+    """
+
+    def __init__(self, capacity: int = VARIANT_DEDUP_CAPACITY):
+        self.capacity = max(1, capacity)
+        self._seen = set()
+        self._batches = deque()
+
+    def filter(self, texts: List[str]) -> List[str]:
+        """回傳 texts 中之前沒見過的文本 (依第一次出現的順序)"""
+        seen = self._seen
+        fresh = [text for text in dict.fromkeys(texts) if text not in seen]
+        seen.update(fresh)
+        self._batches.append(fresh)
+        while len(seen) > self.capacity and len(self._batches) > 1:
+            seen.difference_update(self._batches.popleft())
+        return fresh
+
+
+class VariantEngine:
+    """把規則編譯成一個多模式比對器，展開句子的變體"""
+
+    def __init__(self, rules: Dict[str, Any], workers: int = VARIANT_WORKERS,
+                 parallel_min: int = VARIANT_PARALLEL_MIN, chunk_size: int = VARIANT_CHUNK_SIZE,
+                 dedup_capacity: int = VARIANT_DEDUP_CAPACITY):
+        self.rules = rules
+        self.workers = workers
+        self.parallel_min = parallel_min
+        self.chunk_size = max(1, chunk_size)
+        self.dedup_capacity = dedup_capacity
+
+        # 清理前後標點: 等同 re.sub(^[\s標點]+|[\s標點]+$)，用 str.strip 比正則快
+        self._strip_chars = rules.get("strip", "")
+        self._strip_whitespace = rules.get("strip_whitespace", False)
+        self._skip_empty = rules.get("skip_empty", False)
+        self._split_rules = [
+            (
+                rule["separator"],
+                [compile_template(t, ("left", "right")) for t in rule.get("templates", [])],
+                [compile_template(t, ("left", "right")) for t in rule.get("templates_if_both", [])],
+            )
+            for rule in rules.get("split_rules", [])
+        ]
+
+        # 關鍵詞 -> [(取名用的正則, 含 {name} 的模板, 只跟關鍵詞有關、預先展開好的變體)]
+        self._keyword_rules: Dict[str, List[Tuple[Optional[re.Pattern], List[Callable[..., str]], List[str]]]] = {}
+        for rule in rules.get("keyword_rules", []):
+            name_templates = [compile_template(t, ("name", "keyword")) for t in rule["templates"] if "{name}" in t]
+            fixed_templates = [t for t in rule["templates"] if "{name}" not in t]
+            for keyword in rule["keywords"]:
+                name_pattern = re.compile(rf"(\w+).*?{re.escape(keyword)}") if rule.get("capture_name") else None
+                fixed = [t.format(keyword=keyword) for t in fixed_templates]
+                self._keyword_rules.setdefault(keyword, []).append((name_pattern, name_templates, fixed))
+
+        # 所有關鍵詞合併成一個正則 (長的優先)，一次掃描找出句中的關鍵詞；
+        # 較短且被包含的關鍵詞由 _contained 補上，關鍵詞互相交疊時改用前瞻在每個位置比對
+        keywords = sorted(self._keyword_rules, key=len, reverse=True)
+        alternation = "|".join(map(re.escape, keywords))
+        if not keywords:
+            self._matcher = None
+        elif _overlapping(keywords):
+            self._matcher = re.compile(f"(?=({alternation}))")
+        else:
+            self._matcher = re.compile(alternation)
+        self._contained = {}
+        for keyword in keywords:
+            inner = [other for other in keywords if other != keyword and other in keyword]
+            if inner:
+                self._contained[keyword] = inner
+
+    def _clean(self, text: str) -> str:
+        chars = self._strip_chars
+        if not self._strip_whitespace:
+            return text.strip(chars)
+        while True:
+            stripped = text.strip().strip(chars)
+            if stripped == text:
+                return text
+            text = stripped
+
+    def _keywords_in(self, matches: List[str]) -> Iterable[str]:
+        """補上被包含的較短關鍵詞並去重 (依出現位置排序)"""
+        if self._contained:
+            matches += [inner for keyword in matches for inner in self._contained.get(keyword, ())]
+        return dict.fromkeys(matches)
+
+    def expand(self, text: str) -> List[str]:
+        """回傳一句的所有變體，第一個是清理後的原句 (清理後為空且規則要求略過時回傳空列表)；可能含重複"""
+        if self._strip_whitespace:
+            sentence = self._clean(text)
+        else:
+            sentence = text.strip(self._strip_chars)
+        if self._skip_empty and not sentence:
+            return []
+        variants = [sentence]
+
+        for separator, templates, templates_if_both in self._split_rules:
+            if separator not in sentence:
+                continue
+            left, right = sentence.split(separator, 1)
+            left, right = left.strip(), right.strip()
+            for template in templates:
+                variants.append(template(left, right))
+            if left and right:
+                for template in templates_if_both:
+                    variants.append(template(left, right))
+
+        if self._matcher is not None:
+            matches = self._matcher.findall(sentence)
+            if len(matches) > 1 or self._contained:
+                matches = self._keywords_in(matches)
+            for keyword in matches:
+                for name_pattern, name_templates, fixed in self._keyword_rules[keyword]:
+                    if name_pattern is not None:
+                        match = name_pattern.search(sentence)
+                        if not match:
+                            continue
+                        name = match.group(1)
+                        for template in name_templates:
+                            variants.append(template(name, keyword))
+                    variants.extend(fixed)
+        return variants
+
+    def expand_chunk(self, texts: List[str], dedup: bool = False) -> Tuple[List[str], set]:
+        """展開一批句子，回傳 (變體, 其中屬於原句的集合)；dedup 時先在批次內去重 (減少進程間傳輸)"""
+        variants = []
+        originals = set()
+        for text in texts:
+            expanded = self.expand(text)
+            if expanded:
+                originals.add(expanded[0])
+                variants += expanded
+        if dedup:
+            variants = list(dict.fromkeys(variants))
+        return variants, originals
+
+    def expand_groups_chunk(self, texts: List[str]) -> List[List[str]]:
+        """展開一批句子，每句回傳一組去重後的變體 (第一個是清理後的原句)，清理後為空的句子略過"""
+        groups = []
+        for text in texts:
+            expanded = self.expand(text)
+            if expanded:
+                groups.append(list(dict.fromkeys(expanded)))
+        return groups
+
+    def _chunks(self, texts: Iterable[str]) -> Iterator[List[str]]:
+        iterator = iter(texts)
+        while True:
+            chunk = list(islice(iterator, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def _expand_parallel(self, texts: Iterable[str], workers: int, worker: Callable = None) -> Iterator[Any]:
+        # 呼叫端通常是多執行緒的服務進程 (快照、批次器、執行緒池)，fork 可能讓子進程繼承被持有的鎖而卡住；
+        # forkserver 從單執行緒的伺服進程分出子進程，不支援時用 spawn。子進程只需要本模組與規則
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(self.rules,)) as pool:
+            # 同時最多 2 * workers 個批次在處理，輸入與輸出都不會整批堆在記憶體
+            pending = deque()
+            for chunk in self._chunks(texts):
+                pending.append(pool.submit(worker or _expand_worker_chunk, chunk))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _expanded(self, texts: Iterable[str], workers: Optional[int], expand_chunk: Callable,
+                  worker: Callable) -> Iterator[Any]:
+        """逐批展開，texts 的數量達到 parallel_min 且 workers > 1 時交給進程池 (worker 為子進程執行的函數)"""
+        workers = self.workers if workers is None else workers
+        if hasattr(texts, "__len__"):
+            large = len(texts) >= self.parallel_min
+        else:
+            # 長度未知時先讀 parallel_min 句，讀完了就不必開進程池
+            iterator = iter(texts)
+            head = list(islice(iterator, self.parallel_min))
+            large = len(head) == self.parallel_min
+            texts = chain(head, iterator) if large else head
+
+        if workers > 1 and large:
+            return self._expand_parallel(texts, workers, worker)
+        return map(expand_chunk, self._chunks(texts))
+
+    def _fresh_batches(self, texts: Iterable[str], workers: Optional[int]) -> Iterator[Tuple[List[str], set]]:
+        seen = BoundedDedup(self.dedup_capacity)
+        for variants, originals in self._expanded(texts, workers, self.expand_chunk, _expand_worker_chunk):
+            yield seen.filter(variants), originals
+
+    def iter_variants(self, texts: Iterable[str], workers: Optional[int] = None) -> Iterator[Tuple[str, bool]]:
+        """
+        逐一產生去重後的 (變體, 是否為清理後的原句)，順序為第一次出現的順序
+        texts 的數量達到 parallel_min 且 workers > 1 時使用進程池
+        """
+        for fresh, originals in self._fresh_batches(texts, workers):
+            yield from zip(fresh, map(originals.__contains__, fresh))
+
+    def iter_groups(self, texts: Iterable[str], workers: Optional[int] = None) -> Iterator[List[str]]:
+        """
+        逐句產生一組變體 (第一個是清理後的原句，組內去重)，供多向量模式把變體掛在同一份父文檔下
+        原句與前面的句子重複時整組略過
+        """
+        seen = BoundedDedup(self.dedup_capacity)
+        for groups in self._expanded(texts, workers, self.expand_groups_chunk, _expand_worker_groups):
+            fresh = set(seen.filter([group[0] for group in groups]))
+            for group in groups:
+                if group[0] in fresh:
+                    fresh.discard(group[0])
+                    yield group
+
+    def variants(self, texts: Iterable[str], workers: Optional[int] = None) -> List[str]:
+        results = []
+        for fresh, _ in self._fresh_batches(texts, workers):
+            results += fresh
+        return results
+
+
+_worker_engine: Optional[VariantEngine] = None
+
+
+def _init_worker(rules: Dict[str, Any]):
+    global _worker_engine
+    _worker_engine = VariantEngine(rules, workers=1)
+
+
+def _expand_worker_chunk(texts: List[str]) -> Tuple[List[str], set]:
+    return _worker_engine.expand_chunk(texts, dedup=True)
+
+
+def _expand_worker_groups(texts: List[str]) -> List[List[str]]:
+    return _worker_engine.expand_groups_chunk(texts)
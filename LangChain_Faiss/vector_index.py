@@ -0,0 +1,199 @@
+"""
+可選擇的 FAISS 索引類型
+- flat:     精確搜尋 (IndexFlatL2)
+- ivf_flat: 倒排分桶 + 原始向量，搜尋 nprobe 個桶
+- ivf_pq:   倒排分桶 + 乘積量化，向量壓縮成 m 個位元組
+- hnsw:     圖索引，搜尋寬度由 efSearch 控制
+- sq_fp16:  純量量化，每維存成 float16 (記憶體為 float32 的 1/2)
+- sq_int8:  純量量化，每維依訓練出的數值範圍存成 1 個位元組 (記憶體為 float32 的 1/4)
+向量先做 L2 正規化再用 L2 距離搜尋 (等效於 Cosine)。
+量化索引 (sq_fp16 / sq_int8 / ivf_pq) 可設定 rescore_factor: 先取 k * rescore_factor 個候選，
+再以另外保存的 float32 向量精確重算距離。float32 向量以 mmap 讀取，只有候選所在的頁面會被讀入，
+每次查詢都會完整掃描的只有量化後的向量。
+索引參數保存在索引目錄的 index_config.json，載入時重新套用 nprobe / efSearch / rescore_factor。
+"""
+import os
+import json
+import math
+import uuid
+from typing import Any, Dict, List, Optional
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "sq_fp16", "sq_int8")
+# 有損壓縮向量的索引類型 (可以精確重算)
+QUANTIZED_TYPES = ("ivf_pq", "sq_fp16", "sq_int8")
+SQ_TYPES = {"sq_fp16": faiss.ScalarQuantizer.QT_fp16, "sq_int8": faiss.ScalarQuantizer.QT_8bit}
+INDEX_CONFIG_FILE = "index_config.json"
+
+DEFAULT_INDEX_PARAMS = {
+    "nlist": None,            # IVF 桶數，None 時依資料量自動決定 (約 4 * sqrt(n))
+    "nprobe": 8,              # IVF 搜尋的桶數
+    "pq_m": 16,               # PQ 子向量數 (會調整成維度的因數)
+    "pq_nbits": 8,            # 每個子向量的位元數
+    "hnsw_m": 32,             # HNSW 每個節點的鄰居數
+    "ef_construction": 200,   # HNSW 建圖時的搜尋寬度
+    "ef_search": 64,          # HNSW 查詢時的搜尋寬度
+    "sq_quantile": 0.0,       # int8 每維的數值範圍: 0 為樣本的最小 / 最大值，0.001 表示去掉兩端各 0.1% 的離群值
+    "rescore_factor": 0,      # 量化索引取 k * rescore_factor 個候選後以 float32 精確重算，0 表示不重算
+    "train_sample": 100000,   # 訓練使用的最大樣本數
+    "min_train_size": 1024,   # 向量數少於此值時 IVF / PQ 退回精確搜尋
+}
+
+
+def resolve_params(index_params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    params = dict(DEFAULT_INDEX_PARAMS)
+    params.update(index_params or {})
+    return params
+
+
+def _auto_nlist(count: int) -> int:
+    # FAISS 建議每個桶至少 39 個訓練向量
+    return max(1, min(int(4 * math.sqrt(count)), count // 39))
+
+
+def _pq_m(dim: int, requested: int) -> int:
+    """PQ 子向量數必須整除維度，取不超過 requested 的最大因數"""
+    for m in range(min(requested, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def _train_sample(vectors: np.ndarray, params: Dict[str, Any]) -> np.ndarray:
+    count = len(vectors)
+    if count <= params["train_sample"]:
+        return vectors
+    rng = np.random.default_rng(0)
+    return vectors[rng.choice(count, params["train_sample"], replace=False)]
+
+
+def effective_index_type(index_type: str, count: int, params: Dict[str, Any]) -> str:
+    """資料量太少時 IVF / PQ 無法有效訓練，退回精確搜尋"""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不支援的索引類型: {index_type}，可用: {', '.join(INDEX_TYPES)}")
+    if index_type in ("ivf_flat", "ivf_pq") and count < params["min_train_size"]:
+        return "flat"
+    return index_type
+
+
+def build_faiss_index(vectors: np.ndarray, index_type: str, index_params: Optional[Dict[str, Any]] = None):
+    """建立並訓練索引 (vectors 需已正規化)，回傳 (索引, 實際使用的參數)"""
+    params = resolve_params(index_params)
+    count, dim = vectors.shape
+    index_type = effective_index_type(index_type, count, params)
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["hnsw_m"])
+        index.hnsw.efConstruction = params["ef_construction"]
+    elif index_type in SQ_TYPES:
+        index = faiss.IndexScalarQuantizer(dim, SQ_TYPES[index_type], faiss.METRIC_L2)
+        if params["sq_quantile"]:
+            index.sq.rangestat = faiss.ScalarQuantizer.RS_quantiles
+            index.sq.rangestat_arg = float(params["sq_quantile"])
+        # int8 在樣本上訓練每一維的數值範圍 (float16 不需要訓練)
+        index.train(_train_sample(vectors, params))
+    else:
+        nlist = params["nlist"] or _auto_nlist(count)
+        params["nlist"] = nlist
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_L2)
+        else:
+            params["pq_m"] = _pq_m(dim, params["pq_m"])
+            # PQ 每個子量化器需要至少 2^nbits 個訓練向量
+            params["pq_nbits"] = min(params["pq_nbits"], max(1, int(math.log2(count))))
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, params["pq_m"], params["pq_nbits"])
+
+        # 在樣本上訓練分桶 (與量化器)
+        index.train(_train_sample(vectors, params))
+        # MMR 與重排需要 reconstruct，IVF 要有直接映射
+        index.make_direct_map()
+
+    if index_type in QUANTIZED_TYPES and params["rescore_factor"]:
+        # 另外保存 float32 向量，搜尋結果以精確距離重新排序 (重排與 MMR 的 reconstruct 也取得原始向量)
+        index = faiss.IndexRefineFlat(index)
+    else:
+        params["rescore_factor"] = 0
+    index.add(vectors)
+    params["index_type"] = index_type
+    apply_search_params(index, params)
+    return index, params
+
+
+def apply_search_params(index, params: Dict[str, Any]):
+    """套用查詢時參數 (IVF 的 nprobe、HNSW 的 efSearch、精確重算的候選倍數)"""
+    if isinstance(index, faiss.IndexRefine):
+        index.k_factor = float(max(1, params["rescore_factor"]))
+        index = faiss.downcast_index(index.base_index)
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        ivf.nprobe = int(params["nprobe"])
+    except RuntimeError:
+        pass
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = int(params["ef_search"])
+
+
+def build_vector_store(docs: List[Document], embeddings, index_type: str,
+                       index_params: Optional[Dict[str, Any]] = None):
+    """以指定索引類型建立 LangChain FAISS 向量庫，回傳 (向量庫, 實際使用的參數)"""
+    vectors = embeddings.embed_documents([doc.page_content for doc in docs])
+    return build_vector_store_from_vectors(docs, vectors, embeddings, index_type, index_params)
+
+
+def build_vector_store_from_vectors(docs: List[Document], vectors, embeddings, index_type: str,
+                                    index_params: Optional[Dict[str, Any]] = None):
+    """同 build_vector_store，但使用已計算好的向量 (與 docs 一一對應)"""
+    vectors = np.array(vectors, dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    index, params = build_faiss_index(vectors, index_type, index_params)
+
+    ids = [doc.id or str(uuid.uuid4()) for doc in docs]
+    docstore = InMemoryDocstore({
+        id_: Document(id=id_, page_content=doc.page_content, metadata=doc.metadata)
+        for id_, doc in zip(ids, docs)
+    })
+    vector_db = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=dict(enumerate(ids)),
+        normalize_L2=True,
+        distance_strategy=DistanceStrategy.EUCLIDEAN_DISTANCE,
+    )
+    return vector_db, params
+
+
+def index_memory_bytes(index) -> int:
+    """索引序列化後的大小，近似常駐記憶體用量 (含精確重算用的 float32 向量)"""
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def rescore_memory_bytes(index) -> int:
+    """精確重算用的 float32 向量大小 (以 mmap 讀取時只有候選所在的頁面常駐)；沒有重算時為 0"""
+    if not isinstance(index, faiss.IndexRefine):
+        return 0
+    return int(index.ntotal) * int(index.d) * 4
+
+
+def save_index_config(folder_path: str, config: Dict[str, Any]):
+    os.makedirs(folder_path, exist_ok=True)
+    with open(os.path.join(folder_path, INDEX_CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+
+def load_index_config(folder_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(folder_path, INDEX_CONFIG_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,233 @@
+"""
+索引變更的預寫日誌 (write-ahead log)
+新增文檔時只把 (id, 內容, metadata, 向量) 追加到日誌，不再重寫整個索引；
+完整索引由背景快照定期寫出，載入時先讀快照再重放快照之後的日誌。
+
+- 每筆記錄: 長度 + CRC32 + 序號 + JSON，載入時遇到寫到一半的尾端記錄會截掉
+- group commit: 同時等待持久化的寫入者共用一次 fsync
+- 日誌分段存放，快照完成後刪除快照已涵蓋的分段
+"""
+import os
+import json
+import time
+import base64
+import struct
+import zlib
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+WAL_GROUP_COMMIT_MS = float(os.getenv("RAG_WAL_GROUP_COMMIT_MS", "0"))
+WAL_FSYNC = os.getenv("RAG_WAL_FSYNC", "1") != "0"
+
+# 快照目錄中記錄快照涵蓋到哪個日誌序號
+SNAPSHOT_MANIFEST_FILE = "snapshot.json"
+
+# 記錄標頭: 內容長度、CRC32、序號
+_RECORD_HEADER = struct.Struct("<IIQ")
+_SEGMENT_PREFIX = "wal-"
+_SEGMENT_SUFFIX = ".log"
+
+
+def wal_dir_for(index_path: str) -> str:
+    """日誌放在索引目錄旁邊 (快照會整個替換索引目錄)"""
+    return os.path.normpath(index_path) + ".wal"
+
+
+def save_snapshot_manifest(folder_path: str, manifest: Dict[str, Any]):
+    """寫入後 fsync：快照資訊遺失或是空檔時，重放會重複加入快照已涵蓋的向量"""
+    path = os.path.join(folder_path, SNAPSHOT_MANIFEST_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def load_snapshot_manifest(folder_path: str) -> Dict[str, Any]:
+    """沒有快照資訊的索引目錄視為涵蓋到序號 0 (重放全部日誌)"""
+    try:
+        with open(os.path.join(folder_path, SNAPSHOT_MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"wal_seq": 0}
+
+
+def encode_vector(vector) -> str:
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def decode_vector(data: str) -> List[float]:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32).tolist()
+
+
+class WriteAheadLog:
+    """分段的追加式日誌，序號從 1 開始遞增"""
+
+    def __init__(self, directory: str, group_commit_ms: float = WAL_GROUP_COMMIT_MS, fsync: bool = WAL_FSYNC):
+        self.directory = directory
+        self.group_commit_ms = group_commit_ms
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._sync_cond = threading.Condition()
+        self._syncing = False
+
+        self.last_seq = self._recover()
+        self.durable_seq = self.last_seq
+        self._file = open(self._segment_path(self.last_seq + 1), "ab")
+
+        self.appends = 0
+        self.bytes_written = 0
+        self.fsyncs = 0
+        self.total_fsync_ms = 0.0
+
+    def _segment_path(self, first_seq: int) -> str:
+        return os.path.join(self.directory, f"{_SEGMENT_PREFIX}{first_seq:012d}{_SEGMENT_SUFFIX}")
+
+    def _segments(self) -> List[Tuple[int, str]]:
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX):
+                first_seq = int(name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)])
+                segments.append((first_seq, os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    @staticmethod
+    def _read_segment(path: str) -> Iterator[Tuple[int, int, Dict[str, Any]]]:
+        """逐筆讀取，回傳 (序號, 記錄結束位置, 內容)；遇到不完整或 CRC 不符的記錄即停止"""
+        with open(path, "rb") as f:
+            offset = 0
+            while True:
+                header = f.read(_RECORD_HEADER.size)
+                if len(header) < _RECORD_HEADER.size:
+                    return
+                length, crc, seq = _RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return
+                offset += _RECORD_HEADER.size + length
+                yield seq, offset, json.loads(payload.decode("utf-8"))
+
+    def _recover(self) -> int:
+        """找出最後一個完整記錄的序號，截掉最後一段尾端寫到一半的記錄"""
+        segments = self._segments()
+        last_seq = 0
+        for i, (first_seq, path) in enumerate(segments):
+            valid_end = 0
+            for seq, end, _ in self._read_segment(path):
+                last_seq, valid_end = seq, end
+            if i == len(segments) - 1 and os.path.getsize(path) > valid_end:
+                with open(path, "r+b") as f:
+                    f.truncate(valid_end)
+            if last_seq == 0 and first_seq > 1:
+                last_seq = first_seq - 1
+        return last_seq
+
+    def replay(self, after_seq: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """依序回傳序號大於 after_seq 的記錄"""
+        for _, path in self._segments():
+            for seq, _, record in self._read_segment(path):
+                if seq > after_seq:
+                    yield seq, record
+
+    def append(self, record: Dict[str, Any]) -> int:
+        """寫入一筆記錄 (只寫到 OS 緩衝區)，回傳序號；呼叫 wait_durable(序號) 等待落盤"""
+        payload = json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+        with self._lock:
+            seq = self.last_seq + 1
+            self._file.write(_RECORD_HEADER.pack(len(payload), zlib.crc32(payload), seq) + payload)
+            self._file.flush()
+            self.last_seq = seq
+            self.appends += 1
+            self.bytes_written += _RECORD_HEADER.size + len(payload)
+        return seq
+
+    def wait_durable(self, seq: Optional[int]):
+        """group commit: 第一個等待者負責 fsync，期間到達的寫入者等下一輪一起落盤"""
+        if seq is None:
+            return
+        with self._sync_cond:
+            while self.durable_seq < seq:
+                if self._syncing:
+                    self._sync_cond.wait()
+                    continue
+                self._syncing = True
+                self._sync_cond.release()
+                try:
+                    if self.group_commit_ms > 0:
+                        time.sleep(self.group_commit_ms / 1000)
+                    target = self._sync()
+                finally:
+                    self._sync_cond.acquire()
+                    self._syncing = False
+                self.durable_seq = max(self.durable_seq, target)
+                self._sync_cond.notify_all()
+
+    def _sync(self) -> int:
+        with self._lock:
+            target = self.last_seq
+            # 複製檔案描述子：rotate 可能在 fsync 前關閉分段 (關閉前已經 fsync 過)，
+            # 使用原本的描述子會得到 EBADF 或 fsync 到重複使用該編號的其他檔案
+            fd = os.dup(self._file.fileno()) if self.fsync else None
+        start = time.perf_counter()
+        if fd is not None:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.fsyncs += 1
+        self.total_fsync_ms += (time.perf_counter() - start) * 1000
+        return target
+
+    def rotate(self) -> int:
+        """結束目前分段並開始新分段 (快照開始時呼叫)，回傳已寫入的最後序號"""
+        with self._lock:
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = open(self._segment_path(self.last_seq + 1), "ab")
+            seq = self.last_seq
+        with self._sync_cond:
+            self.durable_seq = max(self.durable_seq, seq)
+            self._sync_cond.notify_all()
+        return seq
+
+    def drop_through(self, seq: int):
+        """刪除所有記錄都不大於 seq 的分段 (快照已涵蓋)"""
+        segments = self._segments()
+        for (first_seq, path), next_segment in zip(segments, segments[1:] + [None]):
+            if next_segment is not None and next_segment[0] - 1 <= seq:
+                os.remove(path)
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._file.close()
+
+    @staticmethod
+    def reset(directory: str):
+        """清空日誌 (索引另存到新目錄時，舊日誌對新快照無效)"""
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX):
+                    os.remove(os.path.join(directory, name))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "directory": self.directory,
+            "last_seq": self.last_seq,
+            "durable_seq": self.durable_seq,
+            "segments": len(self._segments()),
+            "appends": self.appends,
+            "bytes_written": self.bytes_written,
+            "fsyncs": self.fsyncs,
+            "appends_per_fsync": self.appends / self.fsyncs if self.fsyncs else 0.0,
+            "avg_fsync_ms": self.total_fsync_ms / self.fsyncs if self.fsyncs else 0.0,
+        }